@@ -0,0 +1,78 @@
+"""Microbenchmark: per-render cost of the menus shown on every screen.
+
+Run from the repository root (requires the bot's dependencies):
+
+    python -m benchmarks.bench_keyboards [--renders 20000] [--repeat 5]
+
+A "render" is what the common screens need: the main menu (all has_active /
+is_admin variants), the subscription menu, the plan list, the admin panel
+keyboard and the payment screen text. The legacy variant builds the pydantic
+models and formats the templates on every call, as before; the current one
+returns the objects precomputed at import.
+"""
+import argparse
+import time
+from typing import Callable, Dict
+
+from config import MESSAGES, SUBSCRIPTION_PLANS
+from handlers.payment import _PAYMENT_INFO_TEXTS
+from keyboards import inline
+
+
+_PLAN_KEYS = list(SUBSCRIPTION_PLANS)
+
+
+def _render_legacy(i: int) -> None:
+    flag = bool(i & 1)
+    inline._build_main_menu(flag, bool(i & 2))
+    inline._build_subscription_menu(flag)
+    inline._build_plans_menu()
+    inline._build_admin_panel_menu(flag)
+    plan = SUBSCRIPTION_PLANS[_PLAN_KEYS[i % len(_PLAN_KEYS)]]
+    MESSAGES["payment_info"].format(plan_name=plan["name"], price=plan["price"], days=plan["days"])
+
+
+def _render_cached(i: int) -> None:
+    flag = bool(i & 1)
+    inline.get_main_menu(flag, bool(i & 2))
+    inline.get_subscription_menu(flag)
+    inline.get_plans_menu()
+    inline.get_admin_panel_menu(flag)
+    _PAYMENT_INFO_TEXTS[_PLAN_KEYS[i % len(_PLAN_KEYS)]]
+
+
+def _best_of(fn: Callable[[int], None], renders: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for i in range(renders):
+            fn(i)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run(renders: int = 20_000, repeat: int = 5) -> Dict[str, float]:
+    legacy = _best_of(_render_legacy, renders, repeat)
+    cached = _best_of(_render_cached, renders, repeat)
+    return {
+        "renders": renders,
+        "legacy_us_per_render": legacy / renders * 1e6,
+        "cached_us_per_render": cached / renders * 1e6,
+        "speedup": legacy / cached if cached else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--renders", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    result = run(args.renders, args.repeat)
+    print(f"renders:          {result['renders']}")
+    print(f"legacy:           {result['legacy_us_per_render']:.2f} µs/render")
+    print(f"cached:           {result['cached_us_per_render']:.2f} µs/render")
+    print(f"speedup:          {result['speedup']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Microbenchmark: per-update overhead of MaintenanceMiddleware.
+
+Run from the repository root (requires the bot's dependencies):
+
+    python -m benchmarks.bench_maintenance [--updates 200000]
+
+Compares a bare handler call, the previous middleware (os.path.exists on
+every update plus list lookups of admin ids) and the current one (flag
+held in memory, frozenset lookup).
+"""
+import argparse
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, Dict
+
+from config import MAINTENANCE_FLAG_FILE
+from utils.maintenance import MaintenanceMiddleware
+
+
+class _LegacyMaintenanceMiddleware:
+    """The middleware as it was before the flag moved into memory."""
+
+    def __init__(self, admin_ids: list[int], admin_ids_str: list[str]):
+        self.admin_ids = admin_ids
+        self.admin_ids_str = admin_ids_str
+
+    async def __call__(self, handler, event, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        user_id = user.id if user else None
+        if not user_id:
+            return await handler(event, data)
+        if user_id in self.admin_ids or str(user_id) in self.admin_ids_str:
+            return await handler(event, data)
+        if os.path.exists(MAINTENANCE_FLAG_FILE):
+            return None
+        return await handler(event, data)
+
+
+async def _handler(event: Any, data: Dict[str, Any]) -> None:
+    return None
+
+
+async def _measure(call, updates: int) -> float:
+    event = SimpleNamespace()
+    data = {"event_from_user": SimpleNamespace(id=123456789)}
+    started = time.perf_counter()
+    for _ in range(updates):
+        await call(_handler, event, data)
+    return time.perf_counter() - started
+
+
+async def _bare(handler, event, data):
+    return await handler(event, data)
+
+
+async def run(updates: int = 200_000) -> Dict[str, float]:
+    legacy = _LegacyMaintenanceMiddleware(
+        admin_ids=list(range(1000, 1010)),
+        admin_ids_str=[str(x) for x in range(1000, 1010)],
+    )
+    current = MaintenanceMiddleware()
+    bare_s = await _measure(_bare, updates)
+    legacy_s = await _measure(legacy, updates)
+    current_s = await _measure(current, updates)
+    return {
+        "updates": updates,
+        "bare_ns_per_update": bare_s / updates * 1e9,
+        "legacy_overhead_ns": (legacy_s - bare_s) / updates * 1e9,
+        "current_overhead_ns": (current_s - bare_s) / updates * 1e9,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=200_000)
+    args = parser.parse_args()
+    result = asyncio.run(run(args.updates))
+    print(f"updates:            {result['updates']}")
+    print(f"bare handler:       {result['bare_ns_per_update']:.0f} ns/update")
+    print(f"legacy overhead:    {result['legacy_overhead_ns']:.0f} ns/update")
+    print(f"current overhead:   {result['current_overhead_ns']:.0f} ns/update")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Microbenchmark: cost of note parsing per user during a full user scan.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_notes [--users 50000] [--repeat 5]
+
+A "scan" calls the helpers the way the bot does for every user of a full
+list: expiry reminders (_already_notified_today), referral counting
+(extract_referrer_id), the admin user list (extract_username) and username
+sync (update_note_with_username). The legacy variant re-implements the
+pre-memoization parser to give a "before" number on the same machine.
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from utils import helpers
+
+
+# --- legacy implementation (before ParsedNote), kept only for comparison ---
+
+def _legacy_parse(note: Optional[str]) -> tuple[Dict[str, str], list[str]]:
+    fields: Dict[str, str] = {}
+    extras: list[str] = []
+    for segment in helpers.split_note_segments(note):
+        if ":" in segment:
+            key, value = segment.split(":", 1)
+            key_lower = key.strip().lower()
+            if key_lower in helpers.NOTE_KNOWN_KEYS:
+                fields[key_lower] = value.strip()
+                continue
+        extras.append(segment)
+    return fields, extras
+
+
+def _legacy_referrer(note: Optional[str]) -> Optional[int]:
+    fields, _ = _legacy_parse(note)
+    ref_val = fields.get("ref")
+    if not ref_val:
+        return None
+    candidate = ref_val.split("|")[0].split(";")[0].split(",")[0].strip()
+    return int(candidate) if candidate.isdigit() else None
+
+
+def _legacy_username(note: Optional[str]) -> Optional[str]:
+    fields, _ = _legacy_parse(note)
+    return helpers.normalize_username(fields.get("username"))
+
+
+def _legacy_update_username(note: Optional[str], username: Optional[str]) -> Optional[str]:
+    fields, extras = _legacy_parse(note)
+    ref_id = _legacy_referrer(note)
+    if ref_id is not None:
+        fields["ref"] = str(ref_id)
+    elif fields.get("ref") in {"", None}:
+        fields.pop("ref", None)
+    normalized = helpers.normalize_username(username)
+    if normalized:
+        fields["username"] = normalized
+    else:
+        fields.pop("username", None)
+    return helpers.assemble_note_components(fields, extras)
+
+
+def _legacy_notified(note: Optional[str], today: str) -> bool:
+    for segment in helpers.split_note_segments(note):
+        if segment.lower().startswith("nd:") and segment.removeprefix("nd:") == today:
+            return True
+    return False
+
+
+# --- scans ---
+
+def _scan_legacy(notes: List[Optional[str]], today: str) -> None:
+    for note in notes:
+        _legacy_notified(note, today)
+        _legacy_referrer(note)
+        _legacy_username(note)
+        _legacy_update_username(note, "someone")
+
+
+def _scan_current(notes: List[Optional[str]], today: str) -> None:
+    for note in notes:
+        today in helpers.parse_note(note).notify_tags
+        helpers.extract_referrer_id(note)
+        helpers.extract_username(note)
+        helpers.update_note_with_username(note, "someone")
+
+
+def make_notes(count: int, seed: int = 42) -> List[Optional[str]]:
+    rnd = random.Random(seed)
+    notes: List[Optional[str]] = []
+    for i in range(count):
+        ref = rnd.randint(10_000_000, 99_999_999) if rnd.random() < 0.4 else None
+        username = f"user{i}" if rnd.random() < 0.8 else None
+        extras = [f"nd:2024{rnd.randint(1, 12):02d}{rnd.randint(1, 28):02d}"] if rnd.random() < 0.3 else []
+        notes.append(helpers.build_user_note(ref, username, extras))
+    return notes
+
+
+def _best_of(fn, notes, today: str, repeat: int, reset_cache: bool) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        if reset_cache:
+            helpers._parse_note_cached.cache_clear()
+        started = time.perf_counter()
+        fn(notes, today)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run(users: int = 50_000, repeat: int = 5) -> Dict[str, float]:
+    notes = make_notes(users)
+    today = datetime.now().strftime("%Y%m%d")
+    legacy = _best_of(_scan_legacy, notes, today, repeat, reset_cache=False)
+    # Холодный кэш — каждый проход начинается с пустого кэша, как после рестарта
+    cold = _best_of(_scan_current, notes, today, repeat, reset_cache=True)
+    return {
+        "users": users,
+        "legacy_us_per_user": legacy / users * 1e6,
+        "memoized_us_per_user": cold / users * 1e6,
+        "speedup": legacy / cold if cold else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    result = run(args.users, args.repeat)
+    print(f"users:            {result['users']}")
+    print(f"legacy:           {result['legacy_us_per_user']:.2f} µs/user")
+    print(f"memoized (cold):  {result['memoized_us_per_user']:.2f} µs/user")
+    print(f"speedup:          {result['speedup']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
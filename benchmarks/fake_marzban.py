@@ -0,0 +1,209 @@
+"""Local Marzban panel stand-in for load testing MarzbanService without the real panel.
+
+Implements the REST endpoints the bot uses (token, users pagination, user
+get/add/modify, revoke_sub, hosts, inbounds) on top of FakeMarzbanStore, so
+latency/error injection and request counters are shared with the in-process fakes.
+
+    python -m benchmarks.fake_marzban --users 100000 --latency 0.02 --error-rate 0.01 --port 8800
+
+then point the bot (or a benchmark) at it with MARZBAN_URL=http://127.0.0.1:8800;
+any admin username/password is accepted.
+
+Control endpoints (not part of Marzban):
+    GET  /_fake/stats              request and injected error counts per endpoint
+    POST /_fake/reset              zero the counters
+    POST /_fake/seed?count=N       add N more synthetic users
+    POST /_fake/config?latency=&jitter=&error_rate=   change injection on the fly
+
+For in-process use (benchmarks) FakeMarzbanServer runs the app in a background
+thread: ``with FakeMarzbanServer(store) as url: ...``.
+"""
+import argparse
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from benchmarks.fakes import FakeMarzbanError, FakeMarzbanStore
+
+
+_HOSTS = {
+    "VLESS TCP REALITY": [
+        {"remark": "🇳🇱 Netherlands", "address": "nl.example.com", "port": 443, "sni": "nl.example.com"},
+        {"remark": "🇫🇮 Finland", "address": "fi.example.com", "port": 443, "sni": "fi.example.com"},
+    ],
+}
+_INBOUNDS = {
+    "vless": [
+        {"tag": "VLESS TCP REALITY", "protocol": "vless", "network": "tcp", "tls": "reality", "port": 443},
+    ],
+}
+
+
+def _error(e: FakeMarzbanError) -> JSONResponse:
+    return JSONResponse({"detail": e.detail}, status_code=e.status)
+
+
+def create_fake_marzban_app(store: FakeMarzbanStore) -> FastAPI:
+    app = FastAPI(title="Fake Marzban")
+
+    @app.post("/api/admin/token")
+    async def token():
+        try:
+            await store.call("token")
+        except FakeMarzbanError as e:
+            return _error(e)
+        return {"access_token": "fake-token", "token_type": "bearer"}
+
+    @app.get("/api/users")
+    async def users(offset: int = 0, limit: int = 50):
+        try:
+            await store.call("get_users")
+        except FakeMarzbanError as e:
+            return _error(e)
+        return store.page(offset, limit)
+
+    @app.get("/api/user/{username}")
+    async def get_user(username: str):
+        try:
+            await store.call("get_user")
+            return store.get(username)
+        except FakeMarzbanError as e:
+            return _error(e)
+
+    @app.post("/api/user")
+    async def add_user(request: Request):
+        body: Dict[str, Any] = await request.json()
+        try:
+            await store.call("add_user")
+            return store.create(body["username"], body.get("expire"), body.get("note"))
+        except FakeMarzbanError as e:
+            return _error(e)
+
+    @app.put("/api/user/{username}")
+    async def modify_user(username: str, request: Request):
+        body: Dict[str, Any] = await request.json()
+        try:
+            await store.call("modify_user")
+            return store.modify(username, body)
+        except FakeMarzbanError as e:
+            return _error(e)
+
+    @app.post("/api/user/{username}/revoke_sub")
+    async def revoke_sub(username: str):
+        try:
+            await store.call("revoke_sub")
+            return store.get(username)
+        except FakeMarzbanError as e:
+            return _error(e)
+
+    @app.get("/api/hosts")
+    async def hosts():
+        try:
+            await store.call("hosts")
+        except FakeMarzbanError as e:
+            return _error(e)
+        return _HOSTS
+
+    @app.get("/api/inbounds")
+    async def inbounds():
+        try:
+            await store.call("inbounds")
+        except FakeMarzbanError as e:
+            return _error(e)
+        return _INBOUNDS
+
+    @app.get("/_fake/stats")
+    async def stats():
+        return {
+            "users": len(store.users),
+            "requests": dict(store.requests),
+            "errors": dict(store.errors),
+            "latency": store.latency,
+            "jitter": store.jitter,
+            "error_rate": store.error_rate,
+        }
+
+    @app.post("/_fake/reset")
+    async def reset():
+        store.requests.clear()
+        store.errors.clear()
+        return {"status": "ok"}
+
+    @app.post("/_fake/seed")
+    async def seed(count: int):
+        store.seed(count, start_id=100_000_000 + len(store.order))
+        return {"users": len(store.users)}
+
+    @app.post("/_fake/config")
+    async def configure(
+        latency: Optional[float] = None, jitter: Optional[float] = None, error_rate: Optional[float] = None
+    ):
+        if latency is not None:
+            store.latency = latency
+        if jitter is not None:
+            store.jitter = jitter
+        if error_rate is not None:
+            store.error_rate = error_rate
+        return {"latency": store.latency, "jitter": store.jitter, "error_rate": store.error_rate}
+
+    return app
+
+
+class FakeMarzbanServer(threading.Thread):
+    """Fake panel served from a background thread with its own event loop."""
+
+    def __init__(self, store: FakeMarzbanStore, host: str = "127.0.0.1", port: int = 8800):
+        super().__init__(name="fake-marzban", daemon=True)
+        self.store = store
+        self.host = host
+        self.port = port
+        self._server = uvicorn.Server(
+            uvicorn.Config(app=create_fake_marzban_app(store), host=host, port=port, log_level="warning")
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def run(self) -> None:
+        asyncio.run(self._server.serve())
+
+    def __enter__(self) -> str:
+        self.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if not self.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"Fake Marzban failed to start on {self.url}")
+            time.sleep(0.05)
+        return self.url
+
+    def __exit__(self, *exc: Any) -> None:
+        self._server.should_exit = True
+        self.join(timeout=10)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local Marzban panel stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--users", type=int, default=10_000, help="synthetic users to seed")
+    parser.add_argument("--latency", type=float, default=0.0, help="base latency per request, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency up to this, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    store = FakeMarzbanStore(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    started = time.perf_counter()
+    store.seed(args.users, seed=args.seed)
+    print(f"seeded {args.users} users in {time.perf_counter() - started:.2f}s")
+    uvicorn.run(create_fake_marzban_app(store), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
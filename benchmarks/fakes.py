@@ -0,0 +1,277 @@
+"""In-process stand-ins for Marzban and the Telegram Bot used by benchmarks and load tools.
+
+FakeMarzbanStore keeps users in the JSON shape returned by the Marzban REST API
+(so the HTTP stand-in in benchmarks.fake_marzban can serve it as is).
+FakeMarzbanAPI exposes the subset of marzban.MarzbanAPI that MarzbanService calls
+and can be assigned to ``MarzbanService.api`` directly.
+"""
+import asyncio
+import functools
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from utils.helpers import build_user_note
+
+
+class FakeMarzbanError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(f"{status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+def _user_payload(username: str, expire: Optional[int], note: Optional[str], status: str = "active") -> Dict[str, Any]:
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return {
+        "username": username,
+        "proxies": {"vless": {"id": None, "flow": "xtls-rprx-vision"}},
+        "expire": expire,
+        "data_limit": None,
+        "data_limit_reset_strategy": "no_reset",
+        "inbounds": {"vless": ["VLESS TCP REALITY"]},
+        "note": note,
+        "sub_updated_at": None,
+        "sub_last_user_agent": None,
+        "online_at": None,
+        "on_hold_expire_duration": None,
+        "on_hold_timeout": None,
+        "auto_delete_in_days": None,
+        "status": status,
+        "used_traffic": 0,
+        "lifetime_used_traffic": 0,
+        "created_at": now,
+        "links": [],
+        # Пустая ссылка: иначе MarzbanService пойдёт шифровать её во внешний Happ API
+        "subscription_url": "",
+        "excluded_inbounds": {"vless": []},
+        "admin": None,
+    }
+
+
+class FakeMarzbanStore:
+    """Synthetic Marzban user base with latency/error injection and request counters."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 1):
+        self.users: Dict[str, Dict[str, Any]] = {}
+        # Порядок для пагинации (как в панели — по дате создания)
+        self.order: List[str] = []
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests: Counter[str] = Counter()
+        self.errors: Counter[str] = Counter()
+        self._rnd = random.Random(seed)
+
+    def seed(self, count: int, seed: int = 42, start_id: int = 100_000_000) -> None:
+        """Add ``count`` users tg_<id> with a realistic mix of notes and expiry dates."""
+        rnd = random.Random(seed)
+        now = int(time.time())
+        referrers: List[int] = []
+        for i in range(count):
+            telegram_id = start_id + i
+            ref = rnd.choice(referrers) if referrers and rnd.random() < 0.3 else None
+            username = f"user{i}" if rnd.random() < 0.8 else None
+            extras = [f"nd:{time.strftime('%Y%m%d')}"] if rnd.random() < 0.05 else []
+            expire = now + rnd.randint(-60, 90) * 86400
+            status = "active" if expire > now else "expired"
+            self.add(_user_payload(f"tg_{telegram_id}", expire, build_user_note(ref, username, extras), status))
+            if rnd.random() < 0.1:
+                referrers.append(telegram_id)
+
+    def add(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        username = payload["username"]
+        if username not in self.users:
+            self.order.append(username)
+        self.users[username] = payload
+        return payload
+
+    async def call(self, endpoint: str) -> None:
+        """Account a request and apply configured latency / random failures."""
+        self.requests[endpoint] += 1
+        delay = self.latency + (self._rnd.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self._rnd.random() < self.error_rate:
+            self.errors[endpoint] += 1
+            raise FakeMarzbanError(500, "Injected failure")
+
+    def get(self, username: str) -> Dict[str, Any]:
+        user = self.users.get(username)
+        if user is None:
+            raise FakeMarzbanError(404, "User not found")
+        return user
+
+    def create(self, username: str, expire: Optional[int], note: Optional[str]) -> Dict[str, Any]:
+        if username in self.users:
+            raise FakeMarzbanError(409, "User already exists")
+        return self.add(_user_payload(username, expire, note))
+
+    def modify(self, username: str, changes: Dict[str, Any]) -> Dict[str, Any]:
+        user = self.get(username)
+        for key in ("expire", "status", "note", "data_limit"):
+            if changes.get(key) is not None:
+                user[key] = changes[key]
+        if user.get("expire") and user["expire"] > time.time() and changes.get("status") is None:
+            user["status"] = "active"
+        return user
+
+    def page(self, offset: int, limit: int) -> Dict[str, Any]:
+        names = self.order[offset: offset + limit]
+        return {"users": [self.users[name] for name in names], "total": len(self.order)}
+
+
+def _model_fields(model: Any) -> Dict[str, Any]:
+    if hasattr(model, "model_dump"):
+        return model.model_dump()
+    if isinstance(model, dict):
+        return model
+    return dict(vars(model))
+
+
+def _ns(payload: Dict[str, Any]) -> SimpleNamespace:
+    return SimpleNamespace(**payload)
+
+
+def _as_http_error(error: FakeMarzbanError, endpoint: str) -> httpx.HTTPStatusError:
+    # Как у настоящего клиента: raise_for_status() -> httpx.HTTPStatusError
+    request = httpx.Request("GET", f"http://fake-marzban/api/{endpoint}")
+    response = httpx.Response(error.status, json={"detail": error.detail}, request=request)
+    return httpx.HTTPStatusError(str(error), request=request, response=response)
+
+
+def _http_errors(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+        try:
+            return await method(self, *args, **kwargs)
+        except FakeMarzbanError as e:
+            raise _as_http_error(e, method.__name__) from None
+    return wrapper
+
+
+class FakeMarzbanAPI:
+    """Drop-in for the MarzbanAPI methods used by MarzbanService.
+
+    Store errors surface as httpx.HTTPStatusError, like the real client's."""
+
+    def __init__(self, store: FakeMarzbanStore):
+        self.store = store
+
+    @_http_errors
+    async def get_token(self, username: str, password: str) -> SimpleNamespace:
+        await self.store.call("token")
+        return SimpleNamespace(access_token="fake-token", token_type="bearer")
+
+    @_http_errors
+    async def get_user(self, username: str, token: str) -> SimpleNamespace:
+        await self.store.call("get_user")
+        return _ns(self.store.get(username))
+
+    @_http_errors
+    async def add_user(self, user: Any, token: str) -> SimpleNamespace:
+        await self.store.call("add_user")
+        fields = _model_fields(user)
+        return _ns(self.store.create(fields["username"], fields.get("expire"), fields.get("note")))
+
+    @_http_errors
+    async def modify_user(self, username: str, user: Any, token: str) -> SimpleNamespace:
+        await self.store.call("modify_user")
+        return _ns(self.store.modify(username, _model_fields(user)))
+
+    @_http_errors
+    async def get_users(self, token: str, offset: int = 0, limit: int = 50, **_: Any) -> SimpleNamespace:
+        await self.store.call("get_users")
+        page = self.store.page(offset, limit)
+        return SimpleNamespace(users=[_ns(u) for u in page["users"]], total=page["total"])
+
+    @_http_errors
+    async def revoke_user_subscription(self, username: str, token: str) -> SimpleNamespace:
+        await self.store.call("revoke_sub")
+        return _ns(self.store.get(username))
+
+    @_http_errors
+    async def get_hosts(self, token: str) -> Dict[str, Any]:
+        await self.store.call("hosts")
+        return {}
+
+    @_http_errors
+    async def get_inbounds(self, token: str) -> Dict[str, Any]:
+        await self.store.call("inbounds")
+        return {}
+
+    async def close(self) -> None:
+        return None
+
+
+_SERVICE_MODULES = ("handlers.start", "handlers.subscription", "handlers.payment", "handlers.admin_users", "handlers.news")
+
+
+def install_fake_marzban(store: FakeMarzbanStore) -> FakeMarzbanAPI:
+    """Point every handler's MarzbanService (and the username sync service) at the store."""
+    import importlib
+
+    from utils import usernames
+
+    api = FakeMarzbanAPI(store)
+    for module_name in _SERVICE_MODULES:
+        importlib.import_module(module_name).marzban_service.api = api
+    usernames._get_service().api = api
+    return api
+
+
+class FakeBot:
+    """Minimal Bot replacement: records outgoing messages instead of calling the Bot API."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent: Counter[str] = Counter()
+        # (chat_id, perf_counter, есть ли клавиатура) для каждого send_message
+        self.messages: List[tuple[int, float, bool]] = []
+
+    async def _call(self, method: str) -> SimpleNamespace:
+        self.sent[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return SimpleNamespace(message_id=self.sent[method], chat=SimpleNamespace(id=0))
+
+    async def send_message(self, chat_id: int, text: str, **kwargs: Any) -> SimpleNamespace:
+        result = await self._call("send_message")
+        self.messages.append((chat_id, time.perf_counter(), kwargs.get("reply_markup") is not None))
+        return result
+
+    async def copy_message(self, chat_id: int, from_chat_id: int, message_id: int, **_: Any) -> SimpleNamespace:
+        return await self._call("copy_message")
+
+    async def send_document(self, chat_id: int, document: Any, **_: Any) -> SimpleNamespace:
+        return await self._call("send_document")
+
+
+def signed_notification(
+    payment_service: Any,
+    telegram_id: int,
+    plan_key: str,
+    price: Any,
+    operation_id: Optional[str] = None,
+    commission: float = 0.03,
+) -> Dict[str, str]:
+    """A YooMoney HTTP notification as webhook.yoomoney_webhook receives it (form fields), signed."""
+    withdraw = float(price)
+    data = {
+        "notification_type": "p2p-incoming",
+        "operation_id": operation_id or f"{int(time.time() * 1000)}{random.randint(1000, 9999)}",
+        "amount": f"{withdraw * (1 - commission):.2f}",
+        "withdraw_amount": f"{withdraw:.2f}",
+        "currency": "643",
+        "datetime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "sender": "41001000040",
+        "codepro": "false",
+        "label": f"{telegram_id}_{plan_key}_{random.getrandbits(32):08x}",
+        "unaccepted": "false",
+    }
+    data["sha1_hash"] = payment_service.notification_signature(data)
+    return data
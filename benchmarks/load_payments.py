@@ -0,0 +1,380 @@
+"""YooMoney notification replay and load tool for the payment path.
+
+Sends correctly signed notifications (PaymentService.notification_signature) as
+application/x-www-form-urlencoded POSTs, exactly like YooMoney calls
+webhook.yoomoney_webhook, at a fixed rate (open loop: sends are scheduled on the
+clock and never wait for earlier responses).
+
+In-process (default) the webhook app runs via httpx's ASGI transport against the
+fake Marzban store and a recording Bot, in the bot's inline mode or with
+``--mode queue`` (ingest into utils.payment_queue + worker). This measures
+acceptance latency, end-to-end activation time (POST until the user is sent the
+"payment received" message) and whether duplicates are activated more than once.
+
+    python -m benchmarks.load_payments --count 2000 --rate 200 --duplicates 0.1 [--mode queue]
+    python -m benchmarks.load_payments --replay bot.log --fresh-ids --rate 50
+    python -m benchmarks.load_payments --url http://127.0.0.1:8000/yoomoney \
+        --marzban-url http://127.0.0.1:8800 --count 500 --rate 50
+
+Against a running webhook (``--url``) notifications are signed with
+YOOMONEY_NOTIFICATION_SECRET from the environment (or ``--secret``);
+activation is tracked by polling the fake Marzban panel (``--marzban-url``,
+see benchmarks.fake_marzban) until the user's expiry changes.
+
+``--replay`` accepts JSON lines with notification fields or the bot's log, whose
+"YooMoney webhook received: {...}" lines are parsed (the logged dicts have no
+sha1_hash, so replayed notifications are always re-signed).
+
+The exit code is 1 if any answer was not "200 OK" or any payment was not
+activated within ``--settle`` seconds.
+"""
+import argparse
+import ast
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+# Изолируем файлы состояния от рабочих баз до импорта config
+_TMP_DIR = tempfile.mkdtemp(prefix="averra-payments-")
+for _name, _file in (
+    ("STATS_DB_FILE", "stats.db"),
+    ("PROMO_DB_FILE", "promocodes.db"),
+    ("PAYMENT_QUEUE_DB_FILE", "payment_queue.db"),
+    ("SHARED_STATE_DB_FILE", "shared_state.db"),
+):
+    os.environ[_name] = os.path.join(_TMP_DIR, _file)
+os.environ["SHARED_STATE_BACKEND"] = "memory"
+os.environ.setdefault("YOOMONEY_NOTIFICATION_SECRET", "load-test-secret")
+
+import httpx  # noqa: E402
+
+from benchmarks.fakes import FakeBot, FakeMarzbanStore, install_fake_marzban, signed_notification  # noqa: E402
+from config import SUBSCRIPTION_PLANS, YOOMONEY_NOTIFICATION_SECRET, YOOMONEY_WALLET_ID  # noqa: E402
+from services.payment_service import PaymentService  # noqa: E402
+from utils.helpers import extract_referrer_id  # noqa: E402
+
+
+_LOG_MARKER = "YooMoney webhook received:"
+
+
+def load_replay(path: str) -> List[Dict[str, str]]:
+    """Notifications from JSON lines or from the bot's log."""
+    notifications: List[Dict[str, str]] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if _LOG_MARKER in line:
+                raw = ast.literal_eval(line.split(_LOG_MARKER, 1)[1].strip())
+            elif line.startswith("{"):
+                raw = json.loads(line)
+            else:
+                continue
+            notifications.append({k: str(v) for k, v in raw.items()})
+    return notifications
+
+
+def _refresh_ids(data: Dict[str, str], n: int) -> None:
+    """New operation_id and label suffix: otherwise a repeated replay is a duplicate of the previous one."""
+    data["operation_id"] = f"{int(time.time() * 1000)}{n:06d}"
+    parts = data.get("label", "").rsplit("_", 1)
+    if len(parts) == 2:
+        data["label"] = f"{parts[0]}_{random.getrandbits(32):08x}"
+
+
+def _payer_pool(store: FakeMarzbanStore) -> List[int]:
+    """Existing users who are nobody's referrer: their only messages are payment confirmations."""
+    referrers = {extract_referrer_id(user.get("note")) for user in store.users.values()}
+    return [int(name[3:]) for name in store.order if int(name[3:]) not in referrers]
+
+
+def generate(
+    payment_service: PaymentService, count: int, payers: List[int], new_share: float, seed: int
+) -> List[Dict[str, str]]:
+    rnd = random.Random(seed)
+    rnd.shuffle(payers)
+    plans = list(SUBSCRIPTION_PLANS)
+    new_id = 950_000_000
+    notifications = []
+    for n in range(count):
+        if payers and rnd.random() >= new_share:
+            telegram_id = payers.pop()
+        else:
+            new_id += 1
+            telegram_id = new_id
+        plan_key = rnd.choice(plans)
+        notifications.append(
+            signed_notification(
+                payment_service,
+                telegram_id,
+                plan_key,
+                SUBSCRIPTION_PLANS[plan_key]["price"],
+                operation_id=f"{int(time.time() * 1000)}{n:06d}",
+            )
+        )
+    return notifications
+
+
+def _telegram_id(data: Dict[str, str]) -> Optional[int]:
+    head = data.get("label", "").split("_", 1)[0]
+    return int(head) if head.isdigit() else None
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {"count": len(ordered), "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": ordered[-1] * 1000}
+
+
+async def _poll_activation(
+    client: httpx.AsyncClient, marzban_url: str, telegram_id: int, before: Any, sent_at: float, timeout: float
+) -> Optional[float]:
+    deadline = sent_at + timeout
+    while time.perf_counter() < deadline:
+        resp = await client.get(f"{marzban_url}/api/user/tg_{telegram_id}")
+        if resp.status_code == 200 and resp.json().get("expire") != before:
+            return time.perf_counter()
+        await asyncio.sleep(0.05)
+    return None
+
+
+async def run(
+    notifications: List[Dict[str, str]],
+    rate: float,
+    duplicates: float = 0.0,
+    mode: str = "inline",
+    url: Optional[str] = None,
+    marzban_url: Optional[str] = None,
+    store: Optional[FakeMarzbanStore] = None,
+    settle: float = 10.0,
+    seed: int = 11,
+) -> Dict[str, Any]:
+    rnd = random.Random(seed)
+    # Дубликаты — повторная отправка того же уведомления через 0–2 с, как ретраи YooMoney
+    schedule: List[tuple[float, Dict[str, str], bool]] = []
+    for i, data in enumerate(notifications):
+        at = i / rate
+        schedule.append((at, data, False))
+        if rnd.random() < duplicates:
+            schedule.append((at + rnd.uniform(0, 2), data, True))
+    schedule.sort(key=lambda item: item[0])
+
+    bot = FakeBot()
+    worker: Optional[asyncio.Task] = None
+    if url is None:
+        from webhook import create_app
+
+        app = create_app(payment_queue=(mode == "queue"))
+        app.state.bot = bot
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+        target = "/yoomoney"
+        if mode == "queue":
+            from utils.payment_queue import run_payment_queue_worker
+
+            worker = asyncio.create_task(run_payment_queue_worker(bot))
+    else:
+        client = httpx.AsyncClient(timeout=30)
+        target = url
+
+    poller = httpx.AsyncClient(timeout=10) if url is not None and marzban_url else None
+    expire_before: Dict[int, Any] = {}
+    if poller is not None:
+        for data in notifications:
+            telegram_id = _telegram_id(data)
+            if telegram_id is None:
+                continue
+            resp = await poller.get(f"{marzban_url}/api/user/tg_{telegram_id}")
+            expire_before[telegram_id] = resp.json().get("expire") if resp.status_code == 200 else None
+
+    acceptance: Dict[str, List[float]] = defaultdict(list)
+    answers: Counter[str] = Counter()
+    first_sent: Dict[str, float] = {}
+    polled: Dict[str, float] = {}
+
+    async def send(data: Dict[str, str], duplicate: bool) -> None:
+        body = urlencode(data)
+        started = time.perf_counter()
+        if not duplicate:
+            first_sent[data["operation_id"]] = started
+        try:
+            resp = await client.post(
+                target, content=body, headers={"content-type": "application/x-www-form-urlencoded"}
+            )
+            answer = f"{resp.status_code} {resp.text.strip()[:20]}"
+        except httpx.HTTPError as e:
+            answer = type(e).__name__
+        acceptance["duplicate" if duplicate else "original"].append(time.perf_counter() - started)
+        answers[("dup " if duplicate else "") + answer] += 1
+        telegram_id = _telegram_id(data)
+        if poller is not None and not duplicate and telegram_id is not None:
+            activated = await _poll_activation(
+                poller, marzban_url, telegram_id, expire_before.get(telegram_id), started, settle
+            )
+            if activated is not None:
+                polled[data["operation_id"]] = activated
+
+    started = time.perf_counter()
+    tasks = []
+    for at, data, duplicate in schedule:
+        delay = started + at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(data, duplicate)))
+    await asyncio.gather(*tasks)
+    send_elapsed = time.perf_counter() - started
+
+    # Ждём, пока обработчик очереди разберёт принятые уведомления
+    by_user: Dict[int, List[str]] = defaultdict(list)
+    for data in notifications:
+        telegram_id = _telegram_id(data)
+        if telegram_id is not None:
+            by_user[telegram_id].append(data["operation_id"])
+    if url is None:
+        deadline = time.perf_counter() + settle
+        while time.perf_counter() < deadline:
+            confirmed = {chat_id for chat_id, _, markup in bot.messages if markup}
+            if all(telegram_id in confirmed for telegram_id in by_user):
+                break
+            await asyncio.sleep(0.05)
+        # Дубликаты, пришедшие последними, успевают обработаться
+        await asyncio.sleep(0.2)
+    if worker is not None:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+    await client.aclose()
+    if poller is not None:
+        await poller.aclose()
+
+    activation: List[float] = []
+    double_activations = 0
+    not_activated = 0
+    if url is None:
+        # Подтверждение оплаты — сообщение пользователю с клавиатурой; реферальные бонусы идут без неё
+        confirmations: Dict[int, List[float]] = defaultdict(list)
+        for chat_id, at, markup in bot.messages:
+            if markup:
+                confirmations[chat_id].append(at)
+        for telegram_id, operation_ids in by_user.items():
+            times = sorted(confirmations.get(telegram_id, []))
+            if len(times) > len(operation_ids):
+                double_activations += len(times) - len(operation_ids)
+            sent = sorted(first_sent[op] for op in operation_ids if op in first_sent)
+            not_activated += max(0, len(sent) - len(times))
+            activation.extend(t - s for s, t in zip(sent, times))
+    else:
+        for data in notifications:
+            op = data["operation_id"]
+            if op in polled:
+                activation.append(polled[op] - first_sent[op])
+            elif poller is not None:
+                not_activated += 1
+
+    return {
+        "mode": "external" if url else mode,
+        "notifications": len(notifications),
+        "duplicates_sent": sum(1 for _, _, dup in schedule if dup),
+        "rate": rate,
+        "achieved_rate": len(schedule) / send_elapsed if send_elapsed else 0.0,
+        "answers": dict(answers),
+        "acceptance": {kind: _percentiles(samples) for kind, samples in acceptance.items()},
+        "activation": _percentiles(activation),
+        "not_activated": not_activated if (url is None or poller is not None) else None,
+        "double_activations": double_activations if url is None else None,
+        "marzban_requests": dict(store.requests) if store is not None else None,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="YooMoney notification replay and load tool")
+    parser.add_argument("--count", type=int, default=1000, help="notifications to generate")
+    parser.add_argument("--rate", type=float, default=100.0, help="notifications per second")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="share of notifications sent twice")
+    parser.add_argument("--new-users", type=float, default=0.2, help="share of payments from unknown users")
+    parser.add_argument("--mode", choices=("inline", "queue"), default="inline", help="in-process webhook mode")
+    parser.add_argument("--users", type=int, default=50_000, help="synthetic users in the fake Marzban")
+    parser.add_argument("--marzban-latency", type=float, default=0.0)
+    parser.add_argument("--replay", help="JSON lines or bot log with notifications to replay")
+    parser.add_argument("--fresh-ids", action="store_true", help="new operation_id/label for replayed notifications")
+    parser.add_argument("--url", help="POST to a running webhook instead of the in-process app")
+    parser.add_argument("--marzban-url", help="fake Marzban panel to poll for activation with --url")
+    parser.add_argument("--secret", default=YOOMONEY_NOTIFICATION_SECRET)
+    parser.add_argument("--settle", type=float, default=10.0, help="seconds to wait for activations")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    payment_service = PaymentService(YOOMONEY_WALLET_ID, args.secret)
+    store: Optional[FakeMarzbanStore] = None
+    if args.url is None:
+        import handlers.payment
+
+        store = FakeMarzbanStore(latency=args.marzban_latency)
+        store.seed(args.users)
+        install_fake_marzban(store)
+        # In-process приложение проверяет подписи своим сервисом
+        handlers.payment.payment_service.notification_secret = args.secret
+        payment_service = handlers.payment.payment_service
+
+    if args.replay:
+        notifications = load_replay(args.replay)
+        for n, data in enumerate(notifications):
+            if args.fresh_ids:
+                _refresh_ids(data, n)
+            data["sha1_hash"] = payment_service.notification_signature(data)
+    else:
+        payers = _payer_pool(store) if store is not None else []
+        notifications = generate(payment_service, args.count, payers, args.new_users, args.seed)
+
+    report = asyncio.run(
+        run(
+            notifications,
+            rate=args.rate,
+            duplicates=args.duplicates,
+            mode=args.mode,
+            url=args.url,
+            marzban_url=args.marzban_url,
+            store=store,
+            settle=args.settle,
+            seed=args.seed,
+        )
+    )
+    print(
+        f"{report['notifications']} notifications (+{report['duplicates_sent']} duplicates), mode {report['mode']}, "
+        f"rate {report['rate']:.0f}/s (achieved {report['achieved_rate']:.0f}/s)"
+    )
+    print(f"Answers: {report['answers']}")
+    for kind, p in report["acceptance"].items():
+        print(f"Acceptance ({kind}): p50 {p['p50_ms']:.1f} ms, p90 {p['p90_ms']:.1f} ms, p99 {p['p99_ms']:.1f} ms, max {p['max_ms']:.1f} ms")
+    p = report["activation"]
+    if p:
+        print(f"Activation: p50 {p['p50_ms']:.1f} ms, p90 {p['p90_ms']:.1f} ms, p99 {p['p99_ms']:.1f} ms, max {p['max_ms']:.1f} ms")
+    if report["not_activated"] is not None:
+        print(f"Not activated within {args.settle:.0f}s: {report['not_activated']}")
+    if report["double_activations"] is not None:
+        print(f"Duplicates activated again: {report['double_activations']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed_answers = sum(n for answer, n in report["answers"].items() if answer.removeprefix("dup ") != "200 OK")
+    if failed_answers or report["not_activated"]:
+        print(f"FAILED: {failed_answers} answers other than 200 OK, {report['not_activated'] or 0} not activated")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""Synthetic Telegram update load for the real Dispatcher.
+
+Builds a realistic stream of Message and CallbackQuery updates (/start with
+and without referral payloads, my_subscription, plan browsing and selection,
+back to menu, admin user-list paging) and feeds it through main.build_dispatcher()
+with all routers and middlewares via Dispatcher.feed_update. The Bot uses a fake
+session: Bot API calls are answered locally (optionally after --bot-latency)
+and Marzban is replaced by FakeMarzbanStore with --users synthetic users.
+
+    python -m benchmarks.load_updates --updates 20000 --concurrency 200 --users 100000 \
+        [--marzban-latency 0.02] [--bot-latency 0.05] [--tracemalloc] [--json out.json]
+
+Reports updates/s, latency percentiles for whole updates and per handler,
+Bot API calls by method and peak memory (max RSS; tracemalloc peak if enabled).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Изолируем файлы состояния от рабочих баз и задаём админа для сценария пейджинга до импорта config
+_BENCH_ADMIN_ID = 999_000_001
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ["ADMIN_IDS"] = str(_BENCH_ADMIN_ID)
+os.environ["SHARED_STATE_BACKEND"] = "memory"
+_TMP_DIR = tempfile.mkdtemp(prefix="averra-load-")
+for _name, _file in (
+    ("STATS_DB_FILE", "stats.db"),
+    ("PROMO_DB_FILE", "promocodes.db"),
+    ("PAYMENT_QUEUE_DB_FILE", "payment_queue.db"),
+    ("SHARED_STATE_DB_FILE", "shared_state.db"),
+):
+    os.environ[_name] = os.path.join(_TMP_DIR, _file)
+
+from aiogram import BaseMiddleware, Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import TelegramMethod  # noqa: E402
+from aiogram.types import TelegramObject, Update  # noqa: E402
+
+from benchmarks.fakes import FakeMarzbanStore, install_fake_marzban  # noqa: E402
+from config import REFERRAL, SUBSCRIPTION_PLANS  # noqa: E402
+
+
+_MESSAGE_RESULT_METHODS = {"sendMessage", "editMessageText", "copyMessage", "sendDocument", "editMessageReplyMarkup"}
+
+
+class FakeTelegramSession(BaseSession):
+    """Bot API session that answers locally and counts calls by method."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._message_id = 0
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = method.__api_method__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if name == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif name in _MESSAGE_RESULT_METHODS:
+            self._message_id += 1
+            chat_id = getattr(method, "chat_id", None) or 0
+            result = {
+                "message_id": getattr(method, "message_id", None) or self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": getattr(method, "text", None) or "",
+            }
+        else:
+            result = True
+        # Тот же разбор ответа, что у AiohttpSession: модели получают контекст бота
+        response = self.check_response(
+            bot=bot, method=method, status_code=200, content=json.dumps({"ok": True, "result": result})
+        )
+        return response.result
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        yield b""
+
+    async def close(self) -> None:
+        return None
+
+
+class HandlerLatencyRecorder(BaseMiddleware):
+    """Inner-middleware: raw per-handler durations for percentiles."""
+
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__qualname__", None) or "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples[name].append(time.perf_counter() - started)
+
+
+class UpdateFactory:
+    """Weighted mix of user scenarios as raw Bot API update dicts."""
+
+    SCENARIOS = (
+        ("start", 20),
+        ("start_new_ref", 5),
+        ("my_subscription", 30),
+        ("buy_subscription", 10),
+        ("plan", 15),
+        ("back_to_main", 10),
+        ("admin_page", 10),
+    )
+
+    def __init__(self, store: FakeMarzbanStore, seed: int = 7):
+        self.rnd = random.Random(seed)
+        self.existing = [int(name[3:]) for name in store.order]
+        self.next_new_id = 900_000_000
+        self.update_id = 0
+        self.names = [name for name, _ in self.SCENARIOS]
+        self.weights = [weight for _, weight in self.SCENARIOS]
+        self.plan_keys = list(SUBSCRIPTION_PLANS)
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"U{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> Dict[str, Any]:
+        message = {
+            "message_id": self.rnd.randint(1, 1_000_000),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def _callback(self, user_id: int, data: str) -> Dict[str, Any]:
+        message = self._message(1, "…")
+        message["chat"] = {"id": user_id, "type": "private"}
+        return {
+            "id": str(self.rnd.getrandbits(48)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message,
+        }
+
+    def next(self) -> tuple[str, Dict[str, Any]]:
+        self.update_id += 1
+        scenario = self.rnd.choices(self.names, self.weights)[0]
+        user_id = self.rnd.choice(self.existing) if self.existing else 100_000_000
+        if scenario == "start":
+            payload = {"message": self._message(user_id, "/start")}
+        elif scenario == "start_new_ref":
+            self.next_new_id += 1
+            text = f"/start {REFERRAL.get('param', 'ref')}_{user_id}"
+            payload = {"message": self._message(self.next_new_id, text)}
+        elif scenario == "plan":
+            payload = {"callback_query": self._callback(user_id, f"plan_{self.rnd.choice(self.plan_keys)}")}
+        elif scenario == "admin_page":
+            page = self.rnd.randint(0, max(0, len(self.existing) // 5 - 1))
+            payload = {"callback_query": self._callback(_BENCH_ADMIN_ID, f"manage_users_page:{page}")}
+        else:
+            payload = {"callback_query": self._callback(user_id, scenario)}
+        payload["update_id"] = self.update_id
+        return scenario, payload
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def _max_rss_mib() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт KiB, macOS — байты
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+async def run(
+    updates: int = 10_000,
+    concurrency: int = 100,
+    users: int = 50_000,
+    marzban_latency: float = 0.0,
+    bot_latency: float = 0.0,
+    trace_memory: bool = False,
+) -> Dict[str, Any]:
+    from main import build_dispatcher
+
+    store = FakeMarzbanStore(latency=marzban_latency)
+    store.seed(users)
+    install_fake_marzban(store)
+
+    session = FakeTelegramSession(latency=bot_latency)
+    bot = Bot("123456:BENCHMARK", session=session)
+    dp = build_dispatcher()
+    recorder = HandlerLatencyRecorder()
+    dp.message.middleware(recorder)
+    dp.callback_query.middleware(recorder)
+
+    factory = UpdateFactory(store)
+    queue: asyncio.Queue = asyncio.Queue()
+    for _ in range(updates):
+        queue.put_nowait(factory.next())
+
+    update_samples: Dict[str, List[float]] = defaultdict(list)
+    failures: Counter[str] = Counter()
+
+    async def worker() -> None:
+        while True:
+            try:
+                scenario, raw = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            update = Update.model_validate(raw, context={"bot": bot})
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                failures[f"{scenario}: {type(e).__name__}"] += 1
+            update_samples[scenario].append(time.perf_counter() - started)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    all_updates = [s for samples in update_samples.values() for s in samples]
+    return {
+        "updates": updates,
+        "concurrency": concurrency,
+        "users": users,
+        "elapsed_s": elapsed,
+        "updates_per_s": updates / elapsed if elapsed else 0.0,
+        "update_latency": _percentiles(all_updates),
+        "scenarios": {name: _percentiles(samples) for name, samples in sorted(update_samples.items())},
+        "handlers": {name: _percentiles(samples) for name, samples in sorted(recorder.samples.items())},
+        "bot_api_calls": dict(session.calls),
+        "marzban_requests": dict(store.requests),
+        "failures": dict(failures),
+        "max_rss_mib": _max_rss_mib(),
+        "tracemalloc_peak_mib": traced_peak / 1024 / 1024 if traced_peak is not None else None,
+    }
+
+
+def _print_table(title: str, rows: Dict[str, Dict[str, float]]) -> None:
+    print(f"\n{title}")
+    print(f"  {'name':<36} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, p in rows.items():
+        if not p:
+            continue
+        print(
+            f"  {name:<36} {p['count']:>7} {p['p50_ms']:>9.2f} {p['p90_ms']:>9.2f} "
+            f"{p['p99_ms']:>9.2f} {p['max_ms']:>9.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Synthetic Telegram update load for the dispatcher")
+    parser.add_argument("--updates", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=100, help="updates processed at the same time")
+    parser.add_argument("--users", type=int, default=50_000, help="synthetic users in the fake Marzban")
+    parser.add_argument("--marzban-latency", type=float, default=0.0, help="seconds per Marzban request")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="seconds per Bot API call")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report tracemalloc peak (slower)")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run(
+            updates=args.updates,
+            concurrency=args.concurrency,
+            users=args.users,
+            marzban_latency=args.marzban_latency,
+            bot_latency=args.bot_latency,
+            trace_memory=args.tracemalloc,
+        )
+    )
+    print(
+        f"{report['updates']} updates, concurrency {report['concurrency']}, {report['users']} users: "
+        f"{report['updates_per_s']:,.0f} updates/s in {report['elapsed_s']:.2f}s"
+    )
+    _print_table("Per update (scenario):", {"all": report["update_latency"], **report["scenarios"]})
+    _print_table("Per handler:", report["handlers"])
+    print(f"\nBot API calls: {report['bot_api_calls']}")
+    print(f"Marzban requests: {report['marzban_requests']}")
+    if report["failures"]:
+        print(f"Failures: {report['failures']}")
+    print(f"Max RSS: {report['max_rss_mib']} MiB")
+    if report["tracemalloc_peak_mib"] is not None:
+        print(f"tracemalloc peak: {report['tracemalloc_peak_mib']:.1f} MiB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
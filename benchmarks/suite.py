@@ -0,0 +1,354 @@
+"""Benchmark suite for the bot's hot paths with machine-readable results.
+
+Run from the repository root:
+
+    python -m benchmarks.suite [--json results.json] [--compare baseline.json]
+                               [--threshold 0.15] [--only payment] [--repeat 5] [--strict]
+
+Every case is timed ``--repeat`` times after one warm-up round; the JSON report
+holds best/median seconds per round and µs per operation. With ``--compare``
+cases slower than the baseline by more than ``--threshold`` (relative, on the
+best µs/op) are listed and the exit code is 1, so the suite can gate a deploy.
+Cases whose imports fail (e.g. dependencies not installed) are reported as
+"skipped" with the reason instead of aborting the whole run. A case that raises
+during setup or timing is reported as "error"; the remaining cases still run and
+the exit code is non-zero. With ``--strict`` (used by the deploy gate) skipped
+cases, and an ``--only`` filter that matches nothing, fail the run as well.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+# Изолируем файлы состояния бенчмарка от рабочих баз до импорта config
+_TMP_DIR = tempfile.mkdtemp(prefix="averra-bench-")
+for _name, _file in (
+    ("STATS_DB_FILE", "stats.db"),
+    ("PROMO_DB_FILE", "promocodes.db"),
+    ("PAYMENT_QUEUE_DB_FILE", "payment_queue.db"),
+    ("SHARED_STATE_DB_FILE", "shared_state.db"),
+):
+    os.environ[_name] = os.path.join(_TMP_DIR, _file)
+os.environ.setdefault("YOOMONEY_NOTIFICATION_SECRET", "bench-secret")
+os.environ["SHARED_STATE_BACKEND"] = "memory"
+
+
+class Case(NamedTuple):
+    name: str
+    ops: int
+    # setup(ops) -> callable, выполняющий ops операций (sync или async)
+    setup: Callable[[int], Callable[[], Any]]
+
+
+CASES: List[Case] = []
+
+
+def case(name: str, ops: int):
+    def decorator(setup: Callable[[int], Callable[[], Any]]):
+        CASES.append(Case(name, ops, setup))
+        return setup
+    return decorator
+
+
+# --- payment service ---
+
+@case("payment.verify_notification", ops=20_000)
+def _payment_verify(ops: int):
+    from benchmarks.fakes import signed_notification
+    from config import YOOMONEY_NOTIFICATION_SECRET
+    from services.payment_service import PaymentService
+
+    service = PaymentService("41001000000", YOOMONEY_NOTIFICATION_SECRET)
+    notifications = [signed_notification(service, 100_000_000 + i, "1_month", 249) for i in range(100)]
+
+    def run() -> None:
+        for i in range(ops):
+            service.verify_notification(notifications[i % 100])
+    return run
+
+
+@case("payment.parse_payment_data", ops=50_000)
+def _payment_parse(ops: int):
+    from services.payment_service import PaymentService
+
+    service = PaymentService("41001000000", "secret")
+    labels = [f"{100_000_000 + i}_3_months_{i:08x}" for i in range(100)]
+
+    def run() -> None:
+        for i in range(ops):
+            service.parse_payment_data(labels[i % 100])
+    return run
+
+
+# --- notes ---
+
+@case("notes.scan_cold_cache", ops=50_000)
+def _notes_scan(ops: int):
+    from datetime import datetime
+
+    from benchmarks.bench_notes import _scan_current, make_notes
+    from utils import helpers
+
+    notes = make_notes(ops)
+    today = datetime.now().strftime("%Y%m%d")
+
+    def run() -> None:
+        helpers._parse_note_cached.cache_clear()
+        _scan_current(notes, today)
+    return run
+
+
+# --- admin user list at 50k users ---
+
+def _admin_entries(count: int) -> List[Dict[str, Any]]:
+    from benchmarks.fakes import FakeMarzbanStore
+    from handlers.admin_users import _prepare_user_entry, _sort_user_list
+
+    store = FakeMarzbanStore()
+    store.seed(count)
+    entries = [e for e in (_prepare_user_entry(dict(u)) for u in store.users.values()) if e]
+    _sort_user_list(entries)
+    return entries
+
+
+@case("admin_users.prepare_and_sort_50k", ops=50_000)
+def _admin_prepare(ops: int):
+    from benchmarks.fakes import FakeMarzbanStore
+    from handlers.admin_users import _prepare_user_entry, _sort_user_list
+
+    store = FakeMarzbanStore()
+    store.seed(ops)
+    raw = list(store.users.values())
+
+    def run() -> None:
+        entries = [e for e in (_prepare_user_entry(u) for u in raw) if e]
+        _sort_user_list(entries)
+    return run
+
+
+@case("admin_users.build_list_page_50k", ops=2_000)
+def _admin_list_page(ops: int):
+    from handlers.admin_users import _build_list_keyboard, _build_list_text
+
+    entries = _admin_entries(50_000)
+    pages = max(1, len(entries) // 5)
+
+    def run() -> None:
+        for i in range(ops):
+            page = (i * 97) % pages
+            _build_list_text(entries, page)
+            _build_list_keyboard(entries, page)
+    return run
+
+
+# --- broadcast ---
+
+@case("news.extract_chat_ids_50k", ops=50_000)
+def _news_chat_ids(ops: int):
+    from benchmarks.fakes import FakeMarzbanStore
+    from handlers.news import _extract_chat_ids
+
+    store = FakeMarzbanStore()
+    store.seed(ops)
+    users = list(store.users.values())
+
+    def run() -> None:
+        _extract_chat_ids(users)
+    return run
+
+
+# --- keyboards ---
+
+@case("keyboards.builders", ops=5_000)
+def _keyboards(ops: int):
+    from keyboards.inline import get_main_menu, get_payment_menu, get_plans_menu, get_subscription_menu
+
+    def run() -> None:
+        for i in range(ops):
+            get_main_menu(has_active=bool(i & 1), is_admin=False)
+            get_subscription_menu(has_subscription=bool(i & 1))
+            get_plans_menu()
+            get_payment_menu("https://yoomoney.ru/quickpay/confirm.xml?label=1")
+    return run
+
+
+# --- end-to-end payment ---
+
+@case("payment.process_notification_e2e", ops=500)
+def _payment_e2e(ops: int):
+    from benchmarks.fakes import FakeBot, FakeMarzbanAPI, FakeMarzbanStore, signed_notification
+    from config import SUBSCRIPTION_PLANS
+    from handlers import payment
+
+    store = FakeMarzbanStore()
+    store.seed(10_000)
+    payment.marzban_service.api = FakeMarzbanAPI(store)
+    bot = FakeBot()
+    plan_key = next(iter(SUBSCRIPTION_PLANS))
+    price = SUBSCRIPTION_PLANS[plan_key]["price"]
+    counter = iter(range(10**9))
+    # operation_id уникален между прогонами: уже применённые оплаты журнал пропускает
+    run_id = int(time.time() * 1000)
+
+    async def run() -> None:
+        for i in range(ops):
+            n = next(counter)
+            # Каждое четвёртое уведомление — новый пользователь (create), остальные — продление
+            telegram_id = 200_000_000 + n if n % 4 == 0 else 100_000_000 + (n % 10_000)
+            data = signed_notification(payment.payment_service, telegram_id, plan_key, price, operation_id=f"{run_id}-{n}")
+            if await payment.process_payment_notification(data, bot=bot) != "processed":
+                raise RuntimeError("payment was not processed")
+    return run
+
+
+# --- full user scan over HTTP against the fake panel ---
+
+@case("marzban.list_all_users_http_100k", ops=100_000)
+def _marzban_scan_http(ops: int):
+    import socket
+
+    from benchmarks.fake_marzban import FakeMarzbanServer
+    from benchmarks.fakes import FakeMarzbanStore
+    from services.marzban_service import MarzbanService
+
+    store = FakeMarzbanStore()
+    store.seed(ops)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = FakeMarzbanServer(store, port=port)
+    url = server.__enter__()  # поток-демон живёт до конца прогона
+    service = MarzbanService(url, "admin", "admin")
+
+    async def run() -> None:
+        users = await service.list_all_users()
+        if len(users) != ops:
+            raise RuntimeError(f"expected {ops} users, got {len(users)}")
+    return run
+
+
+# --- runner ---
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def _time_once(fn: Callable[[], Any], loop: asyncio.AbstractEventLoop) -> float:
+    started = time.perf_counter()
+    result = fn()
+    if asyncio.iscoroutine(result):
+        loop.run_until_complete(result)
+    return time.perf_counter() - started
+
+
+def run_case(item: Case, repeat: int, loop: asyncio.AbstractEventLoop) -> Dict[str, Any]:
+    try:
+        fn = item.setup(item.ops)
+    except ImportError as e:
+        return {"status": "skipped", "reason": f"{type(e).__name__}: {e}"}
+    except Exception as e:
+        return {"status": "error", "reason": f"{type(e).__name__}: {e}"}
+    try:
+        _time_once(fn, loop)  # прогрев
+        timings = [_time_once(fn, loop) for _ in range(repeat)]
+    except Exception as e:
+        return {"status": "error", "reason": f"{type(e).__name__}: {e}"}
+    best = min(timings)
+    return {
+        "status": "ok",
+        "ops": item.ops,
+        "repeat": repeat,
+        "best_s": best,
+        "median_s": statistics.median(timings),
+        "us_per_op": best / item.ops * 1e6,
+        "ops_per_s": item.ops / best if best else 0.0,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    regressions = []
+    base_results = baseline.get("results", {})
+    for name, current in results.items():
+        base = base_results.get(name)
+        if current.get("status") != "ok" or not base or base.get("status") != "ok":
+            continue
+        ratio = current["us_per_op"] / base["us_per_op"] if base["us_per_op"] else 1.0
+        current["baseline_us_per_op"] = base["us_per_op"]
+        current["change"] = ratio - 1
+        if ratio > 1 + threshold:
+            regressions.append(
+                f"{name}: {base['us_per_op']:.2f} -> {current['us_per_op']:.2f} µs/op ({(ratio - 1) * 100:+.1f}%)"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline JSON produced by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", action="append", default=[], help="run cases whose name contains this")
+    parser.add_argument("--strict", action="store_true", help="treat skipped cases and empty selections as failures")
+    args = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results: Dict[str, Any] = {}
+    for item in CASES:
+        if args.only and not any(part in item.name for part in args.only):
+            continue
+        result = run_case(item, args.repeat, loop)
+        results[item.name] = result
+        if result["status"] == "ok":
+            print(f"{item.name:<40} {result['us_per_op']:>12.2f} µs/op {result['ops_per_s']:>14,.0f} ops/s")
+        else:
+            print(f"{item.name:<40} {result['status']} ({result['reason']})")
+    loop.close()
+
+    report = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "git_revision": _git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    regressions: List[str] = []
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    failing = ("error", "skipped") if args.strict else ("error",)
+    errors = [name for name, result in results.items() if result["status"] in failing]
+    if args.strict and not results:
+        print("No cases matched --only " + ", ".join(args.only))
+        return 1
+    if regressions:
+        print("\nRegressions:")
+        for line in regressions:
+            print(f"  {line}")
+    if errors:
+        print("\nFailed cases: " + ", ".join(errors))
+    return 1 if regressions or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
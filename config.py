@@ -7,6 +7,14 @@ from dotenv import load_dotenv
 # Load environment variables from .env if present
 load_dotenv()
 
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
 # Telegram Bot
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 BOT_USERNAME = os.getenv('BOT_USERNAME')
@@ -75,9 +83,72 @@ if _single_admin:
             ADMIN_IDS_STR.append(_single_admin)
     except Exception:
         pass
+# Для проверок «это админ?» на горячем пути — O(1) вместо поиска по списку
+ADMIN_ID_SET: frozenset[int] = frozenset(ADMIN_IDS)
+
+# Юзернеймы: пассивный сбор из апдейтов и ручная синхронизация
+# Как часто сбрасывать накопленные изменения username в заметки Marzban (сек)
+USERNAME_FLUSH_INTERVAL = _int_env('USERNAME_FLUSH_INTERVAL', 60)
+# Сколько секунд username должен не меняться, прежде чем его запишем
+USERNAME_FLUSH_DEBOUNCE = _int_env('USERNAME_FLUSH_DEBOUNCE', 30)
+# Пользователи, от которых были апдейты за это время, не требуют get_chat при синхронизации
+USERNAME_SEEN_TTL = _int_env('USERNAME_SEEN_TTL', 7 * 24 * 60 * 60)
+# Максимум одновременных запросов к Telegram/Marzban при синхронизации
+USERNAME_SYNC_CONCURRENCY = _int_env('USERNAME_SYNC_CONCURRENCY', 5)
 
 # Режим обслуживания — файл-флаг (можно переопределить через env)
 MAINTENANCE_FLAG_FILE = os.getenv('MAINTENANCE_FLAG_FILE', 'maintenance.lock')
+# Как часто (сек) перепроверять файл-флаг на случай изменения вне бота
+MAINTENANCE_POLL_INTERVAL = _int_env('MAINTENANCE_POLL_INTERVAL', 2)
+
+# Ограничение частоты запросов пользователя (token bucket на пару пользователь+действие).
+# Действия, которые ходят в панель (/start, подписка, меню, тарифы): N в минуту и запас на всплеск
+THROTTLE_PANEL_PER_MINUTE = _int_env('THROTTLE_PANEL_PER_MINUTE', 12)
+THROTTLE_PANEL_BURST = _int_env('THROTTLE_PANEL_BURST', 4)
+# Остальные апдейты; 0 — без ограничения
+THROTTLE_DEFAULT_PER_MINUTE = _int_env('THROTTLE_DEFAULT_PER_MINUTE', 60)
+THROTTLE_DEFAULT_BURST = _int_env('THROTTLE_DEFAULT_BURST', 15)
+
+# Медленные экраны (подписка, тарифы, рефералы): колбэк подтверждается сразу,
+# а если экран строится дольше этого времени (мс) — показывается заглушка
+CALLBACK_PLACEHOLDER_DELAY = _int_env('CALLBACK_PLACEHOLDER_DELAY_MS', 400) / 1000
+
+# Экран подписки: последний известный профиль показывается сразу (stale-while-revalidate).
+# Моложе SUBSCRIPTION_FRESH_SECONDS — без обновления; иначе обновляется в фоне.
+USER_CACHE_SIZE = _int_env('USER_CACHE_SIZE', 20000)
+SUBSCRIPTION_FRESH_SECONDS = _int_env('SUBSCRIPTION_FRESH_SECONDS', 30)
+# Сколько (сек) ждать панель при обновлении экрана подписки
+SUBSCRIPTION_FETCH_TIMEOUT = _int_env('SUBSCRIPTION_FETCH_TIMEOUT', 5)
+
+# Устойчивость запросов к панели Marzban (общая для всех хендлеров).
+# Таймауты попытки (мс): чтение одного объекта, выгрузка списков, изменения
+MARZBAN_READ_TIMEOUT = _int_env('MARZBAN_READ_TIMEOUT_MS', 4000) / 1000
+MARZBAN_LIST_TIMEOUT = _int_env('MARZBAN_LIST_TIMEOUT_MS', 30000) / 1000
+MARZBAN_WRITE_TIMEOUT = _int_env('MARZBAN_WRITE_TIMEOUT_MS', 15000) / 1000
+# Повторы только для чтения и получения токена; задержка растёт от BACKOFF (мс) с джиттером
+MARZBAN_READ_RETRIES = _int_env('MARZBAN_READ_RETRIES', 2)
+MARZBAN_RETRY_BACKOFF = _int_env('MARZBAN_RETRY_BACKOFF_MS', 200) / 1000
+# Circuit breaker: после N сбоев подряд запросы сразу отклоняются на COOLDOWN секунд
+MARZBAN_BREAKER_THRESHOLD = _int_env('MARZBAN_BREAKER_THRESHOLD', 5)
+MARZBAN_BREAKER_COOLDOWN = _int_env('MARZBAN_BREAKER_COOLDOWN', 30)
+# Hedged-чтение профиля: копия запроса, если ответа нет дольше N мс (0 — выключено)
+MARZBAN_HEDGE_DELAY = _int_env('MARZBAN_HEDGE_DELAY_MS', 0) / 1000
+
+# Общий бюджет параллельных запросов к панели и пределы по классам трафика.
+# Свободный слот получают по приоритету: оплаты > запросы пользователей > фоновые задачи
+MARZBAN_CONCURRENCY = _int_env('MARZBAN_CONCURRENCY', 16)
+MARZBAN_PAYMENT_CONCURRENCY = _int_env('MARZBAN_PAYMENT_CONCURRENCY', 8)
+MARZBAN_INTERACTIVE_CONCURRENCY = _int_env('MARZBAN_INTERACTIVE_CONCURRENCY', 12)
+MARZBAN_BATCH_CONCURRENCY = _int_env('MARZBAN_BATCH_CONCURRENCY', 2)
+
+# Бэкап Marzban: максимальный размер одного отправляемого тома (лимит Bot API — 50 МБ)
+BACKUP_VOLUME_SIZE = _int_env('BACKUP_VOLUME_SIZE_MB', 45) * 1024 * 1024
+# Плановые бэкапы: интервал в часах (0 — выключены) и сколько снимков хранить
+BACKUP_SCHEDULE_HOURS = _int_env('BACKUP_SCHEDULE_HOURS', 0)
+BACKUP_RETENTION = _int_env('BACKUP_RETENTION', 7)
+# Хранилище снимков с дедупликацией по блокам
+BACKUP_STORE_DIR = os.getenv('BACKUP_STORE_DIR', 'backups')
+BACKUP_CHUNK_SIZE = _int_env('BACKUP_CHUNK_SIZE_KB', 1024) * 1024
 
 # Webhook server (FastAPI)
 # Provide safe defaults to avoid crashes when env vars are missing in dev
@@ -87,6 +158,46 @@ try:
 except ValueError:
     WEBHOOK_PORT = 8080
 
+# Приём обновлений Telegram: polling (по умолчанию) или webhook через тот же FastAPI-сервер.
+# В режиме webhook Telegram шлёт обновления на {TELEGRAM_WEBHOOK_URL}/telegram/{TELEGRAM_WEBHOOK_SECRET}
+TELEGRAM_UPDATES_MODE = os.getenv('TELEGRAM_UPDATES_MODE', 'polling').strip().lower()
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '').rstrip('/')
+# Допустимы только A-Z, a-z, 0-9, _ и - (ограничение Bot API для secret_token)
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+
+# Токен для /metrics (Authorization: Bearer ...); пусто — без авторизации
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Профилирование из админки и через GET /debug/profile/{cpu|memory}?seconds=N
+# (Authorization: Bearer PROFILING_TOKEN; пустой токен — маршрут выключен)
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+PROFILING_DEFAULT_SECONDS = _int_env('PROFILING_DEFAULT_SECONDS', 30)
+PROFILING_MAX_SECONDS = _int_env('PROFILING_MAX_SECONDS', 300)
+# Интервал сэмплирования стека (сек)
+PROFILING_SAMPLE_INTERVAL = 0.005
+
+# Приём оплат YooMoney:
+# inline — в общем event loop с ботом (как раньше);
+# thread — отдельный поток со своим event loop на PAYMENT_WEBHOOK_PORT;
+# external — отдельный процесс (uvicorn webhook:payment_app), бот только разбирает очередь
+PAYMENT_SERVER_MODE = os.getenv('PAYMENT_SERVER_MODE', 'inline').strip().lower()
+PAYMENT_WEBHOOK_PORT = _int_env('PAYMENT_WEBHOOK_PORT', WEBHOOK_PORT)
+PAYMENT_QUEUE_DB_FILE = os.getenv('PAYMENT_QUEUE_DB_FILE', 'payment_queue.db')
+# Как часто (сек) проверять очередь, если уведомление пришло из другого процесса
+PAYMENT_QUEUE_POLL_INTERVAL = _int_env('PAYMENT_QUEUE_POLL_INTERVAL', 1)
+# Неудачная активация из очереди повторяется с удвоением паузы (от BACKOFF сек, не больше часа);
+# после MAX_ATTEMPTS попыток запись помечается failed и админам уходит уведомление
+PAYMENT_RETRY_MAX_ATTEMPTS = max(1, _int_env('PAYMENT_RETRY_MAX_ATTEMPTS', 8))
+PAYMENT_RETRY_BACKOFF = _int_env('PAYMENT_RETRY_BACKOFF', 30)
+
+# Несколько рабочих процессов (только в режиме webhook и с общим бэкендом состояния)
+BOT_WORKERS = max(1, _int_env('BOT_WORKERS', 1))
+# Общее состояние процессов: memory (один процесс) или sqlite
+SHARED_STATE_BACKEND = os.getenv('SHARED_STATE_BACKEND', 'memory').strip().lower()
+SHARED_STATE_DB_FILE = os.getenv('SHARED_STATE_DB_FILE', 'shared_state.db')
+# Аренда лидера (сек): только лидер запускает напоминания и плановые бэкапы
+LEADER_LEASE_TTL = _int_env('LEADER_LEASE_TTL', 30)
+
 # Подписки и цены
 SUBSCRIPTION_PLANS: Dict[str, Dict] = {
     "1_month": {
@@ -196,6 +307,7 @@ BUTTONS = {
     "extend_subscription": "🔄 Продлить подписку",
     "instruction": "📖 Инструкция",
     "back": "🔙 Назад",
+    "retry": "🔄 Обновить",
     "pay": "💳 Оплатить",
     "back_to_plans": "🔙 Назад к тарифам",
     "support": "💬 Поддержка",
@@ -215,10 +327,17 @@ BUTTONS = {
     "admin_user_back": "◀️ К списку",
     "create_promo": "🎟️ Создать промокод",
     "enter_promo": "🎟️ Ввести промокод",
+    "promo_bulk": "📦 Пакет промокодов",
+    "promo_campaigns": "📊 Промо-кампании",
     "broadcast": "📣 Рассылка",
     "broadcast_all": "📡 Всем пользователям",
     "broadcast_one": "🎯 Одному пользователю",
     "user_agreement": "📄 Пользовательское соглашение",
+    "stats": "📈 Статистика",
+    "stats_refresh": "🔄 Обновить",
+    "profiling": "🩺 Профилирование",
+    "profile_cpu": "⏱️ CPU-профиль",
+    "profile_memory": "🧠 Рост памяти",
 }
 
 # Рефералы
@@ -273,6 +392,23 @@ MESSAGES.update({
     "backup_started": "⏳ Запускаю бэкап...",
     "backup_success": "✅ Бэкап успешно выполнен",
     "backup_failed": "❌ Ошибка при выполнении бэкапа",
+    "backup_checksum": "SHA-256: <code>{sha256}</code>",
+    "backup_volume_caption": "🗄️ Бэкап, том {index}/{total}\nSHA-256: <code>{sha256}</code>",
+    "backup_volumes_done": (
+        "✅ Бэкап успешно выполнен: {total} томов.\n"
+        "Соберите архив командой <code>cat {archive_name}.part* > {archive_name}</code> "
+        "и проверьте суммы: <code>sha256sum -c {archive_name}.sha256</code>"
+    ),
+    "backup_scheduled_report": (
+        "🗄️ <b>Плановый бэкап</b> {snapshot}\n"
+        "━━━━━━━━━━━━\n\n"
+        "Файлов: <b>{files}</b>, объём данных: <b>{logical}</b>\n"
+        "Новых данных: <b>{new}</b> ({new_chunks} блоков, на диске {stored})\n"
+        "Без изменений: <b>{reused}</b>\n"
+        "Хранилище: <b>{store}</b>, удалено старых снимков: {removed}\n"
+        "Длительность: <b>{duration} с</b>"
+    ),
+    "backup_scheduled_failed": "❌ Плановый бэкап не выполнен:\n<code>{error}</code>",
     "broadcast_menu": (
         "📣 <b>Рассылка сообщений</b>\n"
         "━━━━━━━━━━━━\n\n"
@@ -309,6 +445,7 @@ MESSAGES.update({
         "✅ Синхронизация завершена\n"
         "Всего подходящих пользователей: <b>{total}</b>\n"
         "Обновлено: <b>{updated}</b>\n"
+        "Из недавних апдейтов (без get_chat): <b>{cached}</b>\n"
         "Без изменений: <b>{unchanged}</b>\n"
         "Нет username: <b>{missing}</b>\n"
         "Ошибок: <b>{errors}</b>"
@@ -317,8 +454,30 @@ MESSAGES.update({
     "sync_usernames_no_users": "⚠️ Пользователи не найдены.",
 })
 
+# Статистика для админов (SQLite)
+STATS_DB_FILE = os.getenv('STATS_DB_FILE', 'stats.db')
+MESSAGES.update({
+    "admin_stats_error": "❌ Не удалось получить статистику. Попробуйте позже.",
+})
+
+MESSAGES.update({
+    "profiling_menu": (
+        "🩺 <b>Профилирование</b>\n"
+        "━━━━━━━━━━━━\n\n"
+        "⏱️ CPU-профиль — сэмплирование стека event loop в течение {seconds} с, "
+        "файл в формате collapsed stacks (flamegraph.pl / speedscope).\n"
+        "🧠 Рост памяти — разница снимков tracemalloc за {seconds} с, top по росту."
+    ),
+    "profiling_started": "⏳ Профилирование запущено на {seconds} с...",
+    "profiling_busy": "⚠️ Профилирование уже выполняется.",
+    "profiling_failed": "❌ Не удалось выполнить профилирование.",
+    "profiling_done": "✅ Готово: {filename}",
+})
+
 # Промокоды
+# Старый JSON-файл промокодов импортируется в PROMO_DB_FILE при первом обращении
 PROMO_CODES_FILE = os.getenv('PROMO_CODES_FILE', 'promocodes.json')
+PROMO_DB_FILE = os.getenv('PROMO_DB_FILE', 'promocodes.db')
 MESSAGES.update({
     "promo_create_prompt": (
         "🎟️ <b>Создание промокода</b>\n"
@@ -334,6 +493,36 @@ MESSAGES.update({
     "promo_prompt": "🎟️ Введите промокод одним сообщением",
     "promo_invalid": "❌ Неверный промокод",
     "promo_used": "⚠️ Этот промокод уже использован",
+    "promo_expired": "⌛ Срок действия промокода истёк",
+    "promo_bulk_plan_prompt": (
+        "📦 <b>Пакет промокодов</b>\n"
+        "━━━━━━━━━━━━\n\n"
+        "Выберите тариф:"
+    ),
+    "promo_bulk_params_prompt": (
+        "📦 Тариф: <b>{plan_name}</b>\n\n"
+        "Отправьте одним сообщением: <code>количество [дней_действия] [кампания]</code>\n"
+        "Например: <code>1000 30 partner_oct</code> или <code>500 partner_oct</code>.\n"
+        "0 дней — без срока действия. Для отмены отправьте <b>Отмена</b>."
+    ),
+    "promo_bulk_invalid": (
+        "❌ Неверный формат. Количество — от 1 до {max_count}, кампания — латиница, цифры, _ и - "
+        "(до 32 символов). Попробуйте снова или отправьте <b>Отмена</b>."
+    ),
+    "promo_bulk_cancelled": "❎ Создание пакета промокодов отменено.",
+    "promo_bulk_failed": "❌ Не удалось создать промокоды. Попробуйте позже.",
+    "promo_bulk_done": (
+        "✅ <b>Создано промокодов: {count}</b>\n"
+        "Тариф: <b>{plan_name}</b>\n"
+        "Кампания: <b>{campaign}</b>\n"
+        "Действуют до: <b>{expires_str}</b>"
+    ),
+    "promo_campaigns_title": (
+        "📊 <b>Промо-кампании</b>\n"
+        "━━━━━━━━━━━━\n"
+    ),
+    "promo_campaigns_row": "• <b>{campaign}</b>: {redeemed} из {issued} ({rate:.1f}%)",
+    "promo_campaigns_empty": "⚠️ Кампаний пока нет.",
     "promo_applied": (
         "🎉 <b>Промокод применён!</b>\n"
         "━━━━━━━━━━━━\n\n"
@@ -369,3 +558,38 @@ MESSAGES.update({
 })
 
 
+MESSAGES.update({
+    "throttled": "⏳ Слишком часто. Подождите пару секунд.",
+    "loading": "⏳ Загружаем…",
+    "loading_failed": "❌ Не удалось загрузить данные. Попробуйте ещё раз.",
+    "subscription_stale": "\n\n🕓 <i>Данные на {time}, обновляем…</i>",
+    "subscription_offline": "\n\n⚠️ <i>Сервер временно недоступен. Показаны данные на {time}.</i>",
+    "subscription_unavailable": (
+        "⚠️ <b>Не удалось получить данные подписки</b>\n"
+        "━━━━━━━━━━━━\n\n"
+        "Сервер временно недоступен. Попробуйте чуть позже."
+    ),
+    "panel_health_closed": "\n\n🟢 Панель Marzban: доступна",
+    "panel_health_half_open": "\n\n🟡 Панель Marzban: проверяем восстановление",
+    "panel_health_open": (
+        "\n\n🔴 Панель Marzban: недоступна (сбоев подряд: {failures}), "
+        "повторная проверка через {retry_in} с\n<code>{error}</code>"
+    ),
+    "payment_failed_admin": (
+        "🚨 <b>Оплата не активирована</b>\n"
+        "━━━━━━━━━━━━\n\n"
+        "Пользователь: <code>{telegram_id}</code>\n"
+        "Тариф: {plan_key}, сумма: {amount} ₽\n"
+        "Операция: <code>{operation_id}</code>\n"
+        "Попыток: {attempts}\n\n"
+        "Подписку нужно продлить вручную."
+    ),
+    "admin_user_stale": "⚠️ <i>Панель недоступна. Показаны данные на {time}.</i>",
+    "admin_user_refresh_stale": "⚠️ Панель недоступна, показаны сохранённые данные",
+    "admin_user_unavailable": (
+        "⚠️ Панель недоступна: данные пользователя <code>{user_id}</code> не получены. "
+        "Попробуйте позже."
+    ),
+})
+
+
@@ -0,0 +1,71 @@
+import html
+import logging
+
+from aiogram import F, Router
+from aiogram.types import BufferedInputFile, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import ADMIN_ID_SET, BUTTONS, MESSAGES, PROFILING_DEFAULT_SECONDS
+from utils.profiling import ProfilerBusy, memory_diff, sample_cpu_profile
+
+
+router = Router()
+logger = logging.getLogger(__name__)
+
+# Подпись к документу ограничена 1024 символами, сводку отправляем отдельным сообщением
+_SUMMARY_LIMIT = 3500
+
+
+def _is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_ID_SET
+
+
+def _profiling_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=BUTTONS["profile_cpu"], callback_data="admin_profile_cpu")],
+            [InlineKeyboardButton(text=BUTTONS["profile_memory"], callback_data="admin_profile_memory")],
+            [InlineKeyboardButton(text=BUTTONS["back"], callback_data="admin_panel")],
+        ]
+    )
+
+
+@router.callback_query(F.data == "admin_profiling")
+async def admin_profiling(callback: CallbackQuery):
+    if not _is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    await callback.message.edit_text(
+        text=MESSAGES["profiling_menu"].format(seconds=PROFILING_DEFAULT_SECONDS),
+        reply_markup=_profiling_keyboard(),
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.in_({"admin_profile_cpu", "admin_profile_memory"}))
+async def admin_profile_run(callback: CallbackQuery):
+    if not _is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    run = sample_cpu_profile if callback.data == "admin_profile_cpu" else memory_diff
+    await callback.answer(MESSAGES["profiling_started"].format(seconds=PROFILING_DEFAULT_SECONDS))
+    status = await callback.message.answer(
+        MESSAGES["profiling_started"].format(seconds=PROFILING_DEFAULT_SECONDS)
+    )
+    try:
+        result = await run(PROFILING_DEFAULT_SECONDS)
+    except ProfilerBusy:
+        await status.edit_text(MESSAGES["profiling_busy"])
+        return
+    except Exception as e:
+        logger.error("Profiling failed: %s", e)
+        await status.edit_text(MESSAGES["profiling_failed"])
+        return
+
+    await callback.message.answer_document(
+        BufferedInputFile(result.content, filename=result.filename),
+        caption=MESSAGES["profiling_done"].format(filename=result.filename),
+    )
+    summary = result.summary
+    if len(summary) > _SUMMARY_LIMIT:
+        summary = summary[:_SUMMARY_LIMIT] + "\n…"
+    await status.edit_text(f"<pre>{html.escape(summary)}</pre>")
@@ -0,0 +1,96 @@
+from datetime import datetime
+from typing import Any
+
+from aiogram import F, Router
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import ADMIN_ID_SET, BUTTONS, MESSAGES, SUBSCRIPTION_PLANS
+from utils.helpers import format_ts_to_str
+from utils.stats import get_stats_snapshot
+
+
+router = Router()
+
+
+def _is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_ID_SET
+
+
+def _money(value: Any) -> str:
+    try:
+        return f"{float(value):,.0f}".replace(",", " ")
+    except (TypeError, ValueError):
+        return "0"
+
+
+def _build_stats_text(snapshot: dict[str, Any]) -> str:
+    lines = [
+        "📈 <b>Статистика</b>",
+        "━━━━━━━━━━━━",
+        "",
+        f"👥 Всего пользователей: <b>{snapshot['total']}</b>",
+        f"🟢 Активных: <b>{snapshot['active']}</b> (пробных: <b>{snapshot['active_trials']}</b>)",
+        f"🔴 Истёкших: <b>{snapshot['expired']}</b>",
+        f"⏳ Истекают за 7 дней: <b>{snapshot['expiring_7d']}</b>",
+        "",
+        "💰 <b>Выручка по тарифам</b>",
+    ]
+    plans = snapshot.get("plans") or []
+    if plans:
+        for item in plans:
+            plan = SUBSCRIPTION_PLANS.get(item["plan_key"]) or {}
+            name = plan.get("name") or item["plan_key"]
+            lines.append(f"• {name}: {item['payments']} опл. — <b>{_money(item['revenue'])} ₽</b>")
+    else:
+        lines.append("—")
+
+    lines.append("")
+    lines.append("📅 <b>По дням</b> (оплаты / ₽ / новые / пробные)")
+    for row in snapshot.get("days") or []:
+        day = datetime.strptime(row["bucket"], "%Y-%m-%d").strftime("%d.%m")
+        lines.append(
+            f"{day}: {row['payments']} / {_money(row['revenue'])} / {row['new_users']} / {row['trials']}"
+        )
+
+    lines.append("")
+    lines.append("🗓️ <b>По неделям</b> (оплаты / ₽ / продления / истекло)")
+    for row in snapshot.get("weeks") or []:
+        lines.append(
+            f"{row['bucket']}: {row['payments']} / {_money(row['revenue'])} / {row['extensions']} / {row['expirations']}"
+        )
+
+    reconciled_at = snapshot.get("reconciled_at")
+    lines.append("")
+    lines.append(
+        f"🕒 Сверка с панелью: {format_ts_to_str(reconciled_at) if reconciled_at else '—'}"
+    )
+    return "\n".join(lines)
+
+
+def _stats_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=BUTTONS["stats_refresh"], callback_data="admin_stats")],
+            [InlineKeyboardButton(text=BUTTONS["back"], callback_data="admin_panel")],
+        ]
+    )
+
+
+@router.callback_query(F.data == "admin_stats")
+async def admin_stats(callback: CallbackQuery):
+    if not _is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    snapshot = await get_stats_snapshot()
+    if snapshot is None:
+        await callback.answer(MESSAGES["admin_stats_error"], show_alert=True)
+        return
+    try:
+        await callback.message.edit_text(
+            text=_build_stats_text(snapshot), reply_markup=_stats_keyboard()
+        )
+    except TelegramBadRequest as err:
+        if "message is not modified" not in (err.message or "").lower():
+            raise
+    await callback.answer()
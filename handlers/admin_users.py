@@ -9,15 +9,16 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 from config import (
-    ADMIN_IDS,
+    ADMIN_ID_SET,
     BUTTONS,
     MARZBAN_BASE_URL,
     MARZBAN_PASSWORD,
     MARZBAN_USERNAME,
     MESSAGES,
 )
-from services.marzban_service import MarzbanService
+from services.marzban_service import MarzbanService, get_cached_user_info
 from utils.helpers import bytes_to_gigabytes, extract_username, format_ts_to_str
+from utils.shared_state import SharedCache
 
 
 router = Router()
@@ -25,6 +26,10 @@ marzban_service = MarzbanService(MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PAS
 
 PAGE_SIZE = 5
 
+# Список пользователей экрана управления (десятки тысяч записей) хранится по ключу
+# админа отдельно от FSM-данных: иначе каждое update_data перезаписывало бы его целиком
+_user_lists = SharedCache("admin_user_list", ttl=6 * 60 * 60, max_size=64)
+
 
 class UserManageStates(StatesGroup):
     browsing = State()
@@ -33,7 +38,7 @@ class UserManageStates(StatesGroup):
 
 
 def _is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    return user_id in ADMIN_ID_SET
 
 
 def _is_cancel(text: str | None) -> bool:
@@ -61,60 +66,89 @@ def _short_expire(ts: Any) -> str:
         return "—"
 
 
-async def _refresh_user_list(state: FSMContext) -> list[dict[str, Any]]:
-    raw_users = await marzban_service.list_all_users()
-    prepared: list[dict[str, Any]] = []
-    for user in raw_users or []:
-        username = user.get("username")
-        if not isinstance(username, str) or not username.startswith("tg_"):
-            continue
-        tg_str = username.removeprefix("tg_")
-        if not tg_str.isdigit():
-            continue
-        telegram_id = int(tg_str)
-        note = user.get("note")
-        expire_raw = user.get("expire")
-        try:
-            expire_ts = int(expire_raw) if expire_raw else None
-        except (TypeError, ValueError):
-            expire_ts = None
+def _prepare_user_entry(user: dict[str, Any]) -> dict[str, Any] | None:
+    username = user.get("username")
+    if not isinstance(username, str) or not username.startswith("tg_"):
+        return None
+    tg_str = username.removeprefix("tg_")
+    if not tg_str.isdigit():
+        return None
+    telegram_id = int(tg_str)
+    note = user.get("note")
+    expire_raw = user.get("expire")
+    try:
+        expire_ts = int(expire_raw) if expire_raw else None
+    except (TypeError, ValueError):
+        expire_ts = None
 
-        used_raw = user.get("used_traffic")
-        try:
-            used_val = float(used_raw)
-        except (TypeError, ValueError):
-            used_val = 0.0
+    used_raw = user.get("used_traffic")
+    try:
+        used_val = float(used_raw)
+    except (TypeError, ValueError):
+        used_val = 0.0
 
-        data_limit_raw = user.get("data_limit")
-        try:
-            data_limit_val = float(data_limit_raw) if data_limit_raw else None
-        except (TypeError, ValueError):
-            data_limit_val = None
-
-        prepared.append(
-            {
-                "telegram_id": telegram_id,
-                "marzban_username": username,
-                "status": user.get("status"),
-                "expire": expire_ts,
-                "used_traffic": used_val,
-                "data_limit": data_limit_val,
-                "subscription_url": user.get("subscription_url"),
-                "note": note,
-                "note_username": extract_username(note),
-            }
-        )
-    prepared.sort(
+    data_limit_raw = user.get("data_limit")
+    try:
+        data_limit_val = float(data_limit_raw) if data_limit_raw else None
+    except (TypeError, ValueError):
+        data_limit_val = None
+
+    return {
+        "telegram_id": telegram_id,
+        "marzban_username": username,
+        "status": user.get("status"),
+        "expire": expire_ts,
+        "used_traffic": used_val,
+        "data_limit": data_limit_val,
+        "subscription_url": user.get("subscription_url_plain") or user.get("subscription_url"),
+        "note": note,
+        "note_username": extract_username(note),
+    }
+
+
+def _sort_user_list(users: list[dict[str, Any]]) -> None:
+    users.sort(
         key=lambda item: ((item.get("expire") or 0), -item["telegram_id"]),
         reverse=True,
     )
-    await state.update_data(user_list=prepared)
+
+
+async def _refresh_user_list(state: FSMContext) -> list[dict[str, Any]]:
+    raw_users = await marzban_service.list_all_users()
+    prepared: list[dict[str, Any]] = []
+    for user in raw_users or []:
+        entry = _prepare_user_entry(user)
+        if entry is not None:
+            prepared.append(entry)
+    _sort_user_list(prepared)
+    await _user_lists.set(state.key.user_id, prepared)
     return prepared
 
 
+async def _patch_user_list(
+    state: FSMContext, telegram_id: int, info: dict[str, Any] | None, missing: bool = False
+) -> None:
+    """Обновить в сохранённом списке только одну запись, не перечитывая всю панель.
+
+    Запись удаляется, только если пользователя точно нет в панели (missing); без
+    профиля по другой причине (панель недоступна) список не меняется. Если список
+    ещё не загружался, ничего не делаем — он будет получен при открытии.
+    """
+    if not info and not missing:
+        return
+    user_list = await _user_lists.get(state.key.user_id)
+    if not isinstance(user_list, list) or not user_list:
+        return
+    patched = [u for u in user_list if u.get("telegram_id") != telegram_id]
+    entry = _prepare_user_entry(info) if info else None
+    if entry is not None:
+        patched.append(entry)
+    _sort_user_list(patched)
+    await _user_lists.set(state.key.user_id, patched)
+
+
 async def _load_user_list(state: FSMContext) -> list[dict[str, Any]]:
-    data = await state.get_data()
-    user_list = data.get("user_list")
+    user_list = await _user_lists.get(state.key.user_id)
     if isinstance(user_list, list) and user_list:
         return user_list
     return await _refresh_user_list(state)
@@ -232,10 +266,25 @@ async def _render_user_list(
     )
 
 
+async def _fetch_user_detail(telegram_id: int) -> tuple[dict[str, Any] | None, bool]:
+    """Профиль пользователя и признак «в панели его нет» (404).
+
+    Если панель недоступна, возвращает последний известный профиль с пометкой stale
+    (или None), но пользователь при этом отсутствующим не считается.
+    """
+    try:
+        info = await marzban_service.fetch_user_info(telegram_id)
+    except Exception:
+        cached = await get_cached_user_info(telegram_id)
+        if cached is None:
+            return None, False
+        return {**cached[0], "stale": True, "fetched_at": cached[1]}, False
+    return info, info is None
+
+
 async def _build_user_detail(
-    telegram_id: int, state: FSMContext
+    telegram_id: int, state: FSMContext, info: dict[str, Any] | None, missing: bool
 ) -> tuple[str, InlineKeyboardMarkup]:
-    info = await marzban_service.get_user_info(telegram_id)
     if not info:
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -247,6 +296,8 @@ async def _build_user_detail(
                 ]
             ]
         )
+        if not missing:
+            return MESSAGES["admin_user_unavailable"].format(user_id=telegram_id), keyboard
         return (
             f"❌ Пользователь <code>{telegram_id}</code> не найден.",
             keyboard,
@@ -304,6 +355,10 @@ async def _build_user_detail(
     ):
         lines.append("Оригинальная ссылка:")
         lines.append(f"<code>{html.escape(str(subscription_url_plain))}</code>")
+    if info.get("stale"):
+        # Профиль из кэша: панель не ответила, данные могли устареть
+        lines.append("")
+        lines.append(MESSAGES["admin_user_stale"].format(time=format_ts_to_str(int(info["fetched_at"]))))
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -342,26 +397,39 @@ async def _build_user_detail(
 
 
 async def _render_user_detail(
-    message: Message, state: FSMContext, telegram_id: int, refresh_list: bool = False
-):
-    if refresh_list:
-        await _refresh_user_list(state)
-    text, keyboard = await _build_user_detail(telegram_id, state)
+    message: Message,
+    state: FSMContext,
+    telegram_id: int,
+    info: dict[str, Any] | None = None,
+    patch_list: bool = False,
+) -> tuple[dict[str, Any] | None, bool]:
+    missing = False
+    if info is None:
+        info, missing = await _fetch_user_detail(telegram_id)
+    if patch_list:
+        await _patch_user_list(state, telegram_id, info, missing)
+    text, keyboard = await _build_user_detail(telegram_id, state, info, missing)
     await _safe_edit_message(message, text, keyboard)
     await state.update_data(
         detail_user_id=telegram_id,
         detail_message_id=message.message_id,
         detail_chat_id=message.chat.id,
     )
+    return info, missing
 
 
-async def _edit_detail_existing(bot, state: FSMContext, telegram_id: int):
+async def _edit_detail_existing(
+    bot, state: FSMContext, telegram_id: int, info: dict[str, Any] | None = None
+):
     data = await state.get_data()
     message_id = data.get("detail_message_id")
     chat_id = data.get("detail_chat_id")
     if not message_id or not chat_id:
         return
-    text, keyboard = await _build_user_detail(telegram_id, state)
+    missing = False
+    if info is None:
+        info, missing = await _fetch_user_detail(telegram_id)
+    text, keyboard = await _build_user_detail(telegram_id, state, info, missing)
     try:
         await bot.edit_message_text(
             chat_id=chat_id,
@@ -500,7 +568,7 @@ async def manage_users_view(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
     await state.set_state(UserManageStates.browsing)
-    await _render_user_detail(callback.message, state, telegram_id, refresh_list=False)
+    await _render_user_detail(callback.message, state, telegram_id)
     await callback.answer()
 
 
@@ -514,8 +582,11 @@ async def manage_users_refresh_detail(callback: CallbackQuery, state: FSMContext
     except (TypeError, ValueError):
         await callback.answer()
         return
-    await _render_user_detail(callback.message, state, telegram_id, refresh_list=True)
-    await callback.answer("Обновлено")
+    info, missing = await _render_user_detail(callback.message, state, telegram_id, patch_list=True)
+    if (info is None and not missing) or (info and info.get("stale")):
+        await callback.answer(MESSAGES["admin_user_refresh_stale"], show_alert=True)
+    else:
+        await callback.answer("Обновлено")
 
 
 @router.callback_query(F.data.startswith("user_extend:"))
@@ -593,8 +664,9 @@ async def manage_users_extend_days(message: Message, state: FSMContext):
         )
     )
     await state.set_state(UserManageStates.browsing)
-    await _refresh_user_list(state)
-    await _edit_detail_existing(message.bot, state, target_user)
+    # modify_user уже вернул актуальную запись — обновляем только её
+    await _patch_user_list(state, target_user, result)
+    await _edit_detail_existing(message.bot, state, target_user, result)
     await state.update_data(target_user_id=None)
 
 
@@ -610,8 +682,8 @@ async def manage_users_expire(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    success = await marzban_service.expire_user(telegram_id)
-    if not success:
+    updated = await marzban_service.expire_user(telegram_id)
+    if not updated:
         await callback.answer(MESSAGES["admin_users_expire_failed"], show_alert=True)
         return
 
@@ -619,6 +691,7 @@ async def manage_users_expire(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer(
         MESSAGES["admin_users_expire_success"].format(user_id=telegram_id)
     )
-    await _refresh_user_list(state)
-    await _render_user_detail(callback.message, state, telegram_id, refresh_list=False)
+    await _render_user_detail(
+        callback.message, state, telegram_id, info=updated, patch_list=True
+    )
 
@@ -1,4 +1,5 @@
 import logging
+import time
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
@@ -7,6 +8,7 @@ from services.payment_service import PaymentService
 from aiogram import Bot
 from keyboards.inline import get_payment_menu
 from config import (
+    ADMIN_ID_SET,
     MESSAGES,
     SUBSCRIPTION_PLANS,
     YOOMONEY_WALLET_ID,
@@ -19,7 +21,11 @@ from config import (
 )
 from utils.maintenance import is_maintenance_enabled
 from utils.helpers import extract_referrer_id
-from config import ADMIN_IDS, ADMIN_IDS_STR
+from utils.stats import record_payment
+from utils.shared_state import shared_lock
+from utils import payment_ledger
+from utils.metrics import PAYMENT_STAGE_SECONDS, PAYMENTS
+from utils.admission import PAYMENT, with_traffic_class
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -27,17 +33,20 @@ logger = logging.getLogger(__name__)
 marzban_service = MarzbanService(MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD)
 payment_service = PaymentService(YOOMONEY_WALLET_ID, YOOMONEY_NOTIFICATION_SECRET)
 
+# Текст экрана оплаты зависит только от тарифа — форматируем один раз
+_PAYMENT_INFO_TEXTS = {
+    plan_key: MESSAGES["payment_info"].format(plan_name=plan["name"], price=plan["price"], days=plan["days"])
+    for plan_key, plan in SUBSCRIPTION_PLANS.items()
+}
+
 
 @router.callback_query(F.data.startswith("plan_"))
 async def process_plan_selection(callback: CallbackQuery):
     """Обработка выбора тарифного плана"""
     plan_key = callback.data.split("_", 1)[1]
-    # Блокируем оплату в режиме обслуживания для НЕ-админов
-    if is_maintenance_enabled() and callback.from_user:
-        uid = getattr(callback.from_user, 'id', None)
-        if uid is not None and (uid not in ADMIN_IDS and str(uid) not in ADMIN_IDS_STR):
-            await callback.answer(MESSAGES["maintenance_active"], show_alert=True)
-            return
+    # Блокируем оплату в режиме обслуживания для НЕ-админов.
+    # Флаг хранится в памяти, проверка не обращается к файловой системе.
+    if is_maintenance_enabled() and callback.from_user.id not in ADMIN_ID_SET:
         await callback.answer(MESSAGES["maintenance_active"], show_alert=True)
         return
     
@@ -55,11 +64,7 @@ async def process_plan_selection(callback: CallbackQuery):
         plan_key=plan_key
     )
     
-    text = MESSAGES["payment_info"].format(
-        plan_name=plan["name"],
-        price=plan["price"],
-        days=plan["days"]
-    )
+    text = _PAYMENT_INFO_TEXTS[plan_key]
     
     await callback.message.edit_text(
         text=text,
@@ -72,21 +77,38 @@ async def process_plan_selection(callback: CallbackQuery):
 
 
 # Webhook для обработки уведомлений от YooMoney (отдельный endpoint)
-async def process_payment_notification(data: dict, bot: Bot | None = None):
-    """Обработка уведомления об оплате"""
+@with_traffic_class(PAYMENT)
+async def process_payment_notification(data: dict, bot: Bot | None = None) -> str:
+    """Обработка уведомления об оплате.
+
+    Возвращает "processed", "rejected" (уведомление не прошло проверки — повтор не поможет)
+    или "failed" (подписку активировать не удалось — уведомление можно обработать повторно).
+    """
+    started = time.perf_counter()
+    result = await _process_payment_notification(data, bot)
+    PAYMENTS.inc(result)
+    PAYMENT_STAGE_SECONDS.observe(time.perf_counter() - started, "total")
+    # Повтор уже применённой оплаты для вызывающего кода — обычный успех
+    return "processed" if result == "duplicate" else result
+
+
+async def _process_payment_notification(data: dict, bot: Bot | None) -> str:
+    """Возвращает "processed", "duplicate" (оплата уже применена), "rejected" (не прошло проверки)
+    или "failed" (ошибка активации)."""
+    started = time.perf_counter()
     # Уведомления об оплате принимаем, даже если обслуживание включено
     if not payment_service.verify_notification(data):
-        return False
+        return "rejected"
     
     payment_data = payment_service.parse_payment_data(data.get("label", ""))
     if not payment_data:
-        return False
+        return "rejected"
     
     telegram_id = payment_data["telegram_id"]
     plan_key = payment_data["plan_key"]
     
     if plan_key not in SUBSCRIPTION_PLANS:
-        return False
+        return "rejected"
     
     plan = SUBSCRIPTION_PLANS[plan_key]
 
@@ -110,7 +132,7 @@ async def process_payment_notification(data: dict, bot: Bot | None = None):
 
     if expected_amount is None:
         logger.error("Configured price for plan %s is invalid", plan_key)
-        return False
+        return "rejected"
 
     if withdraw_amount is not None:
         if withdraw_amount != expected_amount:
@@ -122,7 +144,7 @@ async def process_payment_notification(data: dict, bot: Bot | None = None):
                 expected_amount,
                 paid_amount,
             )
-            return False
+            return "rejected"
     elif paid_amount is not None:
         if paid_amount != expected_amount:
             logger.warning(
@@ -132,26 +154,57 @@ async def process_payment_notification(data: dict, bot: Bot | None = None):
                 paid_amount,
                 expected_amount,
             )
-            return False
+            return "rejected"
     else:
         logger.warning("Payment rejected: missing amount fields for label %s", data.get("label"))
-        return False
+        return "rejected"
     
+    PAYMENT_STAGE_SECONDS.observe(time.perf_counter() - started, "validate")
+
+    operation_id = data.get("operation_id") or None
     try:
-        # Проверяем, есть ли уже пользователь
-        user_info = await marzban_service.get_user_info(telegram_id)
-        
-        if user_info:
-            # Продлеваем подписку
-            result = await marzban_service.extend_subscription(telegram_id, plan)
-        else:
-            # Создаем нового пользователя
-            result = await marzban_service.create_user(telegram_id, plan)
+        # Блокировка по пользователю: два уведомления в разных процессах не создадут его дважды,
+        # а проверка журнала оплат и продление идут одной критической секцией
+        async with shared_lock(f"user:{telegram_id}"):
+            # Histogram.time — обычный (синхронный) контекстный менеджер
+            with PAYMENT_STAGE_SECONDS.time("activate"):
+                entry = await payment_ledger.get_payment(operation_id) if operation_id else None
+                if entry is not None and entry["status"] == payment_ledger.APPLIED:
+                    logger.info("Payment %s for user %s already applied, skipping", operation_id, telegram_id)
+                    return "duplicate"
+
+                # Проверяем, есть ли уже пользователь (без кэша: от срока зависит продление)
+                user_info = await marzban_service.fetch_user_info(telegram_id)
+                current_expire = int((user_info or {}).get("expire") or 0)
+
+                if entry is not None and current_expire >= (entry["target_expire"] or 0):
+                    # Прошлая попытка не дождалась ответа панели, но продление применилось
+                    logger.warning("Payment %s for user %s was applied by an earlier attempt", operation_id, telegram_id)
+                    result = user_info
+                else:
+                    if operation_id:
+                        target_expire = max(current_expire, int(time.time())) + int(plan["days"]) * 86400
+                        await payment_ledger.begin_payment(operation_id, telegram_id, target_expire)
+                    if user_info:
+                        # Продлеваем подписку
+                        result = await marzban_service.extend_subscription(telegram_id, plan, paid=True)
+                    else:
+                        # Создаем нового пользователя
+                        result = await marzban_service.create_user(telegram_id, plan)
+                if operation_id:
+                    await payment_ledger.mark_applied(operation_id)
         
         logger.info("Payment processed for user %s, until %s", telegram_id, result.get("expire"))
+        # Подписка уже продлена: ошибка статистики не должна превращать оплату в "failed",
+        # иначе повторная обработка продлит её второй раз
+        try:
+            await record_payment(plan_key, expected_amount)
+        except Exception as stats_err:
+            logger.error("Failed to record payment stats for %s: %s", telegram_id, stats_err)
 
         # Notify user if bot instance provided
         if bot is not None:
+            stage_started = time.perf_counter()
             try:
                 expire_ts = result.get("expire")
                 expire_str = "—"
@@ -173,8 +226,10 @@ async def process_payment_notification(data: dict, bot: Bot | None = None):
                 await bot.send_message(chat_id=telegram_id, text=text, reply_markup=keyboard)
             except Exception as notify_err:
                 logger.error("Failed to notify user %s: %s", telegram_id, notify_err)
+            PAYMENT_STAGE_SECONDS.observe(time.perf_counter() - stage_started, "notify")
         
         # Реферальный бонус: если у платящего пользователя есть реферер (в note), начисляем 30% от купленных дней
+        stage_started = time.perf_counter()
         try:
             user_info_after = await marzban_service.get_user_info(telegram_id)
             note = (user_info_after or {}).get("note")
@@ -197,9 +252,10 @@ async def process_payment_notification(data: dict, bot: Bot | None = None):
                         logger.error("Failed to notify referrer %s: %s", referrer_id, ref_notify_err)
         except Exception as ref_err:
             logger.error("Referral bonus error for payer %s: %s", telegram_id, ref_err)
-        return True
+        PAYMENT_STAGE_SECONDS.observe(time.perf_counter() - stage_started, "referral")
+        return "processed"
     except Exception as e:
         logger.error(f"Failed to process payment for user {telegram_id}: {e}")
-        return False
+        return "failed"
 
 
@@ -1,14 +1,20 @@
 import asyncio
+import html
+import re
+from datetime import datetime, timedelta
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from keyboards.inline import get_main_menu
-from config import MESSAGES, MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD, REFERRAL, BOT_USERNAME, BUTTONS, ADMIN_IDS
-from services.marzban_service import MarzbanService
-from utils.helpers import is_subscription_active, build_user_note, update_note_with_username
+from keyboards.inline import get_admin_panel_menu, get_main_menu
+from config import MESSAGES, MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD, REFERRAL, BOT_USERNAME, BUTTONS, ADMIN_ID_SET
+from services.marzban_service import MarzbanService, get_panel_health
+from utils.helpers import is_subscription_active, build_user_note
 from utils.promo import consume_promo
+from utils.shared_state import shared_lock
+from utils.callbacks import ack_first
+from utils.usernames import remember_note, sync_note_usernames
 
 router = Router()
 marzban_service = MarzbanService(MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD)
@@ -20,8 +26,27 @@ class BroadcastStates(StatesGroup):
     waiting_for_message_single = State()
 
 
+class PromoBulkStates(StatesGroup):
+    waiting_for_params = State()
+
+
+PROMO_BULK_MAX = 100_000
+_CAMPAIGN_RE = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
 def _is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    return user_id in ADMIN_ID_SET
+
+
+def _admin_panel_text() -> str:
+    # Состояние circuit breaker: админ сразу видит, что панель лежит и запросы отклоняются
+    health = get_panel_health()
+    line = MESSAGES[f"panel_health_{health['state']}"].format(
+        failures=health["failures"],
+        retry_in=int(health["retry_in"]) + 1,
+        error=html.escape(health["last_error"] or "—"),
+    )
+    return MESSAGES["admin_panel"] + line
 
 
 def _is_cancel(message: Message) -> bool:
@@ -36,6 +61,44 @@ def _build_ref_link(user_id: int) -> str:
     return f"https://t.me/{bot_username}?start={param}_{user_id}"
 
 
+# Пробные профили, которые сейчас создаются: повторный /start ждёт тот же результат
+_trial_in_flight: dict[int, asyncio.Task] = {}
+_TRIAL_PLAN = {"name": "trial", "days": 3, "price": 0, "trial": True}
+
+
+async def _create_trial(telegram_id: int, referrer_id: int | None, raw_username: str | None) -> tuple[dict, bool]:
+    note = build_user_note(referrer_id, raw_username)
+    # Та же блокировка, что у оплаты: профиль не создадут дважды и в соседнем процессе
+    async with shared_lock(f"user:{telegram_id}"):
+        try:
+            result = await marzban_service.create_user(telegram_id, _TRIAL_PLAN, note=note)
+        except Exception:
+            # Профиль мог появиться раньше (другой процесс, оплата) — тогда берём его из панели
+            existing = await marzban_service.get_user_info(telegram_id)
+            if existing is None:
+                raise
+            return existing, False
+    remember_note(telegram_id, note)
+    return result, True
+
+
+async def _provision_trial(
+    telegram_id: int, referrer_id: int | None, raw_username: str | None
+) -> tuple[dict, bool]:
+    """Создать пробный профиль один раз на telegram_id.
+
+    Возвращает профиль (ответ create_user, без повторного чтения из панели) и
+    признак того, что профиль создан именно этим вызовом."""
+    task = _trial_in_flight.get(telegram_id)
+    if task is not None:
+        info, _ = await asyncio.shield(task)
+        return info, False
+    task = asyncio.create_task(_create_trial(telegram_id, referrer_id, raw_username))
+    _trial_in_flight[telegram_id] = task
+    task.add_done_callback(lambda _: _trial_in_flight.pop(telegram_id, None))
+    return await asyncio.shield(task)
+
+
 @router.message(CommandStart())
 async def start_handler(message: Message):
     """Обработчик команды /start"""
@@ -47,6 +110,9 @@ async def start_handler(message: Message):
         user_info = await marzban_service.get_user_info(telegram_id)
     except Exception:
         user_info = None
+    if user_info:
+        # username из note уже известен — middleware не будет перечитывать профиль
+        remember_note(telegram_id, user_info.get("note"))
 
     # Если пользователя нет — создаем пробный профиль на 3 дня
     if not user_info:
@@ -66,14 +132,16 @@ async def start_handler(message: Message):
             referrer_id = None
 
         try:
-            trial_plan = {"name": "trial", "days": 3, "price": 0}
-            note = build_user_note(referrer_id, raw_username)
-            result = await marzban_service.create_user(telegram_id, trial_plan, note=note)
-            created_trial = True
+            user_info, created_trial = await _provision_trial(telegram_id, referrer_id, raw_username)
+        except Exception:
+            # Если не удалось создать пробный — продолжим без него
+            user_info, created_trial = None, False
+
+        if created_trial:
             # Сообщение об активации пробного периода
             try:
                 from utils.helpers import format_ts_to_str
-                expire_str = format_ts_to_str(result.get("expire", 0))
+                expire_str = format_ts_to_str(user_info.get("expire", 0))
             except Exception:
                 expire_str = "—"
             status_line = MESSAGES["trial_activated_title"]
@@ -82,37 +150,32 @@ async def start_handler(message: Message):
                 expire_str=expire_str,
             )
             await message.answer(trial_text)
-            # Обновим user_info для дальнейшей персонализации меню
-            user_info = await marzban_service.get_user_info(telegram_id)
-        except Exception:
-            # Если не удалось создать пробный — продолжим без него
-            created_trial = False
 
     is_active = is_subscription_active(user_info)
 
     await message.answer(
         text=MESSAGES["welcome"],
-        reply_markup=get_main_menu(has_active=is_active, is_admin=message.from_user.id in ADMIN_IDS)
+        reply_markup=get_main_menu(has_active=is_active, is_admin=message.from_user.id in ADMIN_ID_SET)
     )
 
 
 @router.callback_query(F.data == "back_to_main")
+@ack_first
 async def back_to_main(callback: CallbackQuery):
     """Возврат в главное меню"""
     # Определим активность для персонализации CTA
     try:
         user_info = await marzban_service.get_user_info(callback.from_user.id)
+        if user_info:
+            remember_note(callback.from_user.id, user_info.get("note"))
         is_active = is_subscription_active(user_info)
     except Exception:
         is_active = False
-    await callback.message.edit_text(
-        text=MESSAGES["welcome"],
-        reply_markup=get_main_menu(has_active=is_active, is_admin=callback.from_user.id in ADMIN_IDS)
-    )
-    await callback.answer()
+    return MESSAGES["welcome"], get_main_menu(has_active=is_active, is_admin=callback.from_user.id in ADMIN_ID_SET)
 
 
 @router.callback_query(F.data == "ref_info")
+@ack_first
 async def show_ref_info(callback: CallbackQuery):
     """Показать информацию о реферальной программе и персональную ссылку"""
     ref_link = _build_ref_link(callback.from_user.id)
@@ -133,8 +196,7 @@ async def show_ref_info(callback: CallbackQuery):
         [InlineKeyboardButton(text=BUTTONS["share_referral"], callback_data="ref_share")],
         [InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")]
     ])
-    await callback.message.edit_text(text=text, reply_markup=kb)
-    await callback.answer()
+    return text, kb
 
 
 @router.callback_query(F.data == "ref_share")
@@ -151,52 +213,32 @@ async def share_ref_message(callback: CallbackQuery):
 
 @router.callback_query(F.data == "admin_panel")
 async def admin_panel(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in ADMIN_ID_SET:
         await callback.answer()
         return
-    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
     from utils.maintenance import is_maintenance_enabled
-    toggle_text = BUTTONS["maintenance_disable"] if is_maintenance_enabled() else BUTTONS["maintenance_enable"]
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=toggle_text, callback_data="maintenance_toggle")],
-        [InlineKeyboardButton(text=BUTTONS["backup"], callback_data="run_backup")],
-        [InlineKeyboardButton(text=BUTTONS["manage_users"], callback_data="manage_users")],
-        [InlineKeyboardButton(text=BUTTONS["create_promo"], callback_data="promo_create")],
-        [InlineKeyboardButton(text=BUTTONS["sync_usernames"], callback_data="sync_usernames")],
-        [InlineKeyboardButton(text=BUTTONS["broadcast"], callback_data="broadcast_menu")],
-        [InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")],
-    ])
-    await callback.message.edit_text(text=MESSAGES["admin_panel"], reply_markup=kb)
+    kb = get_admin_panel_menu(is_maintenance_enabled())
+    await callback.message.edit_text(text=_admin_panel_text(), reply_markup=kb)
     await callback.answer()
 
 
 @router.callback_query(F.data == "maintenance_toggle")
 async def toggle_maintenance(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in ADMIN_ID_SET:
         await callback.answer()
         return
     from utils.maintenance import set_maintenance_enabled, is_maintenance_enabled
     # Toggle current state
     enable = not is_maintenance_enabled()
     set_maintenance_enabled(enable)
-    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-    toggle_text = BUTTONS["maintenance_disable"] if is_maintenance_enabled() else BUTTONS["maintenance_enable"]
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=toggle_text, callback_data="maintenance_toggle")],
-        [InlineKeyboardButton(text=BUTTONS["backup"], callback_data="run_backup")],
-        [InlineKeyboardButton(text=BUTTONS["manage_users"], callback_data="manage_users")],
-        [InlineKeyboardButton(text=BUTTONS["create_promo"], callback_data="promo_create")],
-        [InlineKeyboardButton(text=BUTTONS["sync_usernames"], callback_data="sync_usernames")],
-        [InlineKeyboardButton(text=BUTTONS["broadcast"], callback_data="broadcast_menu")],
-        [InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")],
-    ])
-    await callback.message.edit_text(text=MESSAGES["admin_panel"], reply_markup=kb)
+    kb = get_admin_panel_menu(is_maintenance_enabled())
+    await callback.message.edit_text(text=_admin_panel_text(), reply_markup=kb)
     await callback.answer(MESSAGES["maintenance_enabled"] if enable else MESSAGES["maintenance_disabled"])
 
 
 @router.callback_query(F.data == "sync_usernames")
 async def sync_usernames(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in ADMIN_ID_SET:
         await callback.answer()
         return
 
@@ -228,46 +270,18 @@ async def sync_usernames(callback: CallbackQuery):
         return
 
     total = len(candidates)
-    updated = 0
-    unchanged = 0
-    missing_username = 0
-    errors = 0
-
-    for tg_id, user in candidates:
-        try:
-            chat = await callback.bot.get_chat(tg_id)
-            actual_username = getattr(chat, "username", None)
-            if not actual_username:
-                missing_username += 1
-
-            new_note = update_note_with_username(user.get("note"), actual_username)
-            current_note = user.get("note")
-            if new_note == current_note:
-                unchanged += 1
-            else:
-                try:
-                    success = await marzban_service.set_user_note(tg_id, new_note)
-                except asyncio.CancelledError:
-                    raise
-                except Exception:
-                    success = False
-
-                if success:
-                    updated += 1
-                else:
-                    errors += 1
-        except asyncio.CancelledError:
-            raise
-        except Exception:
-            errors += 1
-        finally:
-            await asyncio.sleep(0.03)
+    counters = await sync_note_usernames(callback.bot, marzban_service, candidates)
+    updated = counters["updated"]
+    unchanged = counters["unchanged"]
+    missing_username = counters["missing"]
+    errors = counters["errors"]
 
     summary_template = MESSAGES.get("sync_usernames_done")
     if summary_template:
         summary_text = summary_template.format(
             total=total,
             updated=updated,
+            cached=counters["cached"],
             unchanged=unchanged,
             missing=missing_username,
             errors=errors,
@@ -421,7 +435,7 @@ async def broadcast_message_single(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "run_backup")
 async def run_backup(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in ADMIN_ID_SET:
         await callback.answer()
         return
     from utils.backup import run_marzban_backup
@@ -431,9 +445,7 @@ async def run_backup(callback: CallbackQuery):
         # Отправим архив админу, если найден
         if archive_path:
             try:
-                from aiogram.types import FSInputFile
-                doc = FSInputFile(archive_path)
-                await callback.message.answer_document(document=doc, caption=MESSAGES["backup_success"])
+                await _send_backup_archive(callback.message, archive_path)
             except Exception:
                 await callback.message.answer(MESSAGES["backup_success"]) 
         else:
@@ -442,17 +454,122 @@ async def run_backup(callback: CallbackQuery):
         await callback.message.answer(f"{MESSAGES['backup_failed']}\n<code>{output[:1000]}</code>")
 
 
+async def _send_backup_archive(message: Message, archive_path: str) -> None:
+    """Отправить архив томами не больше лимита Telegram, с контрольными суммами.
+
+    Разбиение и хэширование идут в отдельном потоке, а FSInputFile читает файл
+    асинхронно по частям — бот остаётся отзывчивым даже на многогигабайтных архивах.
+    """
+    import os
+    from aiogram.types import BufferedInputFile, FSInputFile
+    from config import BACKUP_VOLUME_SIZE
+    from utils.backup import cleanup_backup_volumes, split_backup_archive
+
+    volumes, archive_sha = await asyncio.to_thread(split_backup_archive, archive_path, BACKUP_VOLUME_SIZE)
+    try:
+        archive_name = os.path.basename(archive_path)
+        if len(volumes) == 1:
+            caption = MESSAGES["backup_success"] + "\n" + MESSAGES["backup_checksum"].format(sha256=archive_sha)
+            await message.answer_document(document=FSInputFile(archive_path), caption=caption)
+            return
+        total = len(volumes)
+        for index, volume in enumerate(volumes, start=1):
+            caption = MESSAGES["backup_volume_caption"].format(
+                index=index, total=total, sha256=volume.sha256,
+            )
+            await message.answer_document(document=FSInputFile(volume.path), caption=caption)
+        sums = "".join(f"{v.sha256}  {os.path.basename(v.path)}\n" for v in volumes)
+        sums += f"{archive_sha}  {archive_name}\n"
+        await message.answer_document(
+            document=BufferedInputFile(sums.encode("utf-8"), filename=f"{archive_name}.sha256"),
+            caption=MESSAGES["backup_volumes_done"].format(total=total, archive_name=archive_name),
+        )
+    finally:
+        await asyncio.to_thread(cleanup_backup_volumes, archive_path, volumes)
+
+
+# Должен быть зарегистрирован раньше promo_code_entered: ввод вида "100000" совпадает с шаблоном промокода
+@router.message(PromoBulkStates.waiting_for_params)
+async def promo_bulk_params(message: Message, state: FSMContext):
+    if not _is_admin(message.from_user.id):
+        await state.clear()
+        return
+    if _is_cancel(message):
+        await state.clear()
+        await message.answer(MESSAGES["promo_bulk_cancelled"])
+        return
+
+    data = await state.get_data()
+    plan_key = data.get("promo_plan_key")
+    from config import SUBSCRIPTION_PLANS
+    plan = SUBSCRIPTION_PLANS.get(plan_key or "")
+    if not plan:
+        await state.clear()
+        await message.answer(MESSAGES["promo_bulk_cancelled"])
+        return
+
+    invalid_text = MESSAGES["promo_bulk_invalid"].format(max_count=PROMO_BULK_MAX)
+    tokens = (message.text or "").split()
+    if not tokens or not tokens[0].isdigit() or len(tokens) > 3:
+        await message.answer(invalid_text)
+        return
+    count = int(tokens[0])
+    days = 0
+    campaign: str | None = None
+    rest = tokens[1:]
+    if rest and rest[0].isdigit():
+        days = int(rest.pop(0))
+    if rest:
+        campaign = rest.pop(0)
+    if rest or not (1 <= count <= PROMO_BULK_MAX) or (campaign and not _CAMPAIGN_RE.match(campaign)):
+        await message.answer(invalid_text)
+        return
+
+    expires_at = None
+    expires_str = "без срока"
+    if days > 0:
+        expires_dt = datetime.now() + timedelta(days=days)
+        expires_at = int(expires_dt.timestamp())
+        expires_str = expires_dt.strftime("%d.%m.%Y %H:%M")
+
+    from utils.promo import create_promos_bulk
+    codes = await create_promos_bulk(plan_key, count, expires_at=expires_at, campaign=campaign)
+    await state.clear()
+    if not codes:
+        await message.answer(MESSAGES["promo_bulk_failed"])
+        return
+
+    from aiogram.types import BufferedInputFile
+    header = "code,plan,campaign,expires_at\n"
+    body = "".join(f"{code},{plan_key},{campaign or ''},{expires_at or ''}\n" for code in codes)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"promo_{campaign or plan_key}_{stamp}.csv"
+    caption = MESSAGES["promo_bulk_done"].format(
+        count=len(codes),
+        plan_name=plan["name"],
+        campaign=campaign or "—",
+        expires_str=expires_str,
+    )
+    await message.answer_document(
+        document=BufferedInputFile((header + body).encode("utf-8"), filename=filename),
+        caption=caption,
+    )
+
+
 @router.message(F.text.regexp(r"^[A-Za-z0-9_-]{6,}$"))
 async def promo_code_entered(message: Message):
     """Обработка ввода промокода в чате"""
     code = (message.text or "").strip()
-    result = consume_promo(code)
+    result = await consume_promo(code, message.from_user.id)
     if result is None:
         await message.answer(MESSAGES.get("promo_invalid", "Неверный промокод"))
         return
     if result == "USED":
         await message.answer(MESSAGES.get("promo_used", "Промокод уже использован"))
         return
+    if result == "EXPIRED":
+        await message.answer(MESSAGES.get("promo_expired", "Срок действия промокода истёк"))
+        return
     plan_key = result
     from config import SUBSCRIPTION_PLANS
     plan = SUBSCRIPTION_PLANS.get(plan_key)
@@ -485,7 +602,7 @@ async def promo_code_entered(message: Message):
 
 @router.callback_query(F.data == "promo_create")
 async def promo_create(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in ADMIN_ID_SET:
         await callback.answer()
         return
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -493,6 +610,10 @@ async def promo_create(callback: CallbackQuery):
     buttons = []
     for plan_key, plan in SUBSCRIPTION_PLANS.items():
         buttons.append([InlineKeyboardButton(text=f"{plan['name']}", callback_data=f"promo_plan_{plan_key}")])
+    buttons.append([
+        InlineKeyboardButton(text=BUTTONS["promo_bulk"], callback_data="promo_bulk"),
+        InlineKeyboardButton(text=BUTTONS["promo_campaigns"], callback_data="promo_campaigns"),
+    ])
     buttons.append([InlineKeyboardButton(text=BUTTONS["back"], callback_data="admin_panel")])
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     await callback.message.edit_text(MESSAGES.get("promo_create_prompt", "Выберите тариф"), reply_markup=kb)
@@ -501,12 +622,12 @@ async def promo_create(callback: CallbackQuery):
 
 @router.callback_query(F.data.startswith("promo_plan_"))
 async def promo_plan_selected(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in ADMIN_ID_SET:
         await callback.answer()
         return
     plan_key = callback.data.split("promo_plan_", 1)[1]
     from utils.promo import create_promo
-    result = create_promo(plan_key)
+    result = await create_promo(plan_key)
     if not result:
         await callback.answer("Ошибка создания", show_alert=True)
         return
@@ -519,3 +640,63 @@ async def promo_plan_selected(callback: CallbackQuery):
     await callback.answer()
 
 
+@router.callback_query(F.data == "promo_bulk")
+async def promo_bulk(callback: CallbackQuery, state: FSMContext):
+    if not _is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    await state.clear()
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    from config import SUBSCRIPTION_PLANS
+    buttons = [
+        [InlineKeyboardButton(text=f"{plan['name']}", callback_data=f"promo_bulk_plan_{plan_key}")]
+        for plan_key, plan in SUBSCRIPTION_PLANS.items()
+    ]
+    buttons.append([InlineKeyboardButton(text=BUTTONS["back"], callback_data="promo_create")])
+    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await callback.message.edit_text(MESSAGES["promo_bulk_plan_prompt"], reply_markup=kb)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("promo_bulk_plan_"))
+async def promo_bulk_plan_selected(callback: CallbackQuery, state: FSMContext):
+    if not _is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    plan_key = callback.data.split("promo_bulk_plan_", 1)[1]
+    from config import SUBSCRIPTION_PLANS
+    plan = SUBSCRIPTION_PLANS.get(plan_key)
+    if not plan:
+        await callback.answer(MESSAGES["invalid_plan_alert"], show_alert=True)
+        return
+    await state.set_state(PromoBulkStates.waiting_for_params)
+    await state.update_data(promo_plan_key=plan_key)
+    await callback.message.answer(MESSAGES["promo_bulk_params_prompt"].format(plan_name=plan["name"]))
+    await callback.answer()
+
+
+@router.callback_query(F.data == "promo_campaigns")
+async def promo_campaigns(callback: CallbackQuery):
+    if not _is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    from utils.promo import campaign_stats
+    rows = await campaign_stats()
+    if rows:
+        lines = [MESSAGES["promo_campaigns_title"]]
+        for row in rows:
+            issued = row["issued"] or 0
+            redeemed = row["redeemed"] or 0
+            rate = (redeemed / issued * 100) if issued else 0.0
+            lines.append(MESSAGES["promo_campaigns_row"].format(
+                campaign=row["campaign"], issued=issued, redeemed=redeemed, rate=rate,
+            ))
+        text = "\n".join(lines)
+    else:
+        text = MESSAGES["promo_campaigns_empty"]
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=BUTTONS["back"], callback_data="promo_create")]
+    ])
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
@@ -1,18 +1,46 @@
+import asyncio
+import time
+from functools import lru_cache
 from aiogram import Router, F
-from aiogram.types import CallbackQuery
-from services.marzban_service import MarzbanService
+from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from services.marzban_service import MarzbanService, get_cached_user_info
 from keyboards.inline import get_subscription_menu, get_plans_menu
-from config import MESSAGES, MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD
+from utils.callbacks import ack_first
+from config import (
+    BUTTONS,
+    MESSAGES,
+    MARZBAN_BASE_URL,
+    MARZBAN_USERNAME,
+    MARZBAN_PASSWORD,
+    SUBSCRIPTION_FETCH_TIMEOUT,
+    SUBSCRIPTION_FRESH_SECONDS,
+)
 from utils.helpers import (
     is_subscription_active,
     bytes_to_gigabytes,
     get_display_username,
     format_ts_to_str,
 )
+from utils.usernames import remember_note
 
 router = Router()
 marzban_service = MarzbanService(MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD)
 
+_UNAVAILABLE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=BUTTONS["retry"], callback_data="my_subscription")],
+    [InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")],
+])
+
+
+@lru_cache(maxsize=16)
+def _render_plans_intro(countries_text: str) -> str:
+    # Список локаций меняется редко — готовый текст переиспользуется
+    template = MESSAGES.get("no_subscription", "{countries}")
+    try:
+        return template.format(countries=countries_text)
+    except Exception:
+        return f"{template}\n{countries_text}" if countries_text else template
+
 
 async def _build_plans_intro_text() -> str:
     try:
@@ -23,79 +51,104 @@ async def _build_plans_intro_text() -> str:
         countries_text = "\n".join(locations)
     else:
         countries_text = "—"
-    template = MESSAGES.get("no_subscription", "{countries}")
-    try:
-        return template.format(countries=countries_text)
-    except Exception:
-        return f"{template}\n{countries_text}" if countries_text else template
+    return _render_plans_intro(countries_text)
 
 
-@router.callback_query(F.data == "my_subscription")
-async def my_subscription_handler(callback: CallbackQuery):
-    """Показать информацию о подписке"""
-    telegram_id = callback.from_user.id
-    user_info = await marzban_service.get_user_info(telegram_id)
-    
+async def _render_subscription(user_info: dict | None):
+    """Экран подписки по профилю пользователя (None — профиля нет)."""
     # Определяем активность
     is_active = is_subscription_active(user_info)
 
     if not user_info:
         # Пользователь ещё ни разу не оформлял подписку
-        await callback.message.edit_text(
-            text=await _build_plans_intro_text(),
-            reply_markup=get_plans_menu()
-        )
-    elif not is_active:
+        return await _build_plans_intro_text(), get_plans_menu()
+    if not is_active:
         # Профиль есть, но подписка истекла — показываем предупреждение, без моментального перехода к оплате
-        await callback.message.edit_text(
-            text=MESSAGES["subscription_expired"],
-            reply_markup=get_subscription_menu(has_subscription=False)
-        )
+        return MESSAGES["subscription_expired"], get_subscription_menu(has_subscription=False)
+
+    # Есть активная подписка
+    # Показ бесконечного срока, если дата не установлена в Marzban
+    _raw_exp = user_info.get("expire")
+    expire_date = "∞" if not _raw_exp else format_ts_to_str(int(_raw_exp))
+    used_gb = bytes_to_gigabytes(user_info.get("used_traffic", 0))
+    total_gb = "∞" if not user_info.get("data_limit") else f"{bytes_to_gigabytes(user_info['data_limit'])} ГБ"
+    display_username = get_display_username(user_info.get("username"))
+
+    subscription_url = user_info.get("subscription_url", "")
+    subscription_url_plain = user_info.get("subscription_url_plain")
+    if (
+        subscription_url
+        and subscription_url_plain
+        and subscription_url != subscription_url_plain
+    ):
+        subscription_label = "Зашифрованная ссылка"
     else:
-        # Есть активная подписка
-        # Показ бесконечного срока, если дата не установлена в Marzban
-        _raw_exp = user_info.get("expire")
-        expire_date = "∞" if not _raw_exp else format_ts_to_str(int(_raw_exp))
-        used_gb = bytes_to_gigabytes(user_info.get("used_traffic", 0))
-        total_gb = "∞" if not user_info.get("data_limit") else f"{bytes_to_gigabytes(user_info['data_limit'])} ГБ"
-        display_username = get_display_username(user_info.get("username"))
-
-        subscription_url = user_info.get("subscription_url", "")
-        subscription_url_plain = user_info.get("subscription_url_plain")
-        if (
-            subscription_url
-            and subscription_url_plain
-            and subscription_url != subscription_url_plain
-        ):
-            subscription_label = "Зашифрованная ссылка"
-        else:
-            subscription_label = "Ссылка для подключения"
-
-        link_to_show = subscription_url or "—"
-
-        text = MESSAGES["subscription_active"].format(
-            display_username=display_username,
-            expire_date=expire_date,
-            used_gb=used_gb,
-            total_gb=total_gb,
-            subscription_url=link_to_show,
-            subscription_label=subscription_label,
+        subscription_label = "Ссылка для подключения"
+
+    link_to_show = subscription_url or "—"
+
+    text = MESSAGES["subscription_active"].format(
+        display_username=display_username,
+        expire_date=expire_date,
+        used_gb=used_gb,
+        total_gb=total_gb,
+        subscription_url=link_to_show,
+        subscription_label=subscription_label,
+    )
+    return text, get_subscription_menu(has_subscription=True)
+
+
+def _with_freshness(screen, template: str, fetched_at: float):
+    text, kb = screen
+    return text + MESSAGES[template].format(time=format_ts_to_str(int(fetched_at))), kb
+
+
+async def _revalidate(telegram_id: int, cached_info: dict, fetched_at: float):
+    try:
+        user_info = await asyncio.wait_for(
+            marzban_service.fetch_user_info(telegram_id), SUBSCRIPTION_FETCH_TIMEOUT
         )
+    except Exception:
+        # Панель недоступна — оставляем сохранённые данные, но честно помечаем их
+        return _with_freshness(await _render_subscription(cached_info), "subscription_offline", fetched_at)
+    if user_info:
+        remember_note(telegram_id, user_info.get("note"))
+    return await _render_subscription(user_info)
 
-        kb = get_subscription_menu(has_subscription=True)
-        await callback.message.edit_text(text=text, reply_markup=kb)
-    
-    await callback.answer()
+
+@router.callback_query(F.data == "my_subscription")
+@ack_first
+async def my_subscription_handler(callback: CallbackQuery):
+    """Показать информацию о подписке"""
+    telegram_id = callback.from_user.id
+    cached = await get_cached_user_info(telegram_id)
+    if cached is not None:
+        # Последний известный профиль отдаём сразу; устаревший обновляем в фоне
+        cached_info, fetched_at = cached
+        remember_note(telegram_id, cached_info.get("note"))
+        screen = await _render_subscription(cached_info)
+        if time.time() - fetched_at < SUBSCRIPTION_FRESH_SECONDS:
+            return screen
+        text, kb = _with_freshness(screen, "subscription_stale", fetched_at)
+        return text, kb, lambda: _revalidate(telegram_id, cached_info, fetched_at)
+
+    try:
+        user_info = await asyncio.wait_for(
+            marzban_service.fetch_user_info(telegram_id), SUBSCRIPTION_FETCH_TIMEOUT
+        )
+    except Exception:
+        # Панель не ответила: это не значит, что подписки нет — не предлагаем купить её заново
+        return MESSAGES["subscription_unavailable"], _UNAVAILABLE_KEYBOARD
+    if user_info:
+        remember_note(telegram_id, user_info.get("note"))
+    return await _render_subscription(user_info)
 
 
 @router.callback_query(F.data.in_(["buy_subscription", "extend_subscription"]))
+@ack_first
 async def show_plans(callback: CallbackQuery):
     """Показать тарифные планы"""
-    await callback.message.edit_text(
-        text=await _build_plans_intro_text(),
-        reply_markup=get_plans_menu()
-    )
-    await callback.answer()
+    return await _build_plans_intro_text(), get_plans_menu()
 
 
 @router.callback_query(F.data == "enter_promo")
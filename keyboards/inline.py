@@ -2,8 +2,19 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import SUBSCRIPTION_PLANS, INSTRUCTION_URL, SUPPORT_URL, NEWS_URL, USER_AGREEMENT_URL, BUTTONS, MESSAGES
 
 
-def get_main_menu(has_active: bool = False, is_admin: bool = False) -> InlineKeyboardMarkup:
-    """Главное меню"""
+# Статические клавиатуры собираются один раз при импорте для всех вариантов
+# (has_active/is_admin и т.п.): валидация pydantic-моделей не повторяется на каждом апдейте.
+# Модели aiogram изменяемы (frozen=False, кортежи pydantic приводит к спискам), поэтому
+# хендлеры получают копию с новыми списками рядов: добавить ряд или кнопку можно, не
+# задев общий экземпляр. Сами кнопки общие — их поля менять нельзя.
+
+
+def _copy(markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+    # Без повторной валидации: в несколько раз дешевле, чем собрать клавиатуру заново
+    return markup.model_copy(update={"inline_keyboard": [list(row) for row in markup.inline_keyboard]})
+
+
+def _build_main_menu(has_active: bool, is_admin: bool) -> InlineKeyboardMarkup:
     cta_text = BUTTONS["extend_subscription"] if has_active else BUTTONS["buy_subscription"]
     rows = [
         [
@@ -27,42 +38,85 @@ def get_main_menu(has_active: bool = False, is_admin: bool = False) -> InlineKey
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def get_subscription_menu(has_subscription: bool = False) -> InlineKeyboardMarkup:
-    """Меню подписки"""
+def _build_subscription_menu(has_subscription: bool) -> InlineKeyboardMarkup:
     buttons = []
-    
+
     if has_subscription:
         buttons.append([InlineKeyboardButton(text=BUTTONS["extend_subscription"], callback_data="extend_subscription")])
         if INSTRUCTION_URL:
             buttons.append([InlineKeyboardButton(text=BUTTONS["instruction"], url=INSTRUCTION_URL)])
     else:
         buttons.append([InlineKeyboardButton(text=BUTTONS["buy_subscription"], callback_data="buy_subscription")])
-    
+
     buttons.append([InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")])
-    
+
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def get_plans_menu() -> InlineKeyboardMarkup:
-    """Меню выбора тарифов"""
+def _build_plans_menu() -> InlineKeyboardMarkup:
     buttons = []
     # Переносим кнопку ввода промокода в экран покупки/продления
     buttons.append([InlineKeyboardButton(text=BUTTONS["enter_promo"], callback_data="enter_promo")])
-    
+
     for plan_key, plan_info in SUBSCRIPTION_PLANS.items():
         text = MESSAGES["plan_button"].format(name=plan_info['name'], price=plan_info['price'])
         buttons.append([InlineKeyboardButton(text=text, callback_data=f"plan_{plan_key}")])
-    
+
     buttons.append([InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")])
-    
+
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def _build_admin_panel_menu(maintenance_enabled: bool) -> InlineKeyboardMarkup:
+    toggle_text = BUTTONS["maintenance_disable"] if maintenance_enabled else BUTTONS["maintenance_enable"]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=toggle_text, callback_data="maintenance_toggle")],
+        [InlineKeyboardButton(text=BUTTONS["backup"], callback_data="run_backup")],
+        [InlineKeyboardButton(text=BUTTONS["manage_users"], callback_data="manage_users")],
+        [InlineKeyboardButton(text=BUTTONS["create_promo"], callback_data="promo_create")],
+        [InlineKeyboardButton(text=BUTTONS["sync_usernames"], callback_data="sync_usernames")],
+        [InlineKeyboardButton(text=BUTTONS["broadcast"], callback_data="broadcast_menu")],
+        [InlineKeyboardButton(text=BUTTONS["stats"], callback_data="admin_stats")],
+        [InlineKeyboardButton(text=BUTTONS["profiling"], callback_data="admin_profiling")],
+        [InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")],
+    ])
+
+
+_MAIN_MENUS = {
+    (has_active, is_admin): _build_main_menu(has_active, is_admin)
+    for has_active in (False, True)
+    for is_admin in (False, True)
+}
+_SUBSCRIPTION_MENUS = {flag: _build_subscription_menu(flag) for flag in (False, True)}
+_PLANS_MENU = _build_plans_menu()
+_ADMIN_PANEL_MENUS = {flag: _build_admin_panel_menu(flag) for flag in (False, True)}
+# Неизменная часть меню оплаты; меняется только ссылка
+_BACK_TO_PLANS_BUTTON = InlineKeyboardButton(text=BUTTONS["back_to_plans"], callback_data="buy_subscription")
+
+
+def get_main_menu(has_active: bool = False, is_admin: bool = False) -> InlineKeyboardMarkup:
+    """Главное меню"""
+    return _copy(_MAIN_MENUS[bool(has_active), bool(is_admin)])
+
+
+def get_subscription_menu(has_subscription: bool = False) -> InlineKeyboardMarkup:
+    """Меню подписки"""
+    return _copy(_SUBSCRIPTION_MENUS[bool(has_subscription)])
+
+
+def get_plans_menu() -> InlineKeyboardMarkup:
+    """Меню выбора тарифов"""
+    return _copy(_PLANS_MENU)
+
+
+def get_admin_panel_menu(maintenance_enabled: bool) -> InlineKeyboardMarkup:
+    """Админ-панель (текст кнопки обслуживания зависит от текущего режима)"""
+    return _copy(_ADMIN_PANEL_MENUS[bool(maintenance_enabled)])
+
+
 def get_payment_menu(payment_url: str) -> InlineKeyboardMarkup:
     """Меню оплаты"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=BUTTONS["pay"], url=payment_url)],
-        [InlineKeyboardButton(text=BUTTONS["back_to_plans"], callback_data="buy_subscription")]
+        [_BACK_TO_PLANS_BUTTON],
     ])
-
-
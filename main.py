@@ -1,15 +1,41 @@
 import asyncio
 import contextlib
 import logging
+import multiprocessing
+import secrets
+import signal
+import socket
+import time
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
-from config import BOT_TOKEN, WEBHOOK_HOST, WEBHOOK_PORT
+from config import (
+    BOT_TOKEN,
+    BOT_WORKERS,
+    PAYMENT_SERVER_MODE,
+    PAYMENT_WEBHOOK_PORT,
+    TELEGRAM_UPDATES_MODE,
+    TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_WEBHOOK_URL,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+)
 from utils.reminder import run_expiry_reminders
 from utils.maintenance import MaintenanceMiddleware
-from handlers import start, subscription, payment, news, admin_users
-from webhook import create_app
+from utils.throttling import ThrottlingMiddleware
+from utils.usernames import UsernameCaptureMiddleware, run_username_flush_loop
+from utils.backup_store import run_backup_schedule_loop
+from utils.metrics import (
+    HandlerMetricsMiddleware,
+    TelegramRequestMetrics,
+    UpdateMetricsMiddleware,
+    run_event_loop_lag_monitor,
+)
+from utils.payment_queue import run_payment_queue_worker
+from utils.shared_state import LeaderElection, create_event_isolation, create_fsm_storage, get_state_backend
+from handlers import start, subscription, payment, news, admin_users, admin_stats, admin_profiling
+from webhook import PaymentServerThread, create_app
 import uvicorn
 
 # Настройка логирования
@@ -20,35 +46,120 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-async def run_bot(bot: Bot) -> None:
-    dp = Dispatcher()
+def build_dispatcher() -> Dispatcher:
+    # При общем бэкенде FSM и очередность обновлений одного чата согласованы между процессами
+    dp = Dispatcher(storage=create_fsm_storage(), events_isolation=create_event_isolation())
+    # Metrics: full update time (outermost) and per-handler time (inherited by all routers)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    # Passively records users' current usernames from incoming updates
+    dp.update.outer_middleware(UsernameCaptureMiddleware())
     # Global middleware blocks non-admins when maintenance is enabled
     dp.update.outer_middleware(MaintenanceMiddleware())
+    # Per-user limits for panel-heavy actions; runs after maintenance so blocked users spend no tokens
+    dp.update.outer_middleware(ThrottlingMiddleware())
     dp.include_router(start.router)
     dp.include_router(subscription.router)
     dp.include_router(payment.router)
     dp.include_router(news.router)
     dp.include_router(admin_users.router)
+    dp.include_router(admin_stats.router)
+    dp.include_router(admin_profiling.router)
+    return dp
+
 
-    logger.info("Starting Averra VPN Bot...")
+async def run_bot(bot: Bot, dp: Dispatcher) -> None:
+    logger.info("Starting Averra VPN Bot (polling)...")
+    # getUpdates не работает при установленном вебхуке; накопившиеся обновления сохраняются
+    await bot.delete_webhook(drop_pending_updates=False)
     await dp.start_polling(bot)
 
 
-async def run_webhook(bot: Bot) -> None:
-    app = create_app(bot)
+async def run_webhook(
+    bot: Bot,
+    dp: Dispatcher | None = None,
+    sockets: list[socket.socket] | None = None,
+    telegram_secret: str | None = None,
+    payment_queue: bool = False,
+) -> None:
+    if dp is not None:
+        logger.info("Starting Averra VPN Bot (webhook)...")
+        app = create_app(
+            bot,
+            dispatcher=dp,
+            telegram_url=TELEGRAM_WEBHOOK_URL,
+            # Без заданного секрета генерируем новый при каждом запуске — вебхук всё равно переустанавливается
+            telegram_secret=telegram_secret or TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            payment_queue=payment_queue,
+        )
+    else:
+        app = create_app(bot, payment_queue=payment_queue)
     config = uvicorn.Config(app=app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, log_level="info")
     server = uvicorn.Server(config)
-    await server.serve()
+    await server.serve(sockets=sockets)
+
+
+async def supervise(name: str, factory, restart_delay: float = 5) -> None:
+    """Перезапускать компонент после падения; штатное завершение — сигнал к остановке."""
+    while True:
+        try:
+            await factory()
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("%s crashed: %s, restarting in %ss", name, e, restart_delay)
+            await asyncio.sleep(restart_delay)
 
 
-async def main():
+async def main(sockets: list[socket.socket] | None = None, telegram_secret: str | None = None):
     bot = Bot(
         token=BOT_TOKEN,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
+    bot.session.middleware(TelegramRequestMetrics())
+
+    dp = build_dispatcher()
+    use_webhook = TELEGRAM_UPDATES_MODE == "webhook"
+    if use_webhook and not TELEGRAM_WEBHOOK_URL:
+        logger.error("TELEGRAM_UPDATES_MODE=webhook requires TELEGRAM_WEBHOOK_URL, falling back to polling")
+        use_webhook = False
+
+    payment_mode = PAYMENT_SERVER_MODE
+    if payment_mode not in ("inline", "thread", "external"):
+        logger.error("Unknown PAYMENT_SERVER_MODE %r, using inline", payment_mode)
+        payment_mode = "inline"
+    if payment_mode == "thread" and sockets is not None:
+        # Рабочие процессы делят один сокет; отдельный поток в каждом занял бы порт повторно
+        logger.error("PAYMENT_SERVER_MODE=thread is not supported with BOT_WORKERS>1, using inline")
+        payment_mode = "inline"
+    if payment_mode == "thread" and use_webhook and PAYMENT_WEBHOOK_PORT == WEBHOOK_PORT:
+        logger.error("PAYMENT_SERVER_MODE=thread with webhook updates needs a separate PAYMENT_WEBHOOK_PORT, using inline")
+        payment_mode = "inline"
+    payment_queue = payment_mode != "inline"
 
-    bot_task = asyncio.create_task(run_bot(bot))
-    webhook_task = asyncio.create_task(run_webhook(bot))
+    main_tasks = []
+    if use_webhook:
+        main_tasks.append(asyncio.create_task(supervise(
+            "Webhook server", lambda: run_webhook(bot, dp, sockets, telegram_secret, payment_queue)
+        )))
+    else:
+        main_tasks.append(asyncio.create_task(supervise("Polling", lambda: run_bot(bot, dp))))
+        if payment_mode == "inline":
+            main_tasks.append(asyncio.create_task(supervise(
+                "Webhook server", lambda: run_webhook(bot, sockets=sockets)
+            )))
+
+    payment_thread: PaymentServerThread | None = None
+    if payment_mode == "thread":
+        payment_thread = PaymentServerThread(WEBHOOK_HOST, PAYMENT_WEBHOOK_PORT)
+        payment_thread.start()
+    # Активация оплат из очереди: уведомления принимает поток/процесс сервера оплат
+    queue_task = (
+        asyncio.create_task(supervise("Payment queue", lambda: run_payment_queue_worker(bot)))
+        if payment_queue else None
+    )
 
     async def _reminder_loop() -> None:
         # Run immediately on start, then periodically
@@ -65,19 +176,89 @@ async def main():
             except Exception as e:
                 logger.error("Reminder run failed: %s", e)
 
-    reminders_task = asyncio.create_task(_reminder_loop())
+    # Напоминания и плановые бэкапы — синглтоны: их запускает только процесс-лидер.
+    # Имена пользователей каждый процесс сбрасывает сам (запись идемпотентна).
+    leader_task = asyncio.create_task(
+        LeaderElection().run([_reminder_loop, lambda: run_backup_schedule_loop(bot)])
+    )
+    usernames_task = asyncio.create_task(run_username_flush_loop())
+    loop_lag_task = asyncio.create_task(run_event_loop_lag_monitor())
 
     # Wait until any of tasks finishes (e.g., Ctrl+C)
     try:
-        await asyncio.wait([bot_task, webhook_task], return_when=asyncio.FIRST_COMPLETED)
+        await asyncio.wait(main_tasks, return_when=asyncio.FIRST_COMPLETED)
     finally:
-        reminders_task.cancel()
-        with contextlib.suppress(Exception):
-            await reminders_task
+        if payment_thread is not None:
+            payment_thread.stop()
+        for task in (*main_tasks, leader_task, usernames_task, loop_lag_task, queue_task):
+            if task is None:
+                continue
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
+        if payment_thread is not None:
+            await asyncio.to_thread(payment_thread.join, 10)
         await bot.session.close()
 
 
+def _worker_main(sock: socket.socket, telegram_secret: str) -> None:
+    asyncio.run(main(sockets=[sock], telegram_secret=telegram_secret))
+
+
+def run_workers(count: int) -> None:
+    """Запустить count процессов на общем сокете и перезапускать упавшие."""
+    sock = socket.socket(socket.AF_INET6 if ":" in WEBHOOK_HOST else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((WEBHOOK_HOST, WEBHOOK_PORT))
+    sock.set_inheritable(True)
+    # Все процессы должны регистрировать вебхук с одним и тем же секретом
+    telegram_secret = TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    ctx = multiprocessing.get_context("spawn")
+    stopping = False
+
+    def _stop(*_: object) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    def _spawn() -> multiprocessing.Process:
+        process = ctx.Process(target=_worker_main, args=(sock, telegram_secret), daemon=False)
+        process.start()
+        return process
+
+    logger.info("Starting %d worker processes on %s:%s", count, WEBHOOK_HOST, WEBHOOK_PORT)
+    workers = [_spawn() for _ in range(count)]
+    try:
+        while not stopping:
+            time.sleep(1)
+            for index, process in enumerate(workers):
+                if not stopping and not process.is_alive():
+                    logger.error("Worker %s exited with code %s, restarting", process.pid, process.exitcode)
+                    workers[index] = _spawn()
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join(timeout=15)
+        sock.close()
+
+
+def _can_run_workers() -> bool:
+    if TELEGRAM_UPDATES_MODE != "webhook" or not TELEGRAM_WEBHOOK_URL:
+        logger.error("BOT_WORKERS>1 requires TELEGRAM_UPDATES_MODE=webhook, running a single process")
+        return False
+    if not get_state_backend().shared:
+        logger.error("BOT_WORKERS>1 requires a shared SHARED_STATE_BACKEND, running a single process")
+        return False
+    return True
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_WORKERS > 1 and _can_run_workers():
+        run_workers(BOT_WORKERS)
+    else:
+        asyncio.run(main())
 
 
@@ -1,26 +1,177 @@
 import logging
+import time
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 import httpx
 from marzban import MarzbanAPI
 from marzban.models import UserCreate, UserModify, ProxySettings
 
+from config import (
+    MARZBAN_BATCH_CONCURRENCY,
+    MARZBAN_BREAKER_COOLDOWN,
+    MARZBAN_BREAKER_THRESHOLD,
+    MARZBAN_CONCURRENCY,
+    MARZBAN_HEDGE_DELAY,
+    MARZBAN_INTERACTIVE_CONCURRENCY,
+    MARZBAN_LIST_TIMEOUT,
+    MARZBAN_PAYMENT_CONCURRENCY,
+    MARZBAN_READ_RETRIES,
+    MARZBAN_READ_TIMEOUT,
+    MARZBAN_RETRY_BACKOFF,
+    MARZBAN_WRITE_TIMEOUT,
+    USER_CACHE_SIZE,
+)
 from utils.crypto_link import encrypt_subscription_url
 from utils.helpers import extract_referrer_id
+from utils import stats
+from utils.metrics import (
+    HAPP_SECONDS,
+    MARZBAN_ADMISSION_WAIT,
+    MARZBAN_ERRORS,
+    MARZBAN_HEDGED,
+    MARZBAN_REJECTED,
+    MARZBAN_RETRIES,
+    MARZBAN_SECONDS,
+    cache_hit,
+    register_collector,
+    timed_method,
+)
+from utils.admission import BATCH, INTERACTIVE, PAYMENT, PRIORITIES, AdmissionController, with_traffic_class
+from utils.resilience import CallPolicy, CircuitBreaker, CircuitOpenError, ResilientCaller, is_transient
+from utils.shared_state import SharedCache
 
 logger = logging.getLogger(__name__)
 
 
+# Последние известные профили (общие для всех экземпляров сервиса и, с общим бэкендом,
+# для всех процессов): telegram_id -> [профиль, время получения].
+# Экран подписки показывает их сразу и тогда, когда панель недоступна.
+_known_users = SharedCache("user_info", ttl=24 * 60 * 60, max_size=USER_CACHE_SIZE)
+# Зашифрованные Happ-ссылки: url -> ссылка. Результат для url не меняется, поэтому
+# он запоминается и локально, а в общем хранилище живёт неделю
+_encrypted_urls = SharedCache("happ_url", ttl=7 * 24 * 60 * 60, max_size=USER_CACHE_SIZE, local_first=True)
+
+
+async def _remember_user(telegram_id: int, info: Dict[str, Any]) -> None:
+    await _known_users.set(telegram_id, [info, time.time()])
+
+
+async def get_cached_user_info(telegram_id: int) -> Optional[tuple[Dict[str, Any], float]]:
+    """Последний полученный из панели профиль и unix-время его получения (без запроса в панель)."""
+    cached = await _known_users.get(telegram_id)
+    cache_hit("user_info", cached is not None)
+    return (cached[0], cached[1]) if cached is not None else None
+
+
+def _is_not_found(error: Exception) -> bool:
+    return isinstance(error, httpx.HTTPStatusError) and error.response is not None and error.response.status_code == 404
+
+
+# Один breaker на панель для всех экземпляров сервиса: сбои, замеченные одним хендлером,
+# избавляют остальные от ожидания таймаутов
+_breaker = CircuitBreaker("marzban", MARZBAN_BREAKER_THRESHOLD, MARZBAN_BREAKER_COOLDOWN)
+_caller = ResilientCaller(
+    _breaker,
+    retries=MARZBAN_READ_RETRIES,
+    backoff=MARZBAN_RETRY_BACKOFF,
+    hedge_delay=MARZBAN_HEDGE_DELAY,
+    on_retry=MARZBAN_RETRIES.inc,
+    on_hedge=MARZBAN_HEDGED.inc,
+)
+
+# Политики по методам MarzbanAPI; всё, чего нет в таблице, считается изменением
+_READ_POLICY = CallPolicy(MARZBAN_READ_TIMEOUT, idempotent=True)
+_WRITE_POLICY = CallPolicy(MARZBAN_WRITE_TIMEOUT)
+_CALL_POLICIES = {
+    "get_token": _READ_POLICY,
+    "get_user": CallPolicy(MARZBAN_READ_TIMEOUT, idempotent=True, hedge=True),
+    "get_users": CallPolicy(MARZBAN_LIST_TIMEOUT, idempotent=True),
+    "get_hosts": _READ_POLICY,
+    "get_inbounds": _READ_POLICY,
+}
+# Локальные операции клиента, не обращающиеся к панели
+_PASSTHROUGH = frozenset({"close"})
+
+_BREAKER_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+register_collector(
+    "marzban_circuit_state",
+    "Marzban circuit breaker state (0 closed, 1 half-open, 2 open)",
+    lambda: {(): _BREAKER_STATES[_breaker.state]},
+)
+
+
+# Общий бюджет параллельных запросов: фоновые проходы по пользователям не вытесняют
+# оплаты и запросы живых пользователей (класс трафика — из контекста вызова)
+_admission = AdmissionController(
+    MARZBAN_CONCURRENCY,
+    {
+        PAYMENT: MARZBAN_PAYMENT_CONCURRENCY,
+        INTERACTIVE: MARZBAN_INTERACTIVE_CONCURRENCY,
+        BATCH: MARZBAN_BATCH_CONCURRENCY,
+    },
+    on_wait=MARZBAN_ADMISSION_WAIT.observe,
+)
+register_collector(
+    "marzban_in_flight",
+    "Marzban API calls in flight and waiting for a slot",
+    lambda: {
+        **{(cls, "active"): _admission.active[cls] for cls in PRIORITIES},
+        **{(cls, "waiting"): _admission.waiting(cls) for cls in PRIORITIES},
+    },
+    ("traffic", "state"),
+)
+
+
+def get_panel_health() -> Dict[str, Any]:
+    """Состояние circuit breaker панели (для админов и диагностики)."""
+    return _breaker.snapshot()
+
+
+def _resilient(name: str, fn: Any) -> Any:
+    policy = _CALL_POLICIES.get(name, _WRITE_POLICY)
+
+    async def call(*args: Any, **kwargs: Any) -> Any:
+        try:
+            if _breaker.retry_in() > 0:
+                # Панель заведомо недоступна — не занимаем очередь за слотом
+                raise CircuitOpenError(f"{_breaker.name}: circuit open")
+            async with _admission.slot():
+                return await _caller.call(name, policy, fn, *args, **kwargs)
+        except CircuitOpenError:
+            MARZBAN_REJECTED.inc(name)
+            raise
+
+    return call
+
+
+class _InstrumentedAPI:
+    """Прокси к MarzbanAPI: политика устойчивости, время и ошибки каждого запроса с меткой api.<метод>."""
+
+    def __init__(self, api: MarzbanAPI):
+        self._api = api
+        self._wrapped: Dict[str, Any] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            attr = getattr(self._api, name)
+            if not callable(attr) or name in _PASSTHROUGH:
+                return attr
+            wrapped = self._wrapped[name] = timed_method(
+                MARZBAN_SECONDS, MARZBAN_ERRORS, label=f"api.{name}"
+            )(_resilient(name, attr))
+        return wrapped
+
+
 class MarzbanService:
     def __init__(self, base_url: str, username: str, password: str):
         self.base_url = base_url
         self.username = username
         self.password = password
-        self.api = MarzbanAPI(base_url=base_url)
+        self.api = _InstrumentedAPI(MarzbanAPI(base_url=base_url))
         self.token: Optional[str] = None
         self.token_expires: Optional[datetime] = None
-        self._encrypted_cache: dict[str, str] = {}
 
     async def _encrypt_subscription_url(
         self, url: Optional[str]
@@ -28,17 +179,73 @@ class MarzbanService:
         if not url:
             return None, None
 
-        cached = self._encrypted_cache.get(url)
+        cached = await _encrypted_urls.get(url)
+        cache_hit("happ_url", bool(cached))
         if cached:
             return cached, url
 
+        started = time.perf_counter()
         encrypted = await encrypt_subscription_url(url)
-        if not encrypted:
-            encrypted = url
-
-        self._encrypted_cache[url] = encrypted
+        # Happ API при ошибке возвращает исходную ссылку
+        HAPP_SECONDS.observe(
+            time.perf_counter() - started, "ok" if encrypted and encrypted != url else "fallback"
+        )
+        if not encrypted or encrypted == url:
+            # Сбой Happ не запоминаем: иначе исходная ссылка надолго осталась бы в общем кэше
+            return url, url
+
+        await _encrypted_urls.set(url, encrypted)
         return encrypted, url
-        
+
+    async def _user_to_dict(self, user: Any) -> Dict[str, Any]:
+        """Привести ответ Marzban (UserResponse) к словарю, который используют хендлеры."""
+        encrypted_url, plain_url = await self._encrypt_subscription_url(
+            getattr(user, "subscription_url", None)
+        )
+        return {
+            "username": getattr(user, "username", None),
+            "status": getattr(user, "status", None),
+            "expire": getattr(user, "expire", None),
+            "data_limit": getattr(user, "data_limit", None),
+            "used_traffic": getattr(user, "used_traffic", None),
+            "subscription_url": encrypted_url,
+            "subscription_url_plain": plain_url,
+            "note": getattr(user, "note", None),
+        }
+
+    @staticmethod
+    async def _remember(telegram_id: int, info: Dict[str, Any]) -> Dict[str, Any]:
+        await _remember_user(telegram_id, info)
+        return info
+
+    async def _write_verified(
+        self,
+        username: str,
+        token: str,
+        write: Callable[[], Awaitable[Any]],
+        applied: Callable[[Any], bool],
+    ) -> Any:
+        """Запись в панель; при таймауте или обрыве связи проверяет, не применилась ли она.
+
+        Запрос мог дойти до панели, а оборвался только ответ: тогда сообщать об ошибке
+        (и повторять оплату или продление) нельзя. Возвращает ответ записи либо
+        перечитанного пользователя, если applied(user) подтверждает изменение.
+        """
+        try:
+            return await write()
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            try:
+                user = await self.api.get_user(username=username, token=token)
+            except Exception as check_error:
+                logger.warning("Could not verify write for %s after %r: %s", username, e, check_error)
+                raise e
+            if not applied(user):
+                raise
+            logger.warning("Write for %s reported %r but was applied", username, e)
+            return user
+
     async def get_token(self) -> str:
         """Получение и обновление токена"""
         if not self.token or (self.token_expires and datetime.now() >= self.token_expires):
@@ -56,30 +263,44 @@ class MarzbanService:
                 raise
         return self.token
 
-    async def get_user_info(self, telegram_id: int) -> Optional[Dict[str, Any]]:
-        """Получение информации о пользователе по Telegram ID"""
+    async def _load_user_info(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         try:
             token = await self.get_token()
             username = f"tg_{telegram_id}"
-            
             user_info = await self.api.get_user(username=username, token=token)
-            encrypted_url, plain_url = await self._encrypt_subscription_url(
-                user_info.subscription_url
-            )
-            return {
-                "username": user_info.username,
-                "status": user_info.status,
-                "expire": user_info.expire,
-                "data_limit": user_info.data_limit,
-                "used_traffic": user_info.used_traffic,
-                "subscription_url": encrypted_url,
-                "subscription_url_plain": plain_url,
-                "note": getattr(user_info, "note", None),
-            }
         except Exception as e:
+            if _is_not_found(e):
+                await _known_users.delete(telegram_id)
+                return None
+            raise
+        info = await self._user_to_dict(user_info)
+        await _remember_user(telegram_id, info)
+        return info
+
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
+    async def get_user_info(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Получение информации о пользователе по Telegram ID.
+
+        Если панель недоступна, возвращает последний известный профиль с пометками
+        stale=True и fetched_at (unix-время получения), иначе None.
+        """
+        try:
+            return await self._load_user_info(telegram_id)
+        except Exception as e:
+            # Панель недоступна — последний известный профиль лучше, чем «подписки нет»
+            cached = await _known_users.get(telegram_id)
+            if cached is not None:
+                logger.warning(f"Using cached profile for {telegram_id}: {e}")
+                return {**cached[0], "stale": True, "fetched_at": cached[1]}
             logger.warning(f"User {telegram_id} not found: {e}")
             return None
 
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
+    async def fetch_user_info(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Как get_user_info, но различает «пользователя нет» (None) и недоступную панель (исключение)."""
+        return await self._load_user_info(telegram_id)
+
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
     async def create_user(self, telegram_id: int, plan: Dict[str, Any], note: Optional[str] = None) -> Dict[str, Any]:
         """Создание нового пользователя"""
         try:
@@ -102,23 +323,25 @@ class MarzbanService:
                 note=note,
             )
             
-            created_user = await self.api.add_user(user=new_user, token=token)
-            encrypted_url, plain_url = await self._encrypt_subscription_url(
-                created_user.subscription_url
+            created_user = await self._write_verified(
+                username,
+                token,
+                lambda: self.api.add_user(user=new_user, token=token),
+                lambda user: (user.expire or 0) >= new_user.expire,
             )
-            
-            return {
-                "username": created_user.username,
-                "subscription_url": encrypted_url,
-                "subscription_url_plain": plain_url,
-                "expire": created_user.expire
-            }
+            await stats.record_user_created(
+                telegram_id, created_user.expire, trial=bool(plan.get("trial"))
+            )
+            return await self._remember(telegram_id, await self._user_to_dict(created_user))
         except Exception as e:
             logger.error(f"Failed to create user {telegram_id}: {e}")
             raise
 
-    async def extend_subscription(self, telegram_id: int, plan: Dict[str, Any]) -> Dict[str, Any]:
-        """Продление подписки существующего пользователя"""
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
+    async def extend_subscription(
+        self, telegram_id: int, plan: Dict[str, Any], paid: bool = False
+    ) -> Dict[str, Any]:
+        """Продление подписки существующего пользователя (paid — продление оплатой)"""
         try:
             token = await self.get_token()
             username = f"tg_{telegram_id}"
@@ -139,25 +362,19 @@ class MarzbanService:
                 status="active"
             )
             
-            modified_user = await self.api.modify_user(
-                username=username, 
-                user=user_modify, 
-                token=token
-            )
-            encrypted_url, plain_url = await self._encrypt_subscription_url(
-                modified_user.subscription_url
+            modified_user = await self._write_verified(
+                username,
+                token,
+                lambda: self.api.modify_user(username=username, user=user_modify, token=token),
+                lambda user: (user.expire or 0) >= user_modify.expire,
             )
-            
-            return {
-                "username": modified_user.username,
-                "subscription_url": encrypted_url,
-                "subscription_url_plain": plain_url,
-                "expire": modified_user.expire
-            }
+            await stats.record_user_extended(telegram_id, modified_user.expire, paid=paid)
+            return await self._remember(telegram_id, await self._user_to_dict(modified_user))
         except Exception as e:
             logger.error(f"Failed to extend subscription for {telegram_id}: {e}")
             raise
 
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
     async def extend_by_days(self, telegram_id: int, days: int) -> Dict[str, Any]:
         """Продлить подписку на указанное количество дней."""
         try:
@@ -176,39 +393,42 @@ class MarzbanService:
                 status="active"
             )
 
-            modified_user = await self.api.modify_user(
-                username=username,
-                user=user_modify,
-                token=token,
+            modified_user = await self._write_verified(
+                username,
+                token,
+                lambda: self.api.modify_user(username=username, user=user_modify, token=token),
+                lambda user: (user.expire or 0) >= user_modify.expire,
             )
-            encrypted_url, plain_url = await self._encrypt_subscription_url(
-                modified_user.subscription_url
-            )
-
-            return {
-                "username": modified_user.username,
-                "subscription_url": encrypted_url,
-                "subscription_url_plain": plain_url,
-                "expire": modified_user.expire,
-            }
+            await stats.record_user_extended(telegram_id, modified_user.expire)
+            return await self._remember(telegram_id, await self._user_to_dict(modified_user))
         except Exception as e:
             logger.error(f"Failed to extend by days for {telegram_id}: {e}")
             raise
 
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
     async def set_user_note(self, telegram_id: int, note: str) -> bool:
         """Установить комментарий (note) у пользователя."""
         try:
             token = await self.get_token()
             username = f"tg_{telegram_id}"
             user_modify = UserModify(note=note)
-            await self.api.modify_user(username=username, user=user_modify, token=token)
+            await self._write_verified(
+                username,
+                token,
+                lambda: self.api.modify_user(username=username, user=user_modify, token=token),
+                lambda user: user.note == note,
+            )
             return True
         except Exception as e:
             logger.error(f"Failed to set note for {telegram_id}: {e}")
             return False
 
-    async def expire_user(self, telegram_id: int) -> bool:
-        """Перевести пользователя в статус expired и завершить подписку."""
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
+    async def expire_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Перевести пользователя в статус expired и завершить подписку.
+
+        Возвращает актуальные данные пользователя после изменения или None при ошибке.
+        """
         username = f"tg_{telegram_id}"
         try:
             token = await self.get_token()
@@ -230,12 +450,14 @@ class MarzbanService:
 
             now_ts = int(datetime.now().timestamp()) - 30
             user_modify = UserModify(expire=now_ts)
-            await self.api.modify_user(
-                username=username,
-                user=user_modify,
-                token=token,
+            modified_user = await self._write_verified(
+                username,
+                token,
+                lambda: self.api.modify_user(username=username, user=user_modify, token=token),
+                lambda user: user.expire is not None and user.expire <= now_ts,
             )
-            return True
+            await stats.record_user_expired(telegram_id, modified_user.expire)
+            return await self._remember(telegram_id, await self._user_to_dict(modified_user))
         except httpx.HTTPStatusError as e:
             detail = ""
             if e.response is not None:
@@ -249,11 +471,13 @@ class MarzbanService:
                 e,
                 detail,
             )
-            return False
+            return None
         except Exception as e:
             logger.error(f"Failed to expire user {telegram_id}: {e}")
-            return False
+            return None
 
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
+    @with_traffic_class(BATCH)
     async def count_referrals_for(self, referrer_id: int) -> int:
         """Подсчитать число пользователей, у которых note начинается с ref:<referrer_id>."""
         try:
@@ -282,6 +506,7 @@ class MarzbanService:
             logger.error(f"Failed to count referrals for {referrer_id}: {e}")
             return 0
 
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
     async def get_inbound_locations(self) -> list[str]:
         """Получить список локаций (по remark/tag) из inbounds/hosts."""
         try:
@@ -355,6 +580,8 @@ class MarzbanService:
         """Закрытие API клиента"""
         await self.api.close()
 
+    @timed_method(MARZBAN_SECONDS, MARZBAN_ERRORS)
+    @with_traffic_class(BATCH)
     async def list_all_users(self) -> list[Dict[str, Any]]:
         """Вернуть плоский список всех пользователей из Marzban.
 
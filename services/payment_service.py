@@ -30,6 +30,22 @@ class PaymentService:
         
         return f"{self.payment_url}?{urlencode(params)}"
 
+    def notification_signature(self, data: Dict[str, Any]) -> str:
+        """sha1_hash, который YooMoney передаёт для этих полей уведомления."""
+        parts = [
+            data.get('notification_type', ''),
+            data.get('operation_id', ''),
+            data.get('amount', ''),
+            data.get('currency', ''),
+            data.get('datetime', ''),
+            data.get('sender', ''),
+            data.get('codepro', ''),
+            self.notification_secret or '',
+            data.get('label', ''),
+        ]
+        sign_string = "&".join(parts)
+        return hashlib.sha1(sign_string.encode('utf-8')).hexdigest().lower()
+
     def verify_notification(self, data: Dict[str, Any]) -> bool:
         """Проверка подлинности уведомления от YooMoney (Quickpay HTTP-уведомления).
 
@@ -37,19 +53,7 @@ class PaymentService:
         sha1("notification_type&operation_id&amount&currency&datetime&sender&codepro&notification_secret&label")
         """
         try:
-            parts = [
-                data.get('notification_type', ''),
-                data.get('operation_id', ''),
-                data.get('amount', ''),
-                data.get('currency', ''),
-                data.get('datetime', ''),
-                data.get('sender', ''),
-                data.get('codepro', ''),
-                self.notification_secret or '',
-                data.get('label', ''),
-            ]
-            sign_string = "&".join(parts)
-            expected_sha1 = hashlib.sha1(sign_string.encode('utf-8')).hexdigest().lower()
+            expected_sha1 = self.notification_signature(data)
             received_sha1 = (data.get('sha1_hash') or '').lower()
             ok = hmac.compare_digest(expected_sha1, received_sha1)
             if not ok:
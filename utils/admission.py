@@ -0,0 +1,127 @@
+"""Общий бюджет параллельных запросов к внешнему сервису с приоритетами классов трафика.
+
+Каждый запрос занимает слот своего класса: payment (активация оплат), interactive
+(запросы живых пользователей) и batch (фоновые проходы по всем пользователям).
+У класса свой предел параллельности, у всех вместе — общий. Освободившийся слот
+достаётся ожидающим строго по приоритету payment > interactive > batch, поэтому
+фоновая синхронизация не занимает панель, пока её ждёт покупатель, а маленький
+предел batch оставляет запас слотов для остальных.
+
+Класс берётся из контекста (contextvars): по умолчанию interactive, фоновые задачи
+и обработка оплат помечают себя через traffic_class() или with_traffic_class().
+Контекст наследуется задачами, созданными внутри (asyncio.gather, create_task).
+"""
+import asyncio
+import contextlib
+import functools
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, Mapping, Optional
+
+PAYMENT = "payment"
+INTERACTIVE = "interactive"
+BATCH = "batch"
+# Порядок выдачи освободившихся слотов
+PRIORITIES = (PAYMENT, INTERACTIVE, BATCH)
+
+_current_class: ContextVar[str] = ContextVar("traffic_class", default=INTERACTIVE)
+
+
+def current_traffic_class() -> str:
+    return _current_class.get()
+
+
+@contextlib.contextmanager
+def traffic_class(name: str) -> Iterator[None]:
+    """Запросы внутри блока (и в задачах, созданных в нём) идут в бюджет класса name."""
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown traffic class: {name}")
+    token = _current_class.set(name)
+    try:
+        yield
+    finally:
+        _current_class.reset(token)
+
+
+def with_traffic_class(name: str):
+    """Декоратор async-функции: вся её работа с панелью идёт в бюджет класса name."""
+    def decorator(fn: Callable[..., Awaitable[Any]]):
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with traffic_class(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class AdmissionController:
+    """Слоты с общим пределом total и пределами по классам; очередь ожидания по приоритету."""
+
+    def __init__(
+        self,
+        total: int,
+        limits: Mapping[str, int],
+        on_wait: Optional[Callable[[float, str], None]] = None,
+    ):
+        self.total = max(1, total)
+        self.limits = {cls: max(1, min(self.total, limits.get(cls, self.total))) for cls in PRIORITIES}
+        self.active: Dict[str, int] = {cls: 0 for cls in PRIORITIES}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {cls: deque() for cls in PRIORITIES}
+        self._on_wait = on_wait
+
+    def _fits(self, cls: str) -> bool:
+        return sum(self.active.values()) < self.total and self.active[cls] < self.limits[cls]
+
+    def _wake(self) -> None:
+        # Ожидающий низкого класса проходит вперёд, только если более приоритетные
+        # упираются в собственный предел, а не в общий
+        for cls in PRIORITIES:
+            waiters = self._waiters[cls]
+            while waiters and self._fits(cls):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self.active[cls] += 1
+                future.set_result(None)
+
+    async def acquire(self, cls: str) -> None:
+        waiters = self._waiters[cls]
+        # Без очереди — только если никто с тем же или более высоким приоритетом не ждёт
+        if self._fits(cls) and not any(self._waiters[c] for c in PRIORITIES[: PRIORITIES.index(cls) + 1]):
+            self.active[cls] += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        # Ждущие выше по приоритету могут упираться лишь в свой предел — тогда слот наш
+        self._wake()
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ждавший отменён — возвращаем его
+                self.release(cls)
+            else:
+                with contextlib.suppress(ValueError):
+                    waiters.remove(future)
+            raise
+        finally:
+            if self._on_wait is not None:
+                self._on_wait(time.perf_counter() - started, cls)
+
+    def release(self, cls: str) -> None:
+        self.active[cls] -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cls: Optional[str] = None) -> AsyncIterator[None]:
+        cls = cls or current_traffic_class()
+        await self.acquire(cls)
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    def waiting(self, cls: str) -> int:
+        return sum(1 for future in self._waiters[cls] if not future.done())
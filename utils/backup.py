@@ -1,9 +1,20 @@
 import asyncio
+import hashlib
 import os
 import re
-from typing import Tuple, Optional, List
+import shutil
+import tempfile
+from typing import NamedTuple, Tuple, Optional, List
 
-def _find_latest_backup(candidates: List[str]) -> Optional[str]:
+_READ_CHUNK = 1024 * 1024
+
+
+class BackupVolume(NamedTuple):
+    path: str
+    size: int
+    sha256: str
+
+def _find_latest_backup(candidates: List[str], since: Optional[float] = None) -> Optional[str]:
     latest_path = None
     latest_mtime = -1.0
     exts = (".tar.gz", ".tgz", ".zip")
@@ -17,6 +28,9 @@ def _find_latest_backup(candidates: List[str]) -> Optional[str]:
                 path = os.path.join(dirpath, name)
                 try:
                     mtime = os.path.getmtime(path)
+                    # Архивы старше since (оставшиеся от прошлых запусков) не рассматриваем
+                    if since is not None and mtime < since:
+                        continue
                     if mtime > latest_mtime:
                         latest_mtime = mtime
                         latest_path = path
@@ -25,7 +39,12 @@ def _find_latest_backup(candidates: List[str]) -> Optional[str]:
     return latest_path
 
 
-async def run_marzban_backup() -> Tuple[bool, str, Optional[str]]:
+async def run_marzban_backup(since: Optional[float] = None) -> Tuple[bool, str, Optional[str]]:
+    """Запустить `marzban backup`: (успех, вывод, путь к архиву или None).
+
+    Путь берётся из вывода команды, иначе — самый свежий архив в типичных каталогах.
+    С since (unix-время) поиск принимает только архивы, изменённые не раньше since.
+    """
     try:
         # Run command; assume bot runs on same server and marzban in PATH or service.
         proc = await asyncio.create_subprocess_shell(
@@ -50,7 +69,70 @@ async def run_marzban_backup() -> Tuple[bool, str, Optional[str]]:
                 "/opt/marzban",
                 os.path.expanduser("~/backups"),
             ]
-            path = _find_latest_backup(candidates)
+            # os.walk по нескольким каталогам — в отдельном потоке, чтобы не блокировать event loop
+            path = await asyncio.to_thread(_find_latest_backup, candidates, since)
         return (proc.returncode == 0, output, path)
     except Exception as e:
         return (False, str(e), None)
+
+
+def split_backup_archive(path: str, volume_size: int) -> Tuple[List[BackupVolume], str]:
+    """Разбить архив на тома не больше volume_size байт и посчитать SHA-256.
+
+    Возвращает (тома, sha256 всего архива). Если архив помещается в один том,
+    он не копируется. Блокирующая функция — вызывать через asyncio.to_thread.
+    """
+    total_size = os.path.getsize(path)
+    whole = hashlib.sha256()
+    if total_size <= volume_size:
+        with open(path, "rb") as src:
+            while chunk := src.read(_READ_CHUNK):
+                whole.update(chunk)
+        digest = whole.hexdigest()
+        return [BackupVolume(path, total_size, digest)], digest
+
+    out_dir = tempfile.mkdtemp(prefix="marzban-backup-")
+    base_name = os.path.basename(path)
+    volumes: List[BackupVolume] = []
+    try:
+        with open(path, "rb") as src:
+            index = 0
+            while True:
+                index += 1
+                part_path = os.path.join(out_dir, f"{base_name}.part{index:03d}")
+                part_hash = hashlib.sha256()
+                written = 0
+                with open(part_path, "wb") as dst:
+                    while written < volume_size:
+                        chunk = src.read(min(_READ_CHUNK, volume_size - written))
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        part_hash.update(chunk)
+                        whole.update(chunk)
+                        written += len(chunk)
+                if written == 0:
+                    os.remove(part_path)
+                    break
+                volumes.append(BackupVolume(part_path, written, part_hash.hexdigest()))
+                if written < volume_size:
+                    break
+    except Exception:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+    return volumes, whole.hexdigest()
+
+
+def cleanup_backup_volumes(archive_path: str, volumes: List[BackupVolume]) -> None:
+    """Удалить временные тома (сам архив не трогаем)."""
+    dirs = set()
+    for volume in volumes:
+        if volume.path == archive_path:
+            continue
+        dirs.add(os.path.dirname(volume.path))
+        try:
+            os.remove(volume.path)
+        except OSError:
+            pass
+    for directory in dirs:
+        shutil.rmtree(directory, ignore_errors=True)
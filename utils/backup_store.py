@@ -0,0 +1,378 @@
+"""Инкрементальное хранилище бэкапов Marzban с дедупликацией по содержимому.
+
+Каждый архив, созданный `marzban backup`, раскладывается по файлам, а содержимое
+файлов режется на блоки фиксированного размера. Блок хранится один раз под именем
+своего SHA-256 (chunks/ab/abcd...), снимок — это JSON-манифест со списком блоков.
+Так ночные бэкапы почти не изменившейся базы записывают только изменённые блоки
+(SQLite меняет страницы точечно), а сжатие tar.gz этому не мешает — режем
+распакованное содержимое.
+
+Восстановление: python -m utils.backup_store restore <snapshot> <out.tar.gz>
+"""
+import asyncio
+import hashlib
+import html
+import io
+import json
+import logging
+import os
+import sys
+import tarfile
+import time
+import zlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from aiogram import Bot
+
+from config import (
+    ADMIN_IDS,
+    BACKUP_CHUNK_SIZE,
+    BACKUP_RETENTION,
+    BACKUP_SCHEDULE_HOURS,
+    BACKUP_STORE_DIR,
+    MESSAGES,
+)
+from utils.backup import run_marzban_backup
+
+
+logger = logging.getLogger(__name__)
+
+_MTIME_SLACK = 2.0
+_FAILED_RETRY = 60 * 60
+
+
+def _chunks_dir(store_dir: str) -> str:
+    return os.path.join(store_dir, "chunks")
+
+
+def _snapshots_dir(store_dir: str) -> str:
+    return os.path.join(store_dir, "snapshots")
+
+
+def _chunk_path(store_dir: str, digest: str) -> str:
+    return os.path.join(_chunks_dir(store_dir), digest[:2], digest)
+
+
+def _format_bytes(value: int) -> str:
+    size = float(value)
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{value} Б"
+
+
+def _put_chunk(store_dir: str, data: bytes, stats: Dict[str, int]) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    path = _chunk_path(store_dir, digest)
+    if os.path.exists(path):
+        stats["reused_chunks"] += 1
+        stats["reused_bytes"] += len(data)
+        return digest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    packed = zlib.compress(data, 6)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(packed)
+    os.replace(tmp_path, path)
+    stats["new_chunks"] += 1
+    stats["new_bytes"] += len(data)
+    stats["stored_bytes"] += len(packed)
+    return digest
+
+
+def _store_stream(store_dir: str, stream, stats: Dict[str, int], chunk_size: int) -> List[str]:
+    digests: List[str] = []
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        stats["logical_bytes"] += len(data)
+        digests.append(_put_chunk(store_dir, data, stats))
+    return digests
+
+
+def store_snapshot(
+    archive_path: str,
+    store_dir: str = BACKUP_STORE_DIR,
+    chunk_size: int = BACKUP_CHUNK_SIZE,
+) -> Dict[str, Any]:
+    """Положить архив в хранилище. Блокирующая функция — вызывать через asyncio.to_thread."""
+    started = time.monotonic()
+    os.makedirs(_snapshots_dir(store_dir), exist_ok=True)
+    stats = {
+        "files": 0,
+        "logical_bytes": 0,
+        "new_chunks": 0,
+        "new_bytes": 0,
+        "stored_bytes": 0,
+        "reused_chunks": 0,
+        "reused_bytes": 0,
+    }
+    entries: List[Dict[str, Any]] = []
+    if tarfile.is_tarfile(archive_path):
+        kind = "tar"
+        with tarfile.open(archive_path, "r:*") as tar:
+            for member in tar:
+                entry: Dict[str, Any] = {
+                    "name": member.name,
+                    "mode": member.mode,
+                    "mtime": member.mtime,
+                }
+                if member.isdir():
+                    entry["type"] = "dir"
+                elif member.issym() or member.islnk():
+                    entry["type"] = "symlink" if member.issym() else "link"
+                    entry["linkname"] = member.linkname
+                elif member.isfile():
+                    entry["type"] = "file"
+                    entry["size"] = member.size
+                    fileobj = tar.extractfile(member)
+                    entry["chunks"] = _store_stream(store_dir, fileobj, stats, chunk_size) if fileobj else []
+                    stats["files"] += 1
+                else:
+                    continue
+                entries.append(entry)
+    else:
+        # zip и прочие форматы храним как один поток байт
+        kind = "raw"
+        with open(archive_path, "rb") as f:
+            chunks = _store_stream(store_dir, f, stats, chunk_size)
+        entries.append({
+            "name": os.path.basename(archive_path),
+            "type": "file",
+            "size": stats["logical_bytes"],
+            "chunks": chunks,
+        })
+        stats["files"] = 1
+
+    name = datetime.now().strftime("%Y%m%d_%H%M%S")
+    manifest = {
+        "name": name,
+        "created_at": int(time.time()),
+        "source": os.path.basename(archive_path),
+        "kind": kind,
+        "entries": entries,
+    }
+    manifest_path = os.path.join(_snapshots_dir(store_dir), f"{name}.json")
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+    stats["snapshot"] = name
+    stats["duration"] = round(time.monotonic() - started, 2)
+    return stats
+
+
+def list_snapshots(store_dir: str = BACKUP_STORE_DIR) -> List[str]:
+    directory = _snapshots_dir(store_dir)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(n[:-5] for n in os.listdir(directory) if n.endswith(".json"))
+
+
+def _load_manifest(store_dir: str, name: str) -> Dict[str, Any]:
+    with open(os.path.join(_snapshots_dir(store_dir), f"{name}.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def prune_snapshots(keep: int = BACKUP_RETENTION, store_dir: str = BACKUP_STORE_DIR) -> Dict[str, int]:
+    """Оставить keep последних снимков и удалить блоки, на которые больше никто не ссылается."""
+    names = list_snapshots(store_dir)
+    removed = 0
+    if keep > 0 and len(names) > keep:
+        for name in names[:-keep]:
+            try:
+                os.remove(os.path.join(_snapshots_dir(store_dir), f"{name}.json"))
+                removed += 1
+            except OSError:
+                continue
+        names = names[-keep:]
+
+    referenced: Set[str] = set()
+    for name in names:
+        for entry in _load_manifest(store_dir, name).get("entries", []):
+            referenced.update(entry.get("chunks") or [])
+
+    freed = 0
+    store_bytes = 0
+    chunks_root = _chunks_dir(store_dir)
+    if os.path.isdir(chunks_root):
+        for dirpath, _, filenames in os.walk(chunks_root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    size = os.path.getsize(path)
+                    if filename in referenced:
+                        store_bytes += size
+                    else:
+                        os.remove(path)
+                        freed += size
+                except OSError:
+                    continue
+    return {"removed_snapshots": removed, "freed_bytes": freed, "store_bytes": store_bytes}
+
+
+def restore_snapshot(name: str, out_path: str, store_dir: str = BACKUP_STORE_DIR) -> None:
+    """Собрать снимок обратно в архив (tar.gz, либо исходный файл для raw-снимков)."""
+    manifest = _load_manifest(store_dir, name)
+
+    def _iter_chunks(digests: List[str]):
+        for digest in digests:
+            with open(_chunk_path(store_dir, digest), "rb") as f:
+                yield zlib.decompress(f.read())
+
+    if manifest.get("kind") == "raw":
+        with open(out_path, "wb") as out:
+            for entry in manifest["entries"]:
+                for data in _iter_chunks(entry.get("chunks") or []):
+                    out.write(data)
+        return
+
+    class _ChunkReader(io.RawIOBase):
+        def __init__(self, digests: List[str]):
+            self._iter = _iter_chunks(digests)
+            self._buf = b""
+
+        def readable(self) -> bool:
+            return True
+
+        def readinto(self, b) -> int:
+            while not self._buf:
+                try:
+                    self._buf = next(self._iter)
+                except StopIteration:
+                    return 0
+            n = min(len(b), len(self._buf))
+            b[:n] = self._buf[:n]
+            self._buf = self._buf[n:]
+            return n
+
+    with tarfile.open(out_path, "w:gz") as tar:
+        for entry in manifest["entries"]:
+            info = tarfile.TarInfo(entry["name"])
+            info.mode = entry.get("mode", 0o644)
+            info.mtime = entry.get("mtime", manifest["created_at"])
+            kind = entry.get("type")
+            if kind == "dir":
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif kind in ("symlink", "link"):
+                info.type = tarfile.SYMTYPE if kind == "symlink" else tarfile.LNKTYPE
+                info.linkname = entry.get("linkname", "")
+                tar.addfile(info)
+            else:
+                info.size = entry.get("size", 0)
+                tar.addfile(info, io.BufferedReader(_ChunkReader(entry.get("chunks") or [])))
+
+
+def _is_fresh(path: str, since: float) -> bool:
+    try:
+        return os.path.getmtime(path) >= since
+    except OSError:
+        return False
+
+
+def last_snapshot_time(store_dir: str = BACKUP_STORE_DIR) -> Optional[float]:
+    """Unix-время создания последнего снимка или None, если снимков нет."""
+    names = list_snapshots(store_dir)
+    if not names:
+        return None
+    try:
+        return float(_load_manifest(store_dir, names[-1])["created_at"])
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Failed to read snapshot %s: %s", names[-1], e)
+        return None
+
+
+async def run_scheduled_backup(bot: Optional[Bot] = None) -> Optional[Dict[str, Any]]:
+    """Сделать бэкап, положить его в хранилище, почистить старые снимки и отчитаться админам."""
+    started = time.monotonic()
+    # Запас на грубую точность mtime файловой системы
+    run_started = time.time() - _MTIME_SLACK
+    ok, output, archive_path = await run_marzban_backup(since=run_started)
+    if ok and archive_path and not _is_fresh(archive_path, run_started):
+        # Путь из вывода указывает на старый архив: сохранять (и удалять) его нельзя
+        logger.error("Scheduled backup: %s was not created by this run", archive_path)
+        output = f"{output}\nАрхив этого запуска не найден ({archive_path} создан раньше)"
+        archive_path = None
+    if not ok or not archive_path:
+        logger.error("Scheduled backup failed: %s", output[:500])
+        await _notify_admins(bot, MESSAGES["backup_scheduled_failed"].format(error=html.escape(output[-500:]) or "—"))
+        return None
+    try:
+        stats = await asyncio.to_thread(store_snapshot, archive_path)
+        stats.update(await asyncio.to_thread(prune_snapshots))
+    except Exception as e:
+        logger.error("Failed to store backup snapshot: %s", e)
+        await _notify_admins(bot, MESSAGES["backup_scheduled_failed"].format(error=html.escape(str(e)[:500])))
+        return None
+    # Снимок уже в хранилище (и подчиняется BACKUP_RETENTION) — полный архив рядом не копим.
+    # При ошибке сохранения архив остаётся: другой копии бэкапа нет
+    try:
+        os.remove(archive_path)
+    except OSError as e:
+        logger.warning("Failed to remove stored backup archive %s: %s", archive_path, e)
+    stats["total_duration"] = round(time.monotonic() - started, 2)
+    logger.info("Scheduled backup stored: %s", stats)
+    await _notify_admins(bot, MESSAGES["backup_scheduled_report"].format(
+        snapshot=stats["snapshot"],
+        files=stats["files"],
+        logical=_format_bytes(stats["logical_bytes"]),
+        new=_format_bytes(stats["new_bytes"]),
+        new_chunks=stats["new_chunks"],
+        stored=_format_bytes(stats["stored_bytes"]),
+        reused=_format_bytes(stats["reused_bytes"]),
+        store=_format_bytes(stats["store_bytes"]),
+        removed=stats["removed_snapshots"],
+        duration=stats["total_duration"],
+    ))
+    return stats
+
+
+async def _notify_admins(bot: Optional[Bot], text: str) -> None:
+    if bot is None:
+        return
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(chat_id=admin_id, text=text)
+        except Exception as e:
+            logger.warning("Failed to send backup report to %s: %s", admin_id, e)
+
+
+async def run_backup_schedule_loop(bot: Bot) -> None:
+    if BACKUP_SCHEDULE_HOURS <= 0:
+        return
+    interval = BACKUP_SCHEDULE_HOURS * 60 * 60
+    # Неудачный запуск не создаёт снимка — повторяем не чаще, чем раз в retry
+    retry = min(interval, _FAILED_RETRY)
+    last_attempt = 0.0
+    while True:
+        try:
+            # Срок считаем от последнего снимка в хранилище, а не от старта процесса:
+            # рестарты и смена лидера чаще интервала не откладывают бэкап бесконечно
+            last_snapshot = await asyncio.to_thread(last_snapshot_time)
+            due = max((last_snapshot or 0.0) + interval, last_attempt + retry)
+            delay = due - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            last_attempt = time.time()
+            await run_scheduled_backup(bot)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error("Scheduled backup run failed: %s", e)
+            await asyncio.sleep(retry)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "list":
+        print("\n".join(list_snapshots()))
+    elif len(sys.argv) == 4 and sys.argv[1] == "restore":
+        restore_snapshot(sys.argv[2], sys.argv[3])
+    else:
+        print("usage: python -m utils.backup_store list | restore <snapshot> <out.tar.gz>")
+        sys.exit(2)
@@ -0,0 +1,100 @@
+"""Колбэки медленных экранов: сначала подтверждаем нажатие, потом считаем ответ.
+
+Хендлер, обёрнутый в ack_first, не редактирует сообщение сам, а возвращает
+(text, reply_markup). Декоратор сразу отвечает на колбэк (у пользователя пропадает
+индикатор загрузки, а запрос не упирается в таймаут answerCallbackQuery),
+запускает построение экрана и, если оно дольше CALLBACK_PLACEHOLDER_DELAY, заменяет
+сообщение заглушкой. Итоговый экран редактируется поверх — строго после заглушки,
+чтобы она не перетёрла готовый ответ.
+
+Третьим элементом можно вернуть refresh — корутинную функцию без аргументов. Она
+запускается в фоне после показа экрана и, если вернёт новый (text, reply_markup),
+сообщение обновляется ещё раз (stale-while-revalidate).
+"""
+import asyncio
+import functools
+import logging
+from typing import Awaitable, Callable, Optional, Set, Tuple, Union
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import BUTTONS, CALLBACK_PLACEHOLDER_DELAY, MESSAGES
+
+
+logger = logging.getLogger(__name__)
+
+Screen = Tuple[str, Optional[InlineKeyboardMarkup]]
+Refresh = Callable[[], Awaitable[Optional[Screen]]]
+ScreenWithRefresh = Tuple[str, Optional[InlineKeyboardMarkup], Refresh]
+
+# Фоновые обновления экранов (ссылки, чтобы задачи не собрал GC)
+_refresh_tasks: Set[asyncio.Task] = set()
+
+
+async def _edit(callback: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> None:
+    if callback.message is None:
+        return
+    try:
+        await callback.message.edit_text(text=text, reply_markup=reply_markup)
+    except TelegramBadRequest as err:
+        if "message is not modified" not in (err.message or "").lower():
+            raise
+
+
+def _failed_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text=BUTTONS["back"], callback_data="back_to_main")]]
+    )
+
+
+async def _run_refresh(callback: CallbackQuery, refresh: Refresh) -> None:
+    try:
+        screen = await refresh()
+        if screen is not None:
+            await _edit(callback, *screen)
+    except Exception as e:
+        logger.warning("Background screen refresh failed: %s", e)
+
+
+def ack_first(
+    build: Callable[[CallbackQuery], Awaitable[Union[Screen, ScreenWithRefresh]]],
+) -> Callable[[CallbackQuery], Awaitable[None]]:
+    """Декоратор хендлера колбэка: build(callback) возвращает (text, reply_markup[, refresh])."""
+
+    @functools.wraps(build)
+    async def handler(callback: CallbackQuery) -> None:
+        try:
+            await callback.answer()
+        except Exception as e:
+            logger.debug("Failed to answer callback early: %s", e)
+
+        task = asyncio.create_task(build(callback))
+        placeholder = False
+        done, _ = await asyncio.wait({task}, timeout=CALLBACK_PLACEHOLDER_DELAY)
+        if not done:
+            placeholder = True
+            try:
+                await _edit(callback, MESSAGES["loading"], None)
+            except Exception as e:
+                logger.debug("Failed to show placeholder: %s", e)
+
+        try:
+            screen = await task
+        except Exception:
+            # Заглушку нельзя оставлять висеть без кнопок
+            if placeholder:
+                try:
+                    await _edit(callback, MESSAGES["loading_failed"], _failed_keyboard())
+                except Exception:
+                    pass
+            raise
+        text, reply_markup = screen[0], screen[1]
+        await _edit(callback, text, reply_markup)
+        if len(screen) > 2:
+            refresh_task = asyncio.create_task(_run_refresh(callback, screen[2]))
+            _refresh_tasks.add(refresh_task)
+            refresh_task.add_done_callback(_refresh_tasks.discard)
+
+    return handler
+
@@ -0,0 +1,68 @@
+import asyncio
+import sqlite3
+import threading
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SQLiteDatabase:
+    """Небольшая обёртка над sqlite3 для использования из asyncio.
+
+    Все запросы выполняются в отдельном потоке (asyncio.to_thread), поэтому не блокируют
+    event loop. Одно соединение на процесс защищено блокировкой; WAL и busy_timeout
+    позволяют нескольким процессам работать с одним файлом.
+    """
+
+    def __init__(self, path: str, init_sql: str = ""):
+        self.path = path
+        self.init_sql = init_sql
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            if self.init_sql:
+                conn.executescript(self.init_sql)
+            self._conn = conn
+        return self._conn
+
+    def run_sync(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """Выполнить fn(conn) в транзакции (BEGIN IMMEDIATE ... COMMIT)."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    async def run(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        return await asyncio.to_thread(self.run_sync, fn)
+
+    def read_sync(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """Выполнить fn(conn) без явной транзакции: только для чтения, писателей не блокирует."""
+        with self._lock:
+            return fn(self._connect())
+
+    async def read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        return await asyncio.to_thread(self.read_sync, fn)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
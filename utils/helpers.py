@@ -1,8 +1,12 @@
 from datetime import datetime
-from typing import Any, Dict, Optional, List
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional, List
 
 
 NOTE_KNOWN_KEYS = {"ref", "username"}
+# Сколько различных note держим в кэше разбора (одна запись ~ несколько сотен байт)
+NOTE_CACHE_SIZE = 8192
 
 
 def split_note_segments(note: Optional[str]) -> List[str]:
@@ -24,7 +28,7 @@ def split_note_segments(note: Optional[str]) -> List[str]:
     return segments
 
 
-def _normalize_username(username: Optional[str]) -> Optional[str]:
+def normalize_username(username: Optional[str]) -> Optional[str]:
     if not username:
         return None
     value = username.strip()
@@ -35,21 +39,79 @@ def _normalize_username(username: Optional[str]) -> Optional[str]:
     return value
 
 
-def parse_note_components(note: Optional[str]) -> tuple[Dict[str, str], list[str]]:
-    """Split note string into known key-value pairs and leftover lines."""
+class ParsedNote:
+    """Immutable parsed form of a Marzban note, shared by all note helpers."""
+
+    __slots__ = ("fields", "extras", "referrer_id", "username", "notify_tags")
+
+    fields: Mapping[str, str]
+    extras: tuple[str, ...]
+    referrer_id: Optional[int]
+    username: Optional[str]
+    notify_tags: frozenset[str]
+
+    def __init__(self, fields: Dict[str, str], extras: tuple[str, ...]):
+        ref_id: Optional[int] = None
+        ref_val = fields.get("ref")
+        if ref_val:
+            candidate = ref_val.split("|")[0].split(";")[0].split(",")[0].strip()
+            if candidate.isdigit():
+                ref_id = int(candidate)
+        set_ = object.__setattr__
+        set_(self, "fields", MappingProxyType(fields))
+        set_(self, "extras", extras)
+        set_(self, "referrer_id", ref_id)
+        set_(self, "username", normalize_username(fields.get("username")))
+        set_(
+            self,
+            "notify_tags",
+            frozenset(e.removeprefix("nd:") for e in extras if e.lower().startswith("nd:")),
+        )
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("ParsedNote is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("ParsedNote is immutable")
+
+    def __repr__(self) -> str:
+        return f"ParsedNote(fields={dict(self.fields)!r}, extras={self.extras!r})"
+
+
+_EMPTY_NOTE = ParsedNote({}, ())
+
+
+@lru_cache(maxsize=NOTE_CACHE_SIZE)
+def _parse_note_cached(note: str) -> ParsedNote:
     fields: Dict[str, str] = {}
     extras: list[str] = []
-    segments = split_note_segments(note)
-    for segment in segments:
+    for segment in split_note_segments(note):
         if ":" in segment:
             key, value = segment.split(":", 1)
             key_lower = key.strip().lower()
-            value_str = value.strip()
             if key_lower in NOTE_KNOWN_KEYS:
-                fields[key_lower] = value_str
+                fields[key_lower] = value.strip()
                 continue
         extras.append(segment)
-    return fields, extras
+    return ParsedNote(fields, tuple(extras))
+
+
+def parse_note(note: Optional[str]) -> ParsedNote:
+    """Return the cached parsed form of a note. The result must not be modified."""
+    if not note:
+        return _EMPTY_NOTE
+    if not isinstance(note, str):
+        note = str(note)
+    return _parse_note_cached(note)
+
+
+def parse_note_components(note: Optional[str]) -> tuple[Dict[str, str], list[str]]:
+    """Split note string into known key-value pairs and leftover lines.
+
+    Returns fresh copies, so callers may modify them.
+    """
+    parsed = parse_note(note)
+    return dict(parsed.fields), list(parsed.extras)
 
 
 def assemble_note_components(fields: Dict[str, str], extras: list[str]) -> Optional[str]:
@@ -72,20 +134,21 @@ def build_user_note(ref_id: Optional[int] = None, username: Optional[str] = None
     fields: Dict[str, str] = {}
     if ref_id is not None:
         fields["ref"] = str(ref_id)
-    normalized_username = _normalize_username(username)
+    normalized_username = normalize_username(username)
     if normalized_username:
         fields["username"] = normalized_username
     return assemble_note_components(fields, extras or [])
 
 
 def update_note_with_username(note: Optional[str], username: Optional[str]) -> Optional[str]:
-    fields, extras = parse_note_components(note)
-    ref_id = extract_referrer_id(note)
+    parsed = parse_note(note)
+    fields, extras = dict(parsed.fields), list(parsed.extras)
+    ref_id = parsed.referrer_id
     if ref_id is not None:
         fields["ref"] = str(ref_id)
     elif fields.get("ref") in {"", None}:
         fields.pop("ref", None)
-    normalized_username = _normalize_username(username)
+    normalized_username = normalize_username(username)
     if normalized_username:
         fields["username"] = normalized_username
     else:
@@ -94,19 +157,11 @@ def update_note_with_username(note: Optional[str], username: Optional[str]) -> O
 
 
 def extract_referrer_id(note: Optional[str]) -> Optional[int]:
-    fields, _ = parse_note_components(note)
-    ref_val = fields.get("ref")
-    if not ref_val:
-        return None
-    candidate = ref_val.split("|")[0].split(";")[0].split(",")[0].strip()
-    if candidate.isdigit():
-        return int(candidate)
-    return None
+    return parse_note(note).referrer_id
 
 
 def extract_username(note: Optional[str]) -> Optional[str]:
-    fields, _ = parse_note_components(note)
-    return _normalize_username(fields.get("username"))
+    return parse_note(note).username
 
 
 def format_ts_to_str(ts: int) -> str:
@@ -1,19 +1,52 @@
 from aiogram import BaseMiddleware
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, TelegramObject, Update
 from typing import Callable, Awaitable, Dict, Any
+import logging
 import os
+import time
 
-from config import ADMIN_IDS, ADMIN_IDS_STR, MAINTENANCE_FLAG_FILE, MESSAGES
+from config import ADMIN_ID_SET, MAINTENANCE_FLAG_FILE, MAINTENANCE_POLL_INTERVAL, MESSAGES
 
 
-def is_maintenance_enabled() -> bool:
+logger = logging.getLogger(__name__)
+
+# Состояние хранится в памяти; файл-флаг перечитывается не чаще MAINTENANCE_POLL_INTERVAL,
+# чтобы подхватывать изменения, сделанные вне бота (например, `touch maintenance.lock`).
+_enabled: bool = False
+_checked_at: float = float("-inf")
+
+
+def _apply_state(enabled: bool) -> None:
+    global _enabled
+    if enabled == _enabled:
+        return
+    _enabled = enabled
+    logger.info("Maintenance mode %s", "enabled" if enabled else "disabled")
+
+
+def refresh_maintenance_state() -> bool:
+    """Перечитать файл-флаг немедленно."""
+    global _checked_at
+    _checked_at = time.monotonic()
     try:
-        return os.path.exists(MAINTENANCE_FLAG_FILE)
+        os.stat(MAINTENANCE_FLAG_FILE)
+        exists = True
+    except FileNotFoundError:
+        exists = False
     except Exception:
-        return False
+        return _enabled
+    _apply_state(exists)
+    return _enabled
+
+
+def is_maintenance_enabled() -> bool:
+    if time.monotonic() - _checked_at >= MAINTENANCE_POLL_INTERVAL:
+        return refresh_maintenance_state()
+    return _enabled
 
 
 def set_maintenance_enabled(enabled: bool) -> None:
+    global _checked_at
     try:
         if enabled:
             with open(MAINTENANCE_FLAG_FILE, 'w', encoding='utf-8') as f:
@@ -23,30 +56,37 @@ def set_maintenance_enabled(enabled: bool) -> None:
                 os.remove(MAINTENANCE_FLAG_FILE)
     except Exception:
         pass
+    _checked_at = time.monotonic()
+    _apply_state(enabled)
 
 
 class MaintenanceMiddleware(BaseMiddleware):
     async def __call__(
         self,
-        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
-        event: Message | CallbackQuery,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        try:
-            user_id = event.from_user.id if getattr(event, 'from_user', None) else None
-            if not user_id:
-                return await handler(event, data)
-            # Администраторы не блокируются (по int и str ID)
-            if user_id in ADMIN_IDS or str(user_id) in ADMIN_IDS_STR:
-                return await handler(event, data)
-            if is_maintenance_enabled():
-                # Block non-admins
-                if isinstance(event, CallbackQuery):
-                    await event.message.edit_text(MESSAGES["maintenance_active"])
-                    await event.answer()
-                else:
-                    await event.answer(MESSAGES["maintenance_active"])
-                return None
+        # Быстрый путь: флаг в памяти, без обращения к файловой системе
+        if not is_maintenance_enabled():
             return await handler(event, data)
-        except Exception:
+        # Middleware висит на dp.update, поэтому пользователя берём из контекста aiogram
+        user = data.get("event_from_user")
+        # Администраторы не блокируются
+        if user is None or user.id in ADMIN_ID_SET:
             return await handler(event, data)
+        # Block non-admins
+        try:
+            target = event.event if isinstance(event, Update) else event
+            if isinstance(target, CallbackQuery):
+                if target.message is not None:
+                    await target.message.edit_text(MESSAGES["maintenance_active"])
+                await target.answer()
+            elif isinstance(target, Message):
+                await target.answer(MESSAGES["maintenance_active"])
+        except Exception:
+            pass
+        return None
+
+
+refresh_maintenance_state()
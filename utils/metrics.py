@@ -0,0 +1,354 @@
+"""Метрики в текстовом формате Prometheus (/metrics).
+
+Собственная минимальная реализация вместо prometheus_client: счётчики и гистограммы
+с метками, запись — один захват блокировки и пара операций со словарём.
+Метрики у каждого процесса свои.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        lines = self._header()
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        collect: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+        kind: str = "gauge",
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self._values: Dict[LabelValues, float] = {}
+        # Если задан collect, значения вычисляются в момент отдачи /metrics
+        self._collect = collect
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self) -> List[str]:
+        if self._collect is not None:
+            try:
+                items = list(self._collect().items())
+            except Exception as e:
+                logger.warning("Metric collector %s failed: %s", self.name, e)
+                items = []
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        lines = self._header()
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счётчики по корзинам (без кумулятивной суммы), +Inf, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 2)
+            row[index] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(labels, list(row)) for labels, row in self._values.items()]
+        lines = self._header()
+        for labels, row in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            cumulative += row[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {row[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+_registry: List[_Metric] = []
+
+
+def _register(metric: _Metric) -> Any:
+    _registry.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+UPDATE_SECONDS = _register(Histogram(
+    "bot_update_seconds", "Update processing time by update type", ("update_type",)
+))
+HANDLER_SECONDS = _register(Histogram(
+    "bot_handler_seconds", "Handler execution time", ("handler",)
+))
+HANDLER_ERRORS = _register(Counter(
+    "bot_handler_errors_total", "Handler exceptions", ("handler",)
+))
+MARZBAN_SECONDS = _register(Histogram(
+    "marzban_call_seconds", "MarzbanService method latency", ("method",)
+))
+MARZBAN_ERRORS = _register(Counter(
+    "marzban_call_errors_total", "Failed Marzban API calls", ("method",)
+))
+MARZBAN_RETRIES = _register(Counter(
+    "marzban_retries_total", "Retried Marzban API requests", ("method",)
+))
+MARZBAN_HEDGED = _register(Counter(
+    "marzban_hedged_requests_total", "Hedged Marzban API reads", ("method",)
+))
+MARZBAN_REJECTED = _register(Counter(
+    "marzban_circuit_rejected_total", "Marzban API calls rejected by the open circuit", ("method",)
+))
+MARZBAN_ADMISSION_WAIT = _register(Histogram(
+    "marzban_admission_wait_seconds", "Time Marzban API calls waited for a concurrency slot", ("traffic",)
+))
+HAPP_SECONDS = _register(Histogram(
+    "happ_encrypt_seconds", "Happ crypto API call latency", ("result",)
+))
+TELEGRAM_REQUESTS = _register(Counter(
+    "telegram_requests_total", "Bot API requests sent", ("method",)
+))
+TELEGRAM_ERRORS = _register(Counter(
+    "telegram_request_errors_total", "Failed Bot API requests", ("method", "error")
+))
+TELEGRAM_SECONDS = _register(Histogram(
+    "telegram_request_seconds", "Bot API request latency", ("method",)
+))
+CACHE_REQUESTS = _register(Counter(
+    "cache_requests_total", "Cache lookups", ("cache", "result")
+))
+PAYMENT_STAGE_SECONDS = _register(Histogram(
+    "payment_stage_seconds", "Payment pipeline stage timings", ("stage",)
+))
+PAYMENTS = _register(Counter(
+    "payments_total", "Processed payment notifications", ("result",)
+))
+THROTTLED = _register(Counter(
+    "bot_throttled_total", "Updates dropped by per-user throttling", ("action", "reason")
+))
+EVENT_LOOP_LAG = _register(Histogram(
+    "event_loop_lag_seconds", "Event loop scheduling delay",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+))
+
+
+def register_collector(
+    name: str,
+    documentation: str,
+    collect: Callable[[], Dict[LabelValues, float]],
+    labelnames: Sequence[str] = (),
+    kind: str = "gauge",
+) -> Gauge:
+    """Метрика, значения которой считаются при каждом обращении к /metrics."""
+    return _register(Gauge(name, documentation, labelnames, collect=collect, kind=kind))
+
+
+def _lru_cache_stats() -> Dict[LabelValues, float]:
+    # Ленивый импорт: helpers не должен зависеть от метрик
+    from utils.helpers import _parse_note_cached
+
+    info = _parse_note_cached.cache_info()
+    return {("parse_note", "hit"): info.hits, ("parse_note", "miss"): info.misses}
+
+
+register_collector(
+    "cache_lru_requests_total", "lru_cache lookups", _lru_cache_stats, ("cache", "result"), kind="counter"
+)
+
+
+def cache_hit(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+def timed_method(histogram: Histogram, errors: Optional[Counter] = None, label: Optional[str] = None):
+    """Декоратор async-метода: время выполнения и число исключений с меткой по имени метода."""
+    def decorator(fn: Callable[..., Awaitable[Any]]):
+        name = label or fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+
+        return wrapper
+
+    return decorator
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: полное время обработки обновления по типу."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+            UPDATE_SECONDS.observe(time.perf_counter() - started, update_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: время конкретного хендлера (наследуется вложенными роутерами)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        name = getattr(callback, "__qualname__", None) or "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: число, задержка и ошибки запросов к Bot API."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Any,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        TELEGRAM_REQUESTS.inc(name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, name)
+
+
+async def run_event_loop_lag_monitor(interval: float = 0.5) -> None:
+    """Измерять, насколько позже запланированного просыпается event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - expected))
@@ -0,0 +1,63 @@
+"""Журнал применённых оплат: одна оплата (operation_id) продлевает подписку один раз.
+
+Уведомление может обрабатываться повторно: YooMoney присылает его ещё раз, запись
+очереди забирает другой обработчик, продление повторяется после таймаута, когда
+панель, возможно, уже применила изменение. Перед записью в панель оплата отмечается
+как applying с ожидаемым сроком подписки, после — как applied. Повтор applied-оплаты
+пропускается, а повтор applying-оплаты сначала сверяет срок в панели с ожидаемым.
+
+Журнал лежит рядом с очередью (PAYMENT_QUEUE_DB_FILE), вызывать его нужно под
+shared_lock(f"user:{telegram_id}"), чтобы проверка и продление шли одной секцией.
+"""
+import sqlite3
+import time
+from typing import Any, Dict, Optional
+
+from config import PAYMENT_QUEUE_DB_FILE
+from utils.db import SQLiteDatabase
+
+
+APPLYING = "applying"
+APPLIED = "applied"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS applied_payments (
+    operation_id TEXT PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    target_expire INTEGER,
+    created_at REAL NOT NULL,
+    applied_at REAL
+);
+"""
+
+_db = SQLiteDatabase(PAYMENT_QUEUE_DB_FILE, _SCHEMA)
+
+
+async def get_payment(operation_id: str) -> Optional[Dict[str, Any]]:
+    """Запись журнала об оплате или None, если оплату ещё не применяли."""
+    def _read(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+        row = conn.execute(
+            "SELECT status, target_expire FROM applied_payments WHERE operation_id = ?",
+            (operation_id,),
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    return await _db.read(_read)
+
+
+async def begin_payment(operation_id: str, telegram_id: int, target_expire: int) -> None:
+    """Отметить, что оплата сейчас применяется и подписка должна продлиться до target_expire."""
+    await _db.run(lambda conn: conn.execute(
+        "INSERT INTO applied_payments(operation_id, telegram_id, status, target_expire, created_at) "
+        "VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(operation_id) DO UPDATE SET status = excluded.status, target_expire = excluded.target_expire",
+        (operation_id, telegram_id, APPLYING, target_expire, time.time()),
+    ))
+
+
+async def mark_applied(operation_id: str) -> None:
+    await _db.run(lambda conn: conn.execute(
+        "UPDATE applied_payments SET status = ?, applied_at = ? WHERE operation_id = ?",
+        (APPLIED, time.time(), operation_id),
+    ))
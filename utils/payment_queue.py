@@ -0,0 +1,216 @@
+"""Локальная очередь уведомлений YooMoney.
+
+Приём уведомления (проверка подписи и запись в очередь) отделён от активации подписки:
+сервер оплат может работать в своём потоке или процессе и отвечать YooMoney сразу,
+а бот разбирает очередь, когда доходят руки. Очередь лежит в SQLite, поэтому
+принятые уведомления переживают перезапуск, а повторы с тем же operation_id
+игнорируются.
+
+YooMoney уже получил «OK», поэтому неудачная активация (панель недоступна) не
+теряется: запись возвращается в очередь с растущей паузой, а после
+PAYMENT_RETRY_MAX_ATTEMPTS попыток помечается failed и админы получают уведомление.
+Отклонённые уведомления (подпись, сумма, тариф) не повторяются.
+
+Взятая в обработку запись — аренда на _CLAIM_LEASE секунд, которую обработчик
+продлевает, пока работает; забрать запись снова можно, только если аренда истекла
+(процесс упал или завис). Повторное продление подписки при этом исключает журнал
+оплат (utils.payment_ledger).
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram import Bot
+
+from config import (
+    ADMIN_IDS,
+    MESSAGES,
+    PAYMENT_QUEUE_DB_FILE,
+    PAYMENT_QUEUE_POLL_INTERVAL,
+    PAYMENT_RETRY_BACKOFF,
+    PAYMENT_RETRY_MAX_ATTEMPTS,
+)
+from handlers.payment import payment_service, process_payment_notification
+from utils.db import SQLiteDatabase
+from utils.metrics import PAYMENT_STAGE_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    operation_id TEXT UNIQUE,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    claimed_at REAL,
+    finished_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_payment_queue_status ON payment_queue(status, id);
+"""
+_RETRY_BACKOFF_MAX = 60 * 60
+# Аренда записи в обработке: продлевается каждые _CLAIM_LEASE / 3 секунд
+_CLAIM_LEASE = 60
+
+_db = SQLiteDatabase(PAYMENT_QUEUE_DB_FILE, _SCHEMA)
+# (loop, event) обработчика очереди в этом процессе — чтобы будить его из потока сервера оплат
+_wakeup: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = None
+
+
+async def enqueue_notification(data: Dict[str, Any]) -> bool:
+    """Положить проверенное уведомление в очередь. False — дубликат по operation_id."""
+    operation_id = data.get("operation_id") or None
+    payload = json.dumps(data, ensure_ascii=False)
+
+    def _insert(conn: sqlite3.Connection) -> bool:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO payment_queue(operation_id, payload, received_at) VALUES (?, ?, ?)",
+            (operation_id, payload, time.time()),
+        )
+        return cur.rowcount == 1
+
+    added = await _db.run(_insert)
+    if added and _wakeup is not None:
+        loop, event = _wakeup
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # Цикл обработчика уже закрыт — запись заберёт следующий запуск
+            pass
+    return added
+
+
+def _claim_next(conn: sqlite3.Connection) -> Optional[Tuple[int, Dict[str, Any], float, int]]:
+    now = time.time()
+    row = conn.execute(
+        "SELECT id, payload, received_at, attempts FROM payment_queue "
+        "WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'processing' AND claimed_at < ?) "
+        "ORDER BY id LIMIT 1",
+        (now, now - _CLAIM_LEASE),
+    ).fetchone()
+    if row is None:
+        return None
+    conn.execute(
+        "UPDATE payment_queue SET status = 'processing', claimed_at = ? WHERE id = ?",
+        (now, row["id"]),
+    )
+    return row["id"], json.loads(row["payload"]), row["received_at"], row["attempts"]
+
+
+async def _renew_claim(item_id: int) -> None:
+    """Продлевать аренду записи, пока её обрабатывают."""
+    while True:
+        await asyncio.sleep(_CLAIM_LEASE / 3)
+        try:
+            await _db.run(lambda conn: conn.execute(
+                "UPDATE payment_queue SET claimed_at = ? WHERE id = ? AND status = 'processing'",
+                (time.time(), item_id),
+            ))
+        except Exception as e:
+            logger.warning("Failed to renew claim on queued payment %s: %s", item_id, e)
+
+
+async def _finish(item_id: int, status: str) -> None:
+    await _db.run(lambda conn: conn.execute(
+        "UPDATE payment_queue SET status = ?, finished_at = ? WHERE id = ?",
+        (status, time.time(), item_id),
+    ))
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(_RETRY_BACKOFF_MAX, PAYMENT_RETRY_BACKOFF * 2 ** (attempts - 1))
+
+
+async def _retry_later(item_id: int, attempts: int) -> None:
+    await _db.run(lambda conn: conn.execute(
+        "UPDATE payment_queue SET status = 'pending', attempts = ?, next_attempt_at = ? WHERE id = ?",
+        (attempts, time.time() + _retry_delay(attempts), item_id),
+    ))
+
+
+async def _give_up(item_id: int, attempts: int) -> None:
+    await _db.run(lambda conn: conn.execute(
+        "UPDATE payment_queue SET status = 'failed', attempts = ?, finished_at = ? WHERE id = ?",
+        (attempts, time.time(), item_id),
+    ))
+
+
+async def _notify_admins(bot: Optional[Bot], data: Dict[str, Any], attempts: int) -> None:
+    if bot is None:
+        return
+    parsed = payment_service.parse_payment_data(str(data.get("label") or ""))
+    text = MESSAGES["payment_failed_admin"].format(
+        telegram_id=parsed.get("telegram_id") or "—",
+        plan_key=parsed.get("plan_key") or "—",
+        amount=data.get("withdraw_amount") or data.get("amount") or "—",
+        operation_id=data.get("operation_id") or "—",
+        attempts=attempts,
+    )
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(chat_id=admin_id, text=text)
+        except Exception as e:
+            logger.warning("Failed to send payment alert to %s: %s", admin_id, e)
+
+
+async def run_payment_queue_worker(bot: Bot) -> None:
+    """Разбирать очередь уведомлений и активировать подписки."""
+    global _wakeup
+    event = asyncio.Event()
+    _wakeup = (asyncio.get_running_loop(), event)
+    try:
+        while True:
+            # Сбрасываем до чтения очереди, чтобы не потерять сигнал о записи, пришедшей во время чтения
+            event.clear()
+            try:
+                item = await _db.run(_claim_next)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Failed to read payment queue: %s", e)
+                item = None
+            if item is None:
+                # Уведомления из других процессов не будят нас — поэтому ещё и опрос по таймеру
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=PAYMENT_QUEUE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            item_id, data, received_at, attempts = item
+            if attempts == 0:
+                PAYMENT_STAGE_SECONDS.observe(max(0.0, time.time() - received_at), "queue_wait")
+            renewal = asyncio.create_task(_renew_claim(item_id))
+            try:
+                result = await process_payment_notification(data, bot=bot)
+            except Exception as e:
+                logger.error("Queued payment %s failed: %s", item_id, e)
+                result = "failed"
+            finally:
+                renewal.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await renewal
+            if result == "processed":
+                await _finish(item_id, "done")
+            elif result == "rejected":
+                await _finish(item_id, "rejected")
+            else:
+                attempts += 1
+                if attempts < PAYMENT_RETRY_MAX_ATTEMPTS:
+                    logger.warning(
+                        "Queued payment %s failed (attempt %s), retrying in %.0fs",
+                        item_id, attempts, _retry_delay(attempts),
+                    )
+                    await _retry_later(item_id, attempts)
+                else:
+                    logger.error("Queued payment %s failed after %s attempts", item_id, attempts)
+                    await _give_up(item_id, attempts)
+                    await _notify_admins(bot, data, attempts)
+    finally:
+        _wakeup = None
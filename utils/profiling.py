@@ -0,0 +1,164 @@
+"""Профилирование работающего процесса без перезапуска.
+
+- sample_cpu_profile: сэмплирующий профилировщик потока event loop. Стек снимается
+  из sys._current_frames() каждые PROFILING_SAMPLE_INTERVAL секунд; результат — файл
+  в формате collapsed stacks (flamegraph.pl, speedscope, inferno) и сводка top-N.
+- memory_diff: разница двух снимков tracemalloc за заданное окно, top-N по росту.
+
+Одновременно выполняется только одна сессия профилирования.
+"""
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Counter, List, NamedTuple
+
+from config import PROFILING_MAX_SECONDS, PROFILING_SAMPLE_INTERVAL
+
+
+class ProfileResult(NamedTuple):
+    filename: str
+    content: bytes
+    summary: str
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+_busy = threading.Lock()
+
+
+def _clamp_duration(seconds: float) -> float:
+    return max(1.0, min(float(seconds), float(PROFILING_MAX_SECONDS)))
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_thread(thread_id: int, duration: float, interval: float) -> tuple[Counter[str], Counter[str], int]:
+    """Собрать стеки потока thread_id. Блокирующая функция — выполняется в отдельном потоке."""
+    stacks: Counter[str] = collections.Counter()
+    self_time: Counter[str] = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            labels: List[str] = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.reverse()
+            stacks[";".join(labels)] += 1
+            self_time[labels[-1]] += 1
+            samples += 1
+        time.sleep(interval)
+    return stacks, self_time, samples
+
+
+def _top_lines(counter: Counter[str], samples: int, top: int) -> List[str]:
+    lines = []
+    for label, count in counter.most_common(top):
+        lines.append(f"{count * 100 / samples:6.2f}%  {count:6d}  {label}")
+    return lines
+
+
+async def sample_cpu_profile(seconds: float, top: int = 25) -> ProfileResult:
+    """Профиль потока, в котором работает текущий event loop."""
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        duration = _clamp_duration(seconds)
+        thread_id = threading.get_ident()
+        stacks, self_time, samples = await asyncio.to_thread(
+            _sample_thread, thread_id, duration, PROFILING_SAMPLE_INTERVAL
+        )
+    finally:
+        _busy.release()
+
+    inclusive: Counter[str] = collections.Counter()
+    for stack, count in stacks.items():
+        # Рекурсивные функции учитываем в стеке один раз
+        for label in set(stack.split(";")):
+            inclusive[label] += count
+
+    folded = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    summary_lines = [
+        f"CPU profile: {duration:.0f}s, {samples} samples, interval {PROFILING_SAMPLE_INTERVAL * 1000:.0f}ms",
+        "",
+        f"Top {top} by self time:",
+        *(_top_lines(self_time, samples, top) if samples else ["—"]),
+        "",
+        f"Top {top} by inclusive time:",
+        *(_top_lines(inclusive, samples, top) if samples else ["—"]),
+    ]
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    return ProfileResult(
+        filename=f"cpu_{stamp}.folded",
+        content=(folded + "\n").encode("utf-8"),
+        summary="\n".join(summary_lines),
+    )
+
+
+async def memory_diff(seconds: float, top: int = 30) -> ProfileResult:
+    """Что выделилось (и не освободилось) за окно в seconds секунд."""
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy()
+    started_here = not tracemalloc.is_tracing()
+    try:
+        duration = _clamp_duration(seconds)
+        if started_here:
+            tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(duration)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+        _busy.release()
+
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ]
+    before = before.filter_traces(filters)
+    after = after.filter_traces(filters)
+    by_line = after.compare_to(before, "lineno")
+    by_trace = after.compare_to(before, "traceback")
+
+    growth = sum(stat.size_diff for stat in by_line)
+    lines = [
+        f"Memory diff: {duration:.0f}s, net {growth / 1024:+.1f} KiB, traced {current / 1024 / 1024:.1f} MiB "
+        f"(peak {peak / 1024 / 1024:.1f} MiB)",
+        "",
+        f"Top {top} lines by growth:",
+    ]
+    for stat in by_line[:top]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size_diff / 1024:+10.1f} KiB  {stat.count_diff:+7d} blocks  {frame.filename}:{frame.lineno}"
+        )
+    summary = "\n".join(lines)
+
+    details: List[str] = [summary, "", f"Top {min(top, 10)} allocation tracebacks:"]
+    for stat in by_trace[: min(top, 10)]:
+        details.append("")
+        details.append(f"{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks")
+        details.extend(stat.traceback.format())
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    return ProfileResult(
+        filename=f"memory_{stamp}.txt",
+        content=("\n".join(details) + "\n").encode("utf-8"),
+        summary=summary,
+    )
+
+
+def is_profiler_busy() -> bool:
+    return _busy.locked()
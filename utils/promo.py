@@ -1,63 +1,176 @@
 import json
+import logging
 import os
 import secrets
-from typing import Dict, Optional, Tuple
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
-from config import PROMO_CODES_FILE, SUBSCRIPTION_PLANS
+from config import PROMO_CODES_FILE, PROMO_DB_FILE, SUBSCRIPTION_PLANS
+from utils.db import SQLiteDatabase
 
 
-def _read_store() -> Dict[str, Dict]:
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS promo_codes (
+    code TEXT PRIMARY KEY,
+    plan_key TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    used_at INTEGER,
+    used_by INTEGER,
+    campaign TEXT,
+    expires_at INTEGER
+);
+-- Покрывающий индекс: отчёт по кампаниям читается без обхода самой таблицы
+CREATE INDEX IF NOT EXISTS idx_promo_campaign ON promo_codes(campaign, used_at);
+"""
+
+_db = SQLiteDatabase(PROMO_DB_FILE, _SCHEMA)
+_migrated = False
+
+
+def _migrate_json_store(conn: sqlite3.Connection) -> int:
+    """Импортировать коды из старого promocodes.json (один раз), файл переименовывается в *.migrated."""
     if not os.path.exists(PROMO_CODES_FILE):
-        return {}
+        return 0
     try:
         with open(PROMO_CODES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f) or {}
-    except Exception:
-        return {}
+            data = json.load(f) or {}
+    except Exception as e:
+        logger.error("Failed to read legacy promo store %s: %s", PROMO_CODES_FILE, e)
+        return 0
+    now = int(time.time())
+    rows = []
+    for code, item in data.items():
+        if not isinstance(item, dict) or item.get("used"):
+            continue
+        plan_key = item.get("plan_key")
+        if not plan_key:
+            continue
+        rows.append((str(code), plan_key, now))
+    conn.executemany(
+        "INSERT OR IGNORE INTO promo_codes(code, plan_key, created_at) VALUES (?, ?, ?)",
+        rows,
+    )
+    os.replace(PROMO_CODES_FILE, PROMO_CODES_FILE + ".migrated")
+    logger.info("Imported %d promo codes from %s", len(rows), PROMO_CODES_FILE)
+    return len(rows)
 
 
-def _write_store(data: Dict[str, Dict]) -> None:
-    tmp = PROMO_CODES_FILE + ".tmp"
-    # sanitize: remove legacy 'used' keys
-    sanitized: Dict[str, Dict] = {}
-    for k, v in (data or {}).items():
-        if isinstance(v, dict) and 'used' in v:
-            v = {kk: vv for kk, vv in v.items() if kk != 'used'}
-        sanitized[k] = v
-    with open(tmp, 'w', encoding='utf-8') as f:
-        json.dump(sanitized, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, PROMO_CODES_FILE)
+async def _run(fn):
+    global _migrated
+    if not _migrated:
+        await _db.run(_migrate_json_store)
+        _migrated = True
+    return await _db.run(fn)
 
 
 def generate_code(length: int = 12) -> str:
     return secrets.token_urlsafe(length)[:length]
 
 
-def create_promo(plan_key: str) -> Optional[Tuple[str, Dict]]:
+async def create_promo(plan_key: str) -> Optional[Tuple[str, Dict]]:
     if plan_key not in SUBSCRIPTION_PLANS:
         return None
-    store = _read_store()
-    code = generate_code()
-    store[code] = {
-        "plan_key": plan_key,
-    }
-    _write_store(store)
+
+    def _insert(conn: sqlite3.Connection) -> str:
+        while True:
+            code = generate_code()
+            try:
+                conn.execute(
+                    "INSERT INTO promo_codes(code, plan_key, created_at) VALUES (?, ?, ?)",
+                    (code, plan_key, int(time.time())),
+                )
+                return code
+            except sqlite3.IntegrityError:
+                # Коллизия кода — генерируем другой
+                continue
+
+    try:
+        code = await _run(_insert)
+    except Exception as e:
+        logger.error("Failed to create promo code: %s", e)
+        return None
     return code, SUBSCRIPTION_PLANS[plan_key]
 
 
-def consume_promo(code: str) -> Optional[str]:
-    store = _read_store()
-    item = store.get(code)
-    if not item:
+async def create_promos_bulk(
+    plan_key: str,
+    count: int,
+    expires_at: Optional[int] = None,
+    campaign: Optional[str] = None,
+) -> Optional[List[str]]:
+    """Создать count промокодов одной транзакцией."""
+    if plan_key not in SUBSCRIPTION_PLANS or count <= 0:
         return None
-    if item.get("used"):
-        return "USED"
-    # Удаляем промокод после использования
+
+    def _insert(conn: sqlite3.Connection) -> List[str]:
+        created: List[str] = []
+        now = int(time.time())
+        while len(created) < count:
+            batch = {generate_code() for _ in range(count - len(created))}
+            for code in batch:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO promo_codes(code, plan_key, created_at, campaign, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (code, plan_key, now, campaign, expires_at),
+                )
+                # rowcount == 0 — такой код уже был, недостающие догенерируем
+                if cur.rowcount == 1:
+                    created.append(code)
+        return created
+
     try:
-        del store[code]
-    except Exception:
-        store.pop(code, None)
-    _write_store(store)
-    return item.get("plan_key")
+        return await _run(_insert)
+    except Exception as e:
+        logger.error("Failed to create promo codes in bulk: %s", e)
+        return None
+
+
+async def campaign_stats() -> List[Dict[str, Any]]:
+    """Число выпущенных и погашенных кодов по кампаниям."""
+    def _read(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+        rows = conn.execute(
+            "SELECT campaign, COUNT(*) AS issued, COUNT(used_at) AS redeemed "
+            "FROM promo_codes WHERE campaign IS NOT NULL "
+            "GROUP BY campaign ORDER BY campaign"
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    try:
+        return await _run(_read)
+    except Exception as e:
+        logger.error("Failed to read promo campaign stats: %s", e)
+        return []
 
 
+async def consume_promo(code: str, telegram_id: Optional[int] = None) -> Optional[str]:
+    """Погасить промокод. Возвращает plan_key, "USED", "EXPIRED" или None, если кода нет.
+
+    Погашение атомарно: из двух одновременных попыток успешна только одна.
+    """
+    def _consume(conn: sqlite3.Connection) -> Optional[str]:
+        row = conn.execute(
+            "SELECT plan_key, used_at, expires_at FROM promo_codes WHERE code = ?", (code,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row["used_at"] is not None:
+            return "USED"
+        now = int(time.time())
+        if row["expires_at"] is not None and row["expires_at"] <= now:
+            return "EXPIRED"
+        cur = conn.execute(
+            "UPDATE promo_codes SET used_at = ?, used_by = ? WHERE code = ? AND used_at IS NULL",
+            (now, telegram_id, code),
+        )
+        if cur.rowcount != 1:
+            return "USED"
+        return row["plan_key"]
+
+    try:
+        return await _run(_consume)
+    except Exception as e:
+        logger.error("Failed to consume promo code: %s", e)
+        return None
@@ -17,8 +17,10 @@ from utils.helpers import (
     format_ts_to_str,
     parse_note_components,
     assemble_note_components,
-    split_note_segments,
+    parse_note,
 )
+from utils.stats import reconcile_stats
+from utils.admission import BATCH, with_traffic_class
 
 
 logger = logging.getLogger(__name__)
@@ -41,14 +43,12 @@ def _merge_note_with_notify_tag(existing: Optional[str], tag: str) -> str:
 
 def _already_notified_today(note: Optional[str]) -> bool:
     try:
-        for segment in split_note_segments(note):
-            if segment.lower().startswith("nd:") and segment.removeprefix("nd:") == _today_tag():
-                return True
-        return False
+        return _today_tag() in parse_note(note).notify_tags
     except Exception:
         return False
 
 
+@with_traffic_class(BATCH)
 async def run_expiry_reminders(bot: Bot) -> None:
     """Send reminders to users whose subscription expires in ~24 hours.
 
@@ -62,6 +62,10 @@ async def run_expiry_reminders(bot: Bot) -> None:
         logger.error("Failed to load users for reminders: %s", e)
         return
 
+    # Тот же полный список используем для периодической сверки статистики
+    if users:
+        await reconcile_stats(users)
+
     now = datetime.now()
     window_end = now + timedelta(days=1, hours=0)
 
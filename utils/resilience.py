@@ -0,0 +1,203 @@
+"""Устойчивость вызовов внешнего API: таймауты, повторы, circuit breaker и hedged-запросы.
+
+ResilientCaller выполняет корутинную функцию по политике CallPolicy:
+- таймаут на попытку, чтобы зависший запрос не держал хендлер дольше нужного;
+- повторы с экспоненциальной задержкой и полным джиттером — только для
+  идемпотентных запросов (чтение, получение токена) и только при сбоях, которые
+  указывают на проблемы сервиса (таймаут, сеть, 5xx);
+- hedged-чтение: если ответ не пришёл за hedge_delay, параллельно уходит копия
+  запроса, побеждает первый успешный ответ;
+- circuit breaker, общий для всех вызовов: после threshold неудачных вызовов подряд
+  (вызов со всеми его повторами — один сбой) вызовы какое-то время сразу получают
+  CircuitOpenError, не дожидаясь таймаутов. Затем пропускается один пробный вызов:
+  успех закрывает breaker, сбой открывает снова.
+
+Ответ сервиса с ошибкой клиента (4xx, например 404) сбоем не считается: сервис жив.
+Состояние хранится в памяти процесса.
+"""
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(RuntimeError):
+    """Вызов не выполнялся: breaker открыт, сервис считается недоступным."""
+
+
+def is_transient(error: BaseException) -> bool:
+    """Сбой на стороне сервиса или сети, который имеет смысл повторить."""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response is None or error.response.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Breaker closed → open → half_open → closed по числу сбоев подряд."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_total = 0
+        self.last_error: Optional[str] = None
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        """Пропустить вызов или сразу отказать CircuitOpenError."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError(f"{self.name}: circuit open")
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+            logger.info("Circuit %s half-open, probing", self.name)
+        if self.state == self.HALF_OPEN:
+            # Пока идёт пробный запрос, остальные не нагружают восстанавливающийся сервис
+            if self._probe_in_flight:
+                raise CircuitOpenError(f"{self.name}: circuit half-open")
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            logger.info("Circuit %s closed", self.name)
+            self.state = self.CLOSED
+
+    def record_failure(self, error: BaseException) -> None:
+        self.failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"[:200]
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.opened_total += 1
+            logger.warning("Circuit %s opened after %s failures: %s", self.name, self.failures, self.last_error)
+
+    def release_probe(self) -> None:
+        """Пробный вызов отменён, не дойдя до результата: следующий может попробовать снова."""
+        self._probe_in_flight = False
+
+    def retry_in(self) -> float:
+        """Сколько секунд до следующего пробного запроса (0 — если breaker не открыт)."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "opened_total": self.opened_total,
+            "retry_in": self.retry_in(),
+            "last_error": self.last_error,
+        }
+
+
+@dataclass(frozen=True)
+class CallPolicy:
+    timeout: float
+    # Повторять и хеджировать можно только запросы без побочных эффектов
+    idempotent: bool = False
+    hedge: bool = False
+
+
+class ResilientCaller:
+    """Выполнение вызовов по CallPolicy через общий CircuitBreaker."""
+
+    def __init__(
+        self,
+        breaker: CircuitBreaker,
+        retries: int = 0,
+        backoff: float = 0.2,
+        hedge_delay: float = 0.0,
+        on_retry: Optional[Callable[[str], None]] = None,
+        on_hedge: Optional[Callable[[str], None]] = None,
+    ):
+        self.breaker = breaker
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.hedge_delay = hedge_delay
+        self._on_retry = on_retry
+        self._on_hedge = on_hedge
+
+    async def call(
+        self, name: str, policy: CallPolicy, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any
+    ) -> Any:
+        attempts = 1 + (self.retries if policy.idempotent else 0)
+        # Breaker считает логические вызовы, а не попытки: один запрос с повторами —
+        # это один сбой, а в half-open все его попытки идут как один пробный вызов
+        self.breaker.before_call()
+        probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+        try:
+            for attempt in range(attempts):
+                try:
+                    result = await asyncio.wait_for(self._attempt(name, policy, fn, args, kwargs), policy.timeout)
+                except Exception as e:
+                    if not is_transient(e):
+                        # Сервис ответил (пусть и ошибкой) — он жив
+                        self.breaker.record_success()
+                        raise
+                    # Breaker открыли другие вызовы — повторы только добавят нагрузки
+                    if attempt + 1 >= attempts or self.breaker.state == CircuitBreaker.OPEN:
+                        self.breaker.record_failure(e)
+                        raise
+                    if self._on_retry is not None:
+                        self._on_retry(name)
+                    # Полный джиттер: повторы разных хендлеров не приходят в панель одной волной
+                    await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                    continue
+                self.breaker.record_success()
+                return result
+        except BaseException:
+            # Пробный вызов отменён, не дойдя до результата (после record_* это ничего не меняет)
+            if probe:
+                self.breaker.release_probe()
+            raise
+
+    async def _attempt(
+        self, name: str, policy: CallPolicy, fn: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict
+    ) -> Any:
+        if not (policy.idempotent and policy.hedge and self.hedge_delay > 0):
+            return await fn(*args, **kwargs)
+
+        tasks = [asyncio.ensure_future(fn(*args, **kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                if self._on_hedge is not None:
+                    self._on_hedge(name)
+                tasks.append(asyncio.ensure_future(fn(*args, **kwargs)))
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # Ошибка проигравшей копии уже не нужна; помечаем её прочитанной
+                    task.exception()
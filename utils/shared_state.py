@@ -0,0 +1,461 @@
+"""Состояние, общее для нескольких процессов бота: FSM, кэши, блокировки и лидер.
+
+Бэкенд выбирается через SHARED_STATE_BACKEND:
+- memory — всё в памяти процесса (по умолчанию, один процесс);
+- sqlite — файл SHARED_STATE_DB_FILE, который видят все процессы на хосте.
+Другие реализации (например, Redis) подключаются через register_backend().
+
+Кэши (SharedCache) и лимиты частоты (take_token) с общим бэкендом видны всем
+процессам; с memory — работают в памяти процесса, как раньше. Блокировки
+продлеваются, пока их держат, поэтому длинный обработчик не теряет её по TTL.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from config import LEADER_LEASE_TTL, SHARED_STATE_BACKEND, SHARED_STATE_DB_FILE
+from utils.db import SQLiteDatabase
+
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend(ABC):
+    """Хранилище ключ-значение с TTL и арендуемыми блокировками."""
+
+    # Видят ли данные другие процессы (memory — нет)
+    shared: bool = False
+
+    @abstractmethod
+    async def get(self, key: str) -> Any: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None: ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    async def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        """Взять блокировку или продлить свою. False — она занята другим владельцем."""
+
+    @abstractmethod
+    async def release_lock(self, name: str, owner: str) -> None: ...
+
+    async def take_token(self, key: str, rate: float, burst: float) -> bool:
+        """Token bucket: взять токен из корзины key (rate — токенов в секунду).
+
+        Реализация по умолчанию читает и пишет двумя запросами, поэтому атомарна только
+        в пределах одного event loop; общие бэкенды переопределяют её одной транзакцией.
+        """
+        now = time.time()
+        allowed, state = _take_from_bucket(await self.get(key), now, rate, burst)
+        await self.set(key, state, ttl=burst / rate)
+        return allowed
+
+    async def close(self) -> None:
+        return None
+
+
+def _take_from_bucket(state: Any, now: float, rate: float, burst: float) -> Tuple[bool, List[float]]:
+    """Новое состояние корзины [токены, время] после попытки взять один токен."""
+    tokens = burst
+    if state:
+        tokens = min(burst, state[0] + (now - state[1]) * rate)
+    allowed = tokens >= 1
+    return allowed, [tokens - 1 if allowed else tokens, now]
+
+
+class MemoryStateBackend(StateBackend):
+    def __init__(self) -> None:
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._locks: Dict[str, Tuple[str, float]] = {}
+
+    async def get(self, key: str) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        current = self._locks.get(name)
+        if current is not None and current[0] != owner and current[1] > now:
+            return False
+        self._locks[name] = (owner, now + ttl)
+        return True
+
+    async def release_lock(self, name: str, owner: str) -> None:
+        current = self._locks.get(name)
+        if current is not None and current[0] == owner:
+            self._locks.pop(name, None)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS shared_locks (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+_UPSERT_KV = (
+    "INSERT INTO shared_kv(key, value, expires_at) VALUES (?, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at"
+)
+# Как часто (сек) удалять просроченные ключи (кэши пишутся постоянно, а читаются не все)
+_PURGE_INTERVAL = 600
+
+
+class SQLiteStateBackend(StateBackend):
+    shared = True
+
+    def __init__(self, path: str) -> None:
+        self._db = SQLiteDatabase(path, _SQLITE_SCHEMA)
+        self._purged_at = 0.0
+
+    async def get(self, key: str) -> Any:
+        # Чтение без BEGIN IMMEDIATE: FSM и кэши читаются на каждом апдейте и не должны
+        # вставать в очередь за писателями; просроченное просто не отдаётся
+        def _read(conn: sqlite3.Connection) -> Optional[str]:
+            row = conn.execute(
+                "SELECT value FROM shared_kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+            return row["value"] if row is not None else None
+
+        raw = await self._db.read(_read)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        raw = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        purge = now - self._purged_at >= _PURGE_INTERVAL
+        if purge:
+            self._purged_at = now
+
+        def _write(conn: sqlite3.Connection) -> None:
+            conn.execute(_UPSERT_KV, (key, raw, expires_at))
+            if purge:
+                conn.execute("DELETE FROM shared_kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+        await self._db.run(_write)
+
+    async def take_token(self, key: str, rate: float, burst: float) -> bool:
+        def _take(conn: sqlite3.Connection) -> bool:
+            now = time.time()
+            row = conn.execute(
+                "SELECT value FROM shared_kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, now),
+            ).fetchone()
+            allowed, state = _take_from_bucket(json.loads(row["value"]) if row else None, now, rate, burst)
+            conn.execute(_UPSERT_KV, (key, json.dumps(state), now + burst / rate))
+            return allowed
+
+        return await self._db.run(_take)
+
+    async def delete(self, key: str) -> None:
+        await self._db.run(lambda conn: conn.execute("DELETE FROM shared_kv WHERE key = ?", (key,)))
+
+    async def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        def _acquire(conn: sqlite3.Connection) -> bool:
+            now = time.time()
+            cur = conn.execute(
+                "INSERT INTO shared_locks(name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE shared_locks.owner = excluded.owner OR shared_locks.expires_at <= ?",
+                (name, owner, now + ttl, now),
+            )
+            return cur.rowcount == 1
+
+        return await self._db.run(_acquire)
+
+    async def release_lock(self, name: str, owner: str) -> None:
+        await self._db.run(lambda conn: conn.execute(
+            "DELETE FROM shared_locks WHERE name = ? AND owner = ?", (name, owner)
+        ))
+
+    async def close(self) -> None:
+        self._db.close()
+
+
+_BACKENDS: Dict[str, Callable[[], StateBackend]] = {
+    "memory": MemoryStateBackend,
+    "sqlite": lambda: SQLiteStateBackend(SHARED_STATE_DB_FILE),
+}
+_backend: Optional[StateBackend] = None
+
+
+def register_backend(name: str, factory: Callable[[], StateBackend]) -> None:
+    """Зарегистрировать дополнительную реализацию (выбирается через SHARED_STATE_BACKEND)."""
+    _BACKENDS[name] = factory
+
+
+def get_state_backend() -> StateBackend:
+    global _backend
+    if _backend is None:
+        factory = _BACKENDS.get(SHARED_STATE_BACKEND)
+        if factory is None:
+            logger.error("Unknown SHARED_STATE_BACKEND %r, using memory", SHARED_STATE_BACKEND)
+            factory = MemoryStateBackend
+        _backend = factory()
+    return _backend
+
+
+def _new_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def _renew_lock(backend: StateBackend, name: str, owner: str, ttl: float) -> None:
+    """Продлевать аренду каждые ttl/3 секунд, пока блокировку держат."""
+    while True:
+        await asyncio.sleep(ttl / 3)
+        try:
+            renewed = await backend.acquire_lock(name, owner, ttl)
+        except Exception as e:
+            logger.warning("Failed to renew shared lock %s: %s", name, e)
+            continue
+        if not renewed:
+            # Аренда истекла раньше продления (процесс завис дольше ttl) и её забрали
+            logger.error("Shared lock %s was lost while held", name)
+            return
+
+
+@contextlib.asynccontextmanager
+async def shared_lock(
+    name: str,
+    ttl: float = 60,
+    poll_interval: float = 0.05,
+    backend: Optional[StateBackend] = None,
+) -> AsyncIterator[None]:
+    """Межпроцессная блокировка.
+
+    ttl защищает от блокировок, оставшихся после упавшего процесса; пока блокировка
+    взята, аренда продлевается в фоне, так что работа может длиться дольше ttl.
+    """
+    backend = backend or get_state_backend()
+    owner = _new_owner()
+    lock_name = f"lock:{name}"
+    while not await backend.acquire_lock(lock_name, owner, ttl):
+        await asyncio.sleep(poll_interval)
+    renewal = asyncio.create_task(_renew_lock(backend, lock_name, owner, ttl))
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await renewal
+        try:
+            await backend.release_lock(lock_name, owner)
+        except Exception as e:
+            logger.warning("Failed to release shared lock %s: %s", name, e)
+
+
+class SharedCache:
+    """Кэш ключ-значение поверх StateBackend.
+
+    С общим бэкендом значения видят все процессы (один запрос в Happ или панель на
+    всех); с memory — это LRU в памяти процесса на max_size ключей. local_first —
+    для неизменных значений: найденное в общем хранилище запоминается и локально,
+    повторные чтения не ходят в бэкенд. Ошибки бэкенда не пробрасываются: кэш
+    просто промахивается.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        ttl: Optional[float] = None,
+        max_size: int = 10_000,
+        local_first: bool = False,
+        backend: Optional[StateBackend] = None,
+    ) -> None:
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_size = max_size
+        self.local_first = local_first
+        self._backend = backend
+        self._local: "OrderedDict[Any, Any]" = OrderedDict()
+
+    @property
+    def backend(self) -> StateBackend:
+        return self._backend or get_state_backend()
+
+    def _remember(self, key: Any, value: Any) -> None:
+        self._local[key] = value
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    async def get(self, key: Any) -> Any:
+        backend = self.backend
+        if not backend.shared or self.local_first:
+            value = self._local.get(key)
+            if value is not None or not backend.shared:
+                if value is not None:
+                    self._local.move_to_end(key)
+                return value
+        try:
+            value = await backend.get(f"{self.namespace}:{key}")
+        except Exception as e:
+            logger.warning("Shared cache %s read failed: %s", self.namespace, e)
+            return None
+        if value is not None and self.local_first:
+            self._remember(key, value)
+        return value
+
+    async def set(self, key: Any, value: Any) -> None:
+        backend = self.backend
+        if not backend.shared or self.local_first:
+            self._remember(key, value)
+        if backend.shared:
+            try:
+                await backend.set(f"{self.namespace}:{key}", value, ttl=self.ttl)
+            except Exception as e:
+                logger.warning("Shared cache %s write failed: %s", self.namespace, e)
+
+    async def delete(self, key: Any) -> None:
+        self._local.pop(key, None)
+        backend = self.backend
+        if backend.shared:
+            try:
+                await backend.delete(f"{self.namespace}:{key}")
+            except Exception as e:
+                logger.warning("Shared cache %s delete failed: %s", self.namespace, e)
+
+
+class SharedFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх StateBackend."""
+
+    def __init__(self, backend: StateBackend) -> None:
+        self.backend = backend
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        fsm_key = self.key_builder.build(key, "state")
+        if value is None:
+            await self.backend.delete(fsm_key)
+        else:
+            await self.backend.set(fsm_key, value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self.backend.get(self.key_builder.build(key, "state"))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        fsm_key = self.key_builder.build(key, "data")
+        if not data:
+            await self.backend.delete(fsm_key)
+        else:
+            await self.backend.set(fsm_key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return await self.backend.get(self.key_builder.build(key, "data")) or {}
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+
+class SharedEventIsolation(BaseEventIsolation):
+    """Последовательная обработка обновлений одного чата, даже если они попали в разные процессы."""
+
+    def __init__(self, backend: StateBackend, ttl: float = 60) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncIterator[None]:
+        async with shared_lock(self.key_builder.build(key, "lock"), ttl=self.ttl, backend=self.backend):
+            yield
+
+    async def close(self) -> None:
+        return None
+
+
+def create_fsm_storage() -> Optional[BaseStorage]:
+    """FSM-хранилище для Dispatcher; None — стандартное MemoryStorage aiogram."""
+    backend = get_state_backend()
+    return SharedFSMStorage(backend) if backend.shared else None
+
+
+def create_event_isolation() -> Optional[BaseEventIsolation]:
+    backend = get_state_backend()
+    return SharedEventIsolation(backend) if backend.shared else None
+
+
+class LeaderElection:
+    """Аренда роли лидера: синглтон-задачи работают только в одном процессе.
+
+    Лидер продлевает аренду каждые ttl/3 секунд. Если процесс упал, через ttl роль
+    подхватывает другой.
+    """
+
+    def __init__(self, name: str = "leader", ttl: float = LEADER_LEASE_TTL, backend: Optional[StateBackend] = None):
+        self.name = f"leader:{name}"
+        self.ttl = ttl
+        self.backend = backend or get_state_backend()
+        self.owner = _new_owner()
+        self.is_leader = False
+
+    async def run(self, jobs: Sequence[Callable[[], Awaitable[Any]]]) -> None:
+        """Пока процесс лидер — держать запущенными jobs; потеряв аренду — остановить их."""
+        tasks: List[asyncio.Task] = []
+        try:
+            while True:
+                try:
+                    acquired = await self.backend.acquire_lock(self.name, self.owner, self.ttl)
+                except Exception as e:
+                    logger.error("Leader lease renewal failed: %s", e)
+                    acquired = False
+                if acquired and not self.is_leader:
+                    logger.info("Became leader (%s), starting %d singleton jobs", self.owner, len(jobs))
+                    tasks = [asyncio.create_task(job()) for job in jobs]
+                elif not acquired and self.is_leader:
+                    logger.warning("Lost leadership (%s), stopping singleton jobs", self.owner)
+                    await _cancel_all(tasks)
+                    tasks = []
+                self.is_leader = acquired
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            await _cancel_all(tasks)
+            if self.is_leader:
+                self.is_leader = False
+                with contextlib.suppress(Exception):
+                    await self.backend.release_lock(self.name, self.owner)
+
+
+async def _cancel_all(tasks: Sequence[asyncio.Task]) -> None:
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await task
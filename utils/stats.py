@@ -0,0 +1,344 @@
+import logging
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Optional
+
+from config import STATS_DB_FILE
+from utils.db import SQLiteDatabase
+
+
+logger = logging.getLogger(__name__)
+
+# Счётчики обновляются инкрементально на каждом событии (оплата, создание, продление,
+# завершение), поэтому экран статистики не требует полного прохода по пользователям.
+# Сроки подписок хранятся в почасовых корзинах: «истёкшие» — это корзины до текущего
+# часа включительно, «истекают за 7 дней» — сумма 168 следующих корзин.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats_users (
+    telegram_id INTEGER PRIMARY KEY,
+    expire_hour INTEGER,
+    trial INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stats_expiry (
+    hour INTEGER PRIMARY KEY,
+    users INTEGER NOT NULL DEFAULT 0,
+    trials INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stats_plans (
+    plan_key TEXT PRIMARY KEY,
+    payments INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stats_rollups (
+    period TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    payments INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0,
+    new_users INTEGER NOT NULL DEFAULT 0,
+    trials INTEGER NOT NULL DEFAULT 0,
+    extensions INTEGER NOT NULL DEFAULT 0,
+    expirations INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, bucket)
+);
+"""
+
+_ROLLUP_FIELDS = ("payments", "revenue", "new_users", "trials", "extensions", "expirations")
+_WEEK_HOURS = 7 * 24
+
+_db = SQLiteDatabase(STATS_DB_FILE, _SCHEMA)
+
+
+def _now_hour() -> int:
+    return int(time.time()) // 3600
+
+
+def _expire_hour(expire_ts: Any) -> Optional[int]:
+    try:
+        ts = int(expire_ts or 0)
+    except (TypeError, ValueError):
+        return None
+    return ts // 3600 if ts > 0 else None
+
+
+def _day_bucket(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d")
+
+
+def _week_bucket(dt: datetime) -> str:
+    year, week, _ = dt.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def _get_counter(conn: sqlite3.Connection, name: str, default: Optional[int] = 0) -> Optional[int]:
+    row = conn.execute("SELECT value FROM stats_counters WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else default
+
+
+def _set_counter(conn: sqlite3.Connection, name: str, value: int) -> None:
+    conn.execute(
+        "INSERT INTO stats_counters(name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        (name, value),
+    )
+
+
+def _add_counter(conn: sqlite3.Connection, name: str, delta: int) -> None:
+    if not delta:
+        return
+    conn.execute(
+        "INSERT INTO stats_counters(name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        (name, delta),
+    )
+
+
+def _bump_rollups(conn: sqlite3.Connection, ts: float, **deltas: float) -> None:
+    cols = [c for c in _ROLLUP_FIELDS if deltas.get(c)]
+    if not cols:
+        return
+    values = [deltas[c] for c in cols]
+    placeholders = ", ".join("?" for _ in cols)
+    updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in cols)
+    dt = datetime.fromtimestamp(ts)
+    for period, bucket in (("day", _day_bucket(dt)), ("week", _week_bucket(dt))):
+        conn.execute(
+            f"INSERT INTO stats_rollups(period, bucket, {', '.join(cols)}) "
+            f"VALUES (?, ?, {placeholders}) "
+            f"ON CONFLICT(period, bucket) DO UPDATE SET {updates}",
+            (period, bucket, *values),
+        )
+
+
+def _rolled_hour(conn: sqlite3.Connection) -> int:
+    rolled = _get_counter(conn, "rolled_hour", None)
+    if rolled is None:
+        rolled = _now_hour()
+        _set_counter(conn, "rolled_hour", rolled)
+    return rolled
+
+
+def _roll_forward(conn: sqlite3.Connection) -> None:
+    """Перенести корзины, чей час уже наступил, в счётчики истёкших."""
+    rolled = _rolled_hour(conn)
+    now_h = _now_hour()
+    if now_h <= rolled:
+        return
+    rows = conn.execute(
+        "SELECT hour, users, trials FROM stats_expiry WHERE hour > ? AND hour <= ?",
+        (rolled, now_h),
+    ).fetchall()
+    for row in rows:
+        _add_counter(conn, "expired", row["users"])
+        _add_counter(conn, "trials_expired", row["trials"])
+        _bump_rollups(conn, row["hour"] * 3600, expirations=row["users"])
+    _set_counter(conn, "rolled_hour", now_h)
+
+
+def _move_bucket(conn: sqlite3.Connection, hour: Optional[int], trial: int, delta: int, rolled: int) -> None:
+    if hour is None:
+        return
+    conn.execute(
+        "INSERT INTO stats_expiry(hour, users, trials) VALUES (?, ?, ?) "
+        "ON CONFLICT(hour) DO UPDATE SET users = users + excluded.users, trials = trials + excluded.trials",
+        (hour, delta, delta * trial),
+    )
+    if hour <= rolled:
+        _add_counter(conn, "expired", delta)
+        _add_counter(conn, "trials_expired", delta * trial)
+
+
+def _track_user(
+    conn: sqlite3.Connection, telegram_id: int, expire_hour: Optional[int], trial: Optional[bool]
+) -> tuple[bool, bool]:
+    """Обновить срок пользователя. Возвращает (был_истёкшим, стал_истёкшим)."""
+    _roll_forward(conn)
+    rolled = _rolled_hour(conn)
+    row = conn.execute(
+        "SELECT expire_hour, trial FROM stats_users WHERE telegram_id = ?", (telegram_id,)
+    ).fetchone()
+    if row is not None:
+        old_hour, old_trial = row["expire_hour"], int(row["trial"])
+        _move_bucket(conn, old_hour, old_trial, -1, rolled)
+    else:
+        old_hour, old_trial = None, 0
+        _add_counter(conn, "total", 1)
+    new_trial = old_trial if trial is None else int(bool(trial))
+    _add_counter(conn, "trials_total", new_trial - old_trial)
+    conn.execute(
+        "INSERT OR REPLACE INTO stats_users(telegram_id, expire_hour, trial) VALUES (?, ?, ?)",
+        (telegram_id, expire_hour, new_trial),
+    )
+    _move_bucket(conn, expire_hour, new_trial, 1, rolled)
+    was_expired = row is not None and old_hour is not None and old_hour <= rolled
+    is_expired = expire_hour is not None and expire_hour <= rolled
+    return was_expired, is_expired
+
+
+async def _run(fn, what: str) -> Any:
+    try:
+        return await _db.run(fn)
+    except Exception as e:
+        logger.warning("Stats update failed (%s): %s", what, e)
+        return None
+
+
+async def record_user_created(telegram_id: int, expire_ts: Any, trial: bool = False) -> None:
+    def _apply(conn: sqlite3.Connection) -> None:
+        _track_user(conn, telegram_id, _expire_hour(expire_ts), trial)
+        _bump_rollups(conn, time.time(), new_users=1, trials=1 if trial else 0)
+
+    await _run(_apply, "created")
+
+
+async def record_user_extended(telegram_id: int, expire_ts: Any, paid: bool = False) -> None:
+    def _apply(conn: sqlite3.Connection) -> None:
+        # Пробным пользователь быть перестаёт только после оплаты; бонусы и продления
+        # админом сохраняют отметку, иначе переход trial → оплата завышается
+        _track_user(conn, telegram_id, _expire_hour(expire_ts), False if paid else None)
+        _bump_rollups(conn, time.time(), extensions=1)
+
+    await _run(_apply, "extended")
+
+
+async def record_user_expired(telegram_id: int, expire_ts: Any) -> None:
+    def _apply(conn: sqlite3.Connection) -> None:
+        hour = _expire_hour(expire_ts)
+        if hour is None:
+            hour = _now_hour()
+        was_expired, is_expired = _track_user(conn, telegram_id, min(hour, _now_hour()), None)
+        if is_expired and not was_expired:
+            _bump_rollups(conn, time.time(), expirations=1)
+
+    await _run(_apply, "expired")
+
+
+async def record_payment(plan_key: str, amount: Any) -> None:
+    try:
+        value = float(amount)
+    except (TypeError, ValueError):
+        value = 0.0
+
+    def _apply(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "INSERT INTO stats_plans(plan_key, payments, revenue) VALUES (?, 1, ?) "
+            "ON CONFLICT(plan_key) DO UPDATE SET payments = payments + 1, revenue = revenue + excluded.revenue",
+            (plan_key, value),
+        )
+        _bump_rollups(conn, time.time(), payments=1, revenue=value)
+
+    await _run(_apply, "payment")
+
+
+async def reconcile_stats(users: Iterable[Dict[str, Any]]) -> None:
+    """Пересобрать счётчики пользователей по полному списку из панели.
+
+    Выручка и временные срезы — это журнал событий, они не пересчитываются.
+    """
+    now_h = _now_hour()
+    rows: list[tuple[int, Optional[int]]] = []
+    for user in users or []:
+        username = str(user.get("username") or "")
+        if not username.startswith("tg_"):
+            continue
+        tg_str = username.removeprefix("tg_")
+        if not tg_str.isdigit():
+            continue
+        hour = _expire_hour(user.get("expire"))
+        if user.get("status") != "active":
+            hour = now_h if hour is None else min(hour, now_h)
+        rows.append((int(tg_str), hour))
+
+    def _apply(conn: sqlite3.Connection) -> None:
+        trials = {
+            r["telegram_id"]: int(r["trial"])
+            for r in conn.execute("SELECT telegram_id, trial FROM stats_users")
+        }
+        conn.execute("DELETE FROM stats_users")
+        conn.execute("DELETE FROM stats_expiry")
+        buckets: Dict[int, list[int]] = {}
+        expired = trials_expired = trials_total = 0
+        records = []
+        for telegram_id, hour in rows:
+            trial = trials.get(telegram_id, 0)
+            records.append((telegram_id, hour, trial))
+            trials_total += trial
+            if hour is None:
+                continue
+            bucket = buckets.setdefault(hour, [0, 0])
+            bucket[0] += 1
+            bucket[1] += trial
+            if hour <= now_h:
+                expired += 1
+                trials_expired += trial
+        conn.executemany(
+            "INSERT OR REPLACE INTO stats_users(telegram_id, expire_hour, trial) VALUES (?, ?, ?)",
+            records,
+        )
+        conn.executemany(
+            "INSERT INTO stats_expiry(hour, users, trials) VALUES (?, ?, ?)",
+            [(hour, b[0], b[1]) for hour, b in buckets.items()],
+        )
+        _set_counter(conn, "total", len(records))
+        _set_counter(conn, "trials_total", trials_total)
+        _set_counter(conn, "expired", expired)
+        _set_counter(conn, "trials_expired", trials_expired)
+        _set_counter(conn, "rolled_hour", now_h)
+        _set_counter(conn, "reconciled_at", int(time.time()))
+
+    await _run(_apply, "reconcile")
+
+
+async def get_stats_snapshot(days: int = 7, weeks: int = 4) -> Optional[Dict[str, Any]]:
+    """Прочитать готовые счётчики. Стоимость не зависит от числа пользователей."""
+    now = datetime.now()
+    day_keys = [_day_bucket(now - timedelta(days=i)) for i in range(days)]
+    week_keys = []
+    for i in range(weeks):
+        key = _week_bucket(now - timedelta(weeks=i))
+        if key not in week_keys:
+            week_keys.append(key)
+
+    def _read(conn: sqlite3.Connection) -> Dict[str, Any]:
+        _roll_forward(conn)
+        now_h = _now_hour()
+        total = _get_counter(conn, "total") or 0
+        expired = _get_counter(conn, "expired") or 0
+        trials_total = _get_counter(conn, "trials_total") or 0
+        trials_expired = _get_counter(conn, "trials_expired") or 0
+        expiring = conn.execute(
+            "SELECT COALESCE(SUM(users), 0) FROM stats_expiry WHERE hour > ? AND hour <= ?",
+            (now_h, now_h + _WEEK_HOURS),
+        ).fetchone()[0]
+        plans = [dict(r) for r in conn.execute(
+            "SELECT plan_key, payments, revenue FROM stats_plans ORDER BY revenue DESC"
+        )]
+
+        def _rollups(period: str, keys: list[str]) -> list[Dict[str, Any]]:
+            found = {
+                r["bucket"]: dict(r)
+                for r in conn.execute(
+                    f"SELECT * FROM stats_rollups WHERE period = ? AND bucket IN ({', '.join('?' for _ in keys)})",
+                    (period, *keys),
+                )
+            }
+            empty = {field: 0 for field in _ROLLUP_FIELDS}
+            return [found.get(key) or {"period": period, "bucket": key, **empty} for key in keys]
+
+        return {
+            "total": total,
+            "active": total - expired,
+            "expired": expired,
+            "active_trials": trials_total - trials_expired,
+            "expiring_7d": expiring,
+            "plans": plans,
+            "days": _rollups("day", day_keys),
+            "weeks": _rollups("week", week_keys),
+            "reconciled_at": _get_counter(conn, "reconciled_at", None),
+        }
+
+    return await _run(_read, "snapshot")
@@ -0,0 +1,164 @@
+"""Ограничение частоты апдейтов на пользователя, чтобы спам кнопками не нагружал панель.
+
+Для каждой пары (пользователь, действие) хранится token bucket: [токены, время обновления].
+Действия, которые ходят в Marzban (/start, подписка, главное меню, список тарифов),
+ограничены строже остальных. Повторное нажатие той же кнопки, пока первое ещё
+обрабатывается, склеивается с ним: второй запрос в панель не уходит. При превышении
+лимита колбэк получает всплывающее «подождите», а на экране остаётся уже показанный
+ответ; лишние сообщения (флуд /start) молча отбрасываются.
+
+С общим бэкендом состояния (BOT_WORKERS>1) корзины лежат в нём, и лимит один на
+все процессы; иначе — в памяти процесса, а полные (давно неактивные) корзины
+удаляются при периодической чистке прямо из middleware, без отдельной задачи.
+Склейка повторных нажатий всегда локальна: апдейты одного чата и так
+обрабатываются по очереди (SharedEventIsolation).
+"""
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+from config import (
+    ADMIN_ID_SET,
+    MESSAGES,
+    THROTTLE_DEFAULT_BURST,
+    THROTTLE_DEFAULT_PER_MINUTE,
+    THROTTLE_PANEL_BURST,
+    THROTTLE_PANEL_PER_MINUTE,
+)
+from utils.metrics import THROTTLED
+from utils.shared_state import get_state_backend
+
+
+logger = logging.getLogger(__name__)
+
+# callback_data, обработчики которых обращаются к панели
+PANEL_CALLBACKS = frozenset({"my_subscription", "back_to_main", "buy_subscription", "extend_subscription"})
+_EVICT_INTERVAL = 60.0
+
+
+class TokenBucketLimiter:
+    """Token bucket на ключ; rate — токенов в секунду, burst — ёмкость корзины."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = float(max(1, burst))
+        self._buckets: Dict[Any, List[float]] = {}
+        self._evicted_at = time.monotonic()
+
+    def allow(self, key: Any, now: Optional[float] = None) -> bool:
+        if self.rate <= 0:
+            return True
+        if now is None:
+            now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [self.burst - 1, now]
+            allowed = True
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            allowed = tokens >= 1
+            bucket[0] = tokens - 1 if allowed else tokens
+        if now - self._evicted_at >= _EVICT_INTERVAL:
+            self.evict(now)
+        return allowed
+
+    def evict(self, now: Optional[float] = None) -> int:
+        """Удалить корзины, которые уже успели наполниться: они неотличимы от новых."""
+        if now is None:
+            now = time.monotonic()
+        self._evicted_at = now
+        refill = self.burst / self.rate if self.rate > 0 else 0.0
+        stale = [key for key, (_, updated) in self._buckets.items() if now - updated >= refill]
+        for key in stale:
+            del self._buckets[key]
+        return len(stale)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+def _action(event: TelegramObject) -> Tuple[Optional[str], bool]:
+    """Ключ действия и признак обращения к панели."""
+    if isinstance(event, CallbackQuery):
+        data = event.data or ""
+        if data in PANEL_CALLBACKS:
+            return data, True
+        return "callback", False
+    if isinstance(event, Message):
+        text = event.text or ""
+        if text.startswith("/start"):
+            return "start", True
+        return "message", False
+    return None, False
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: per-user лимиты и склейка повторных нажатий."""
+
+    def __init__(self) -> None:
+        self.panel = TokenBucketLimiter(THROTTLE_PANEL_PER_MINUTE / 60, THROTTLE_PANEL_BURST)
+        self.default = TokenBucketLimiter(THROTTLE_DEFAULT_PER_MINUTE / 60, THROTTLE_DEFAULT_BURST)
+        backend = get_state_backend()
+        self._shared = backend if backend.shared else None
+        # (user_id, action) панельных действий, которые сейчас обрабатываются
+        self._in_flight: Set[Tuple[int, str]] = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id in ADMIN_ID_SET:
+            return await handler(event, data)
+        target = event.event if isinstance(event, Update) else event
+        action, panel = _action(target)
+        if action is None:
+            return await handler(event, data)
+
+        key = (user.id, action)
+        if panel and key in self._in_flight:
+            THROTTLED.inc(action, "coalesced")
+            await self._reject(target, notify=False)
+            return None
+        limiter = self.panel if panel else self.default
+        if not await self._allow(limiter, key):
+            THROTTLED.inc(action, "rate")
+            await self._reject(target, notify=True)
+            return None
+
+        if not panel:
+            return await handler(event, data)
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+
+    async def _allow(self, limiter: TokenBucketLimiter, key: Tuple[int, str]) -> bool:
+        if self._shared is None or limiter.rate <= 0:
+            return limiter.allow(key)
+        try:
+            return await self._shared.take_token(f"throttle:{key[0]}:{key[1]}", limiter.rate, limiter.burst)
+        except Exception as e:
+            # Бэкенд недоступен — ограничиваем хотя бы в пределах процесса
+            logger.warning("Shared throttle bucket failed: %s", e)
+            return limiter.allow(key)
+
+    @staticmethod
+    async def _reject(target: TelegramObject, notify: bool) -> None:
+        # Колбэк обязательно подтверждаем, иначе у клиента крутится индикатор загрузки
+        if not isinstance(target, CallbackQuery):
+            return
+        try:
+            if notify:
+                await target.answer(MESSAGES["throttled"])
+            else:
+                await target.answer()
+        except Exception as e:
+            logger.debug("Failed to answer throttled callback: %s", e)
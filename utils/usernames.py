@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import TelegramObject
+
+from config import (
+    MARZBAN_BASE_URL,
+    MARZBAN_USERNAME,
+    MARZBAN_PASSWORD,
+    USERNAME_FLUSH_INTERVAL,
+    USERNAME_FLUSH_DEBOUNCE,
+    USERNAME_SEEN_TTL,
+    USERNAME_SYNC_CONCURRENCY,
+)
+from services.marzban_service import MarzbanService, get_cached_user_info
+from utils.admission import BATCH, with_traffic_class
+from utils.helpers import extract_username, normalize_username, update_note_with_username
+
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+# Пауза между запусками get_chat при синхронизации (общая для всех параллельных вызовов)
+_GET_CHAT_PAUSE = 0.03
+# Сколько раз повторять get_chat после flood-ограничения (429 retry_after)
+_GET_CHAT_RETRIES = 3
+# Как часто забывать пользователей, не писавших боту дольше USERNAME_SEEN_TTL
+_PRUNE_INTERVAL = 10 * 60
+
+# telegram_id -> время последнего апдейта (unix time)
+_last_seen: Dict[int, float] = {}
+# telegram_id -> последний username из апдейтов (нормализованный, с @)
+_observed: Dict[int, Optional[str]] = {}
+# telegram_id -> username, который точно записан в note в Marzban
+_stored: Dict[int, Optional[str]] = {}
+# telegram_id -> monotonic-время последнего изменения, ожидающего записи
+_pending: Dict[int, float] = {}
+# Словари выше хранят только недавно активных пользователей (см. _prune_idle)
+_pruned_at = 0.0
+
+_service: Optional[MarzbanService] = None
+
+
+def _get_service() -> MarzbanService:
+    global _service
+    if _service is None:
+        _service = MarzbanService(MARZBAN_BASE_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD)
+    return _service
+
+
+def remember_seen(telegram_id: int, username: Optional[str]) -> None:
+    """Запомнить актуальный username из входящего апдейта.
+
+    Запись в Marzban откладывается: пользователь попадает в очередь только если
+    значение отличается от уже известного.
+    """
+    _last_seen[telegram_id] = time.time()
+    normalized = normalize_username(username)
+    if _observed.get(telegram_id, _MISSING) == normalized:
+        return
+    _observed[telegram_id] = normalized
+    if _stored.get(telegram_id, _MISSING) == normalized:
+        _pending.pop(telegram_id, None)
+        return
+    _pending[telegram_id] = time.monotonic()
+
+
+def remember_note(telegram_id: int, note: Optional[str]) -> None:
+    """Запомнить username, который уже лежит в note (после чтения профиля из Marzban)."""
+    stored = extract_username(note)
+    _stored[telegram_id] = stored
+    if _observed.get(telegram_id, _MISSING) == stored:
+        _pending.pop(telegram_id, None)
+
+
+def _prune_idle(now: Optional[float] = None) -> int:
+    """Забыть пользователей без апдейтов дольше USERNAME_SEEN_TTL (кроме ожидающих записи).
+
+    Возвращает число забытых. При следующем апдейте такой пользователь снова сверится
+    с note — из кэша профилей, а при его отсутствии — чтением из панели.
+    """
+    global _pruned_at
+    now = time.time() if now is None else now
+    _pruned_at = now
+    cutoff = now - USERNAME_SEEN_TTL
+    for tg_id in [tg_id for tg_id, seen_at in _last_seen.items() if seen_at < cutoff and tg_id not in _pending]:
+        del _last_seen[tg_id]
+    removed = 0
+    for mapping in (_observed, _stored):
+        for tg_id in [tg_id for tg_id in mapping if tg_id not in _last_seen and tg_id not in _pending]:
+            del mapping[tg_id]
+            removed += 1
+    return removed
+
+
+def was_seen_recently(telegram_id: int, ttl: int = USERNAME_SEEN_TTL) -> bool:
+    seen_at = _last_seen.get(telegram_id)
+    return seen_at is not None and (time.time() - seen_at) <= ttl
+
+
+class UsernameCaptureMiddleware(BaseMiddleware):
+    """Собирает username из апдейтов, которые бот и так получает."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None and not getattr(user, "is_bot", False):
+            try:
+                remember_seen(user.id, getattr(user, "username", None))
+            except Exception:
+                pass
+        return await handler(event, data)
+
+
+async def _write_username(service: MarzbanService, telegram_id: int, username: Optional[str]) -> bool:
+    """Записать username в note, если он действительно изменился. Возвращает True при записи.
+
+    Если панель недоступна или запись не удалась — исключение: изменение вернётся в очередь.
+    """
+    # Перед записью всегда читаем свежую note, чтобы не затереть ref/nd-метки.
+    # fetch_user_info, а не get_user_info: ошибка панели не должна выглядеть как «профиля нет»
+    info = await service.fetch_user_info(telegram_id)
+    if not info:
+        # Профиля в Marzban нет — писать некуда
+        return False
+    note = info.get("note")
+    new_note = update_note_with_username(note, username)
+    if new_note == note:
+        _stored[telegram_id] = username
+        return False
+    if not await service.set_user_note(telegram_id, new_note):
+        raise RuntimeError("set_user_note failed")
+    _stored[telegram_id] = username
+    return True
+
+
+@with_traffic_class(BATCH)
+async def flush_pending_usernames(service: Optional[MarzbanService] = None) -> int:
+    """Записать накопленные изменения username пачкой с ограниченной параллельностью."""
+    if not _pending:
+        return 0
+    service = service or _get_service()
+    now = time.monotonic()
+    ready = [tg_id for tg_id, since in _pending.items() if now - since >= USERNAME_FLUSH_DEBOUNCE]
+    if not ready:
+        return 0
+    for tg_id in ready:
+        _pending.pop(tg_id, None)
+
+    semaphore = asyncio.Semaphore(max(1, USERNAME_SYNC_CONCURRENCY))
+
+    async def _one(tg_id: int) -> bool:
+        async with semaphore:
+            username = _observed.get(tg_id)
+            if _stored.get(tg_id, _MISSING) == username:
+                return False
+            # Профиль из общего кэша (его уже читали экраны бота, в т.ч. до рестарта):
+            # если username там уже записан, панель не трогаем
+            cached = await get_cached_user_info(tg_id)
+            if cached is not None:
+                remember_note(tg_id, cached[0].get("note"))
+                if _stored.get(tg_id, _MISSING) == username:
+                    return False
+            return await _write_username(service, tg_id, username)
+
+    results = await asyncio.gather(*(_one(tg_id) for tg_id in ready), return_exceptions=True)
+    written = 0
+    for tg_id, res in zip(ready, results):
+        if isinstance(res, Exception):
+            logger.warning("Failed to flush username for %s: %s", tg_id, res)
+            # Повторим в следующий раз
+            _pending.setdefault(tg_id, time.monotonic())
+        elif res:
+            written += 1
+    if written:
+        logger.info("Flushed %d username changes to Marzban notes", written)
+    return written
+
+
+async def run_username_flush_loop() -> None:
+    while True:
+        try:
+            await asyncio.sleep(USERNAME_FLUSH_INTERVAL)
+            await flush_pending_usernames()
+            if time.time() - _pruned_at >= _PRUNE_INTERVAL:
+                _prune_idle()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error("Username flush failed: %s", e)
+
+
+async def _paced_get_chat(bot: Bot, tg_id: int, pace: asyncio.Lock) -> Any:
+    for attempt in range(_GET_CHAT_RETRIES + 1):
+        async with pace:
+            await asyncio.sleep(_GET_CHAT_PAUSE)
+        try:
+            return await bot.get_chat(tg_id)
+        except TelegramRetryAfter as e:
+            if attempt >= _GET_CHAT_RETRIES:
+                raise
+            logger.warning("get_chat flood limit, waiting %ss", e.retry_after)
+            # Ждём под тем же замком: остальные get_chat тоже стоят, пока лимит не снят
+            async with pace:
+                await asyncio.sleep(e.retry_after)
+
+
+@with_traffic_class(BATCH)
+async def sync_note_usernames(
+    bot: Bot, service: MarzbanService, candidates: Iterable[tuple[int, dict]]
+) -> Dict[str, int]:
+    """Сверить username в note со свежими данными.
+
+    Для пользователей, от которых недавно были апдейты, используется уже известный
+    username; get_chat вызывается только для остальных, с ограниченной параллельностью,
+    паузой между вызовами и ожиданием при flood-ограничении Telegram.
+    """
+    counters = {"updated": 0, "unchanged": 0, "missing": 0, "errors": 0, "cached": 0}
+    semaphore = asyncio.Semaphore(max(1, USERNAME_SYNC_CONCURRENCY))
+    pace = asyncio.Lock()
+
+    async def _one(tg_id: int, user: dict) -> None:
+        current_note = user.get("note")
+        remember_note(tg_id, current_note)
+        try:
+            if was_seen_recently(tg_id) and tg_id in _observed:
+                actual_username = _observed.get(tg_id)
+                counters["cached"] += 1
+            else:
+                async with semaphore:
+                    chat = await _paced_get_chat(bot, tg_id, pace)
+                actual_username = getattr(chat, "username", None)
+            if not actual_username:
+                counters["missing"] += 1
+
+            new_note = update_note_with_username(current_note, actual_username)
+            if new_note == current_note:
+                counters["unchanged"] += 1
+                return
+            async with semaphore:
+                try:
+                    success = await service.set_user_note(tg_id, new_note)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    success = False
+            if success:
+                _stored[tg_id] = normalize_username(actual_username)
+                counters["updated"] += 1
+            else:
+                counters["errors"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            counters["errors"] += 1
+
+    await asyncio.gather(*(_one(tg_id, user) for tg_id, user in candidates))
+    return counters
@@ -1,27 +1,82 @@
+import asyncio
+import hmac
 import logging
+import threading
+import time
+import uvicorn
 from fastapi import FastAPI, Request
-from fastapi.responses import PlainTextResponse
-from aiogram import Bot
+from fastapi.responses import PlainTextResponse, Response
+from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.types import Update
 
-from handlers.payment import process_payment_notification
-from config import BOT_TOKEN
+from handlers.payment import payment_service, process_payment_notification
+from config import BOT_TOKEN, METRICS_TOKEN, PROFILING_DEFAULT_SECONDS, PROFILING_TOKEN
+from utils.metrics import PAYMENT_STAGE_SECONDS, render_metrics
+from utils.profiling import ProfilerBusy, memory_diff, sample_cpu_profile
+from utils.payment_queue import enqueue_notification
 
 logger = logging.getLogger(__name__)
 
 
-def create_app(bot: Bot | None = None) -> FastAPI:
+TELEGRAM_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def create_app(
+    bot: Bot | None = None,
+    dispatcher: Dispatcher | None = None,
+    telegram_url: str | None = None,
+    telegram_secret: str | None = None,
+    payment_queue: bool = False,
+) -> FastAPI:
+    """Webhook-сервер. Если переданы dispatcher, telegram_url и telegram_secret,
+    он также принимает обновления Telegram на /telegram/<secret>.
+
+    С payment_queue=True уведомления YooMoney только проверяются и кладутся в очередь
+    (utils.payment_queue), а подписку активирует бот."""
     app = FastAPI(title="Averra VPN Webhooks")
+    telegram_enabled = dispatcher is not None and bool(telegram_url) and bool(telegram_secret)
+    # Обновления обрабатываются в фоне: Telegram получает 200 сразу, не дожидаясь хендлеров
+    pending_updates: set[asyncio.Task] = set()
 
     @app.get("/health")
     async def health() -> dict:
         return {"status": "ok"}
 
+    @app.get("/metrics")
+    async def metrics(request: Request):
+        if METRICS_TOKEN:
+            header = request.headers.get("authorization", "")
+            if not hmac.compare_digest(header, f"Bearer {METRICS_TOKEN}"):
+                return Response(status_code=401)
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/debug/profile/{kind}")
+    async def debug_profile(kind: str, request: Request, seconds: int = PROFILING_DEFAULT_SECONDS):
+        # Без токена маршрут не существует
+        if not PROFILING_TOKEN:
+            return Response(status_code=404)
+        header = request.headers.get("authorization", "")
+        if not hmac.compare_digest(header, f"Bearer {PROFILING_TOKEN}"):
+            return Response(status_code=401)
+        run = {"cpu": sample_cpu_profile, "memory": memory_diff}.get(kind)
+        if run is None:
+            return Response(status_code=404)
+        try:
+            result = await run(seconds)
+        except ProfilerBusy:
+            return PlainTextResponse("profiler is busy", status_code=409)
+        return Response(
+            content=result.content,
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{result.filename}"'},
+        )
+
     @app.on_event("startup")
     async def on_startup() -> None:
         nonlocal bot
-        if bot is None:
+        if bot is None and not payment_queue:
             bot = Bot(
                 token=BOT_TOKEN,
                 default=DefaultBotProperties(parse_mode=ParseMode.HTML)
@@ -30,10 +85,23 @@ def create_app(bot: Bot | None = None) -> FastAPI:
         else:
             app.state.owns_bot = False
         app.state.bot = bot
+        if telegram_enabled:
+            url = f"{telegram_url}/telegram/{telegram_secret}"
+            await bot.set_webhook(
+                url=url,
+                secret_token=telegram_secret,
+                allowed_updates=dispatcher.resolve_used_update_types(),
+                drop_pending_updates=False,
+            )
+            logger.info("Telegram webhook set to %s/telegram/***", telegram_url)
 
     @app.on_event("shutdown")
     async def on_shutdown() -> None:
         # Close only if app created its own bot
+        if pending_updates:
+            # Даём догореть уже принятым обновлениям; вебхук не снимаем —
+            # Telegram придержит новые обновления до следующего запуска
+            await asyncio.wait(set(pending_updates), timeout=10)
         b: Bot | None = getattr(app.state, "bot", None)
         owns: bool = getattr(app.state, "owns_bot", False)
         if b is not None and owns:
@@ -60,16 +128,94 @@ def create_app(bot: Bot | None = None) -> FastAPI:
 
         logger.info("YooMoney webhook received: %s", {k: v for k, v in data.items() if k != 'sha1_hash'})
 
+        if payment_queue:
+            started = time.perf_counter()
+            if not payment_service.verify_notification(data):
+                return PlainTextResponse("ERR", status_code=200)
+            try:
+                await enqueue_notification(data)
+            except Exception as queue_err:
+                logger.error("Failed to enqueue YooMoney notification: %s", queue_err)
+                return PlainTextResponse("ERR", status_code=200)
+            PAYMENT_STAGE_SECONDS.observe(time.perf_counter() - started, "ingest")
+            return PlainTextResponse("OK", status_code=200)
+
         b: Bot | None = getattr(app.state, "bot", None)
-        processed = await process_payment_notification(data, bot=b)
-        if processed:
+        result = await process_payment_notification(data, bot=b)
+        if result == "processed":
             return PlainTextResponse("OK", status_code=200)
         return PlainTextResponse("ERR", status_code=200)
 
+    async def _feed_update(b: Bot, update: Update) -> None:
+        try:
+            await dispatcher.feed_update(b, update)
+        except Exception as e:
+            logger.exception("Failed to process Telegram update %s: %s", update.update_id, e)
+
+    @app.post("/telegram/{secret}")
+    async def telegram_webhook(secret: str, request: Request):
+        if not telegram_enabled:
+            return Response(status_code=404)
+        header = request.headers.get(TELEGRAM_SECRET_HEADER, "")
+        if not (
+            hmac.compare_digest(secret, telegram_secret)
+            and hmac.compare_digest(header, telegram_secret)
+        ):
+            logger.warning("Rejected Telegram webhook call with invalid secret")
+            return Response(status_code=401)
+        b: Bot = app.state.bot
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": b})
+        except Exception as parse_err:
+            logger.error("Telegram update parse error: %s", parse_err)
+            return Response(status_code=200)
+        task = asyncio.create_task(_feed_update(b, update))
+        pending_updates.add(task)
+        task.add_done_callback(pending_updates.discard)
+        return Response(status_code=200)
+
     return app
 
 
+class PaymentServerThread(threading.Thread):
+    """Сервер приёма оплат в отдельном потоке со своим event loop.
+
+    Нагрузка бота (рассылки, медленные хендлеры) не задерживает ответы YooMoney.
+    При падении сервер перезапускается через restart_delay секунд.
+    """
+
+    def __init__(self, host: str, port: int, restart_delay: float = 5):
+        super().__init__(name="payment-server", daemon=True)
+        self.host = host
+        self.port = port
+        self.restart_delay = restart_delay
+        self._server: uvicorn.Server | None = None
+        self._stopping = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopping.is_set():
+            config = uvicorn.Config(
+                app=create_app(payment_queue=True), host=self.host, port=self.port, log_level="info"
+            )
+            self._server = uvicorn.Server(config)
+            try:
+                asyncio.run(self._server.serve())
+            except BaseException as e:
+                # uvicorn завершает процесс через SystemExit, если не смог занять порт
+                logger.error("Payment server crashed: %r", e)
+            if self._stopping.wait(self.restart_delay):
+                break
+            logger.warning("Restarting payment server on %s:%s", self.host, self.port)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._server is not None:
+            self._server.should_exit = True
+
+
 # Backward compatibility when running uvicorn webhook:app
 app = create_app()
+# Отдельный процесс приёма оплат: uvicorn webhook:payment_app (бот с PAYMENT_SERVER_MODE=external)
+payment_app = create_app(payment_queue=True)
 
 